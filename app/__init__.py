@@ -1,6 +1,6 @@
 import os
 import logging
-from logging.handlers import SMTPHandler, RotatingFileHandler
+from logging.handlers import RotatingFileHandler
 from flask import Flask, request, current_app
 from config import Config
 from flask_sqlalchemy import SQLAlchemy
@@ -10,8 +10,7 @@ from flask_mail import Mail
 from flask_bootstrap import Bootstrap
 from flask_moment import Moment
 from flask_babel import Babel
-import sentry_sdk
-from sentry_sdk.integrations.flask import FlaskIntegration
+from app.logging_pipeline import AggregatingSMTPHandler, attach_queued_handlers
 
 
 # This class is used to control the SQLAlchemy integration to one or more Flask applications. Depending on how you
@@ -20,11 +19,6 @@ from sentry_sdk.integrations.flask import FlaskIntegration
 # The usage mode which is utilized involves binding the instance to a very specific Flask application:
 db = SQLAlchemy()
 
-# Sentry extension
-sentry_sdk.init(
-    dsn="https://b4fd20a1b0d34a6abefbda5c324aaefc@sentry.io/1456192",
-    integrations=[FlaskIntegration()])
-
 # Flask-Migrate is an extension that handles SQLAlchemy database migrations for Flask applications using Alembic. The
 # database operations are made available through the Flask command-line interface or through the Flask-Script
 # extension. This is utilizing the Flask-Script exposing the database migrations.
@@ -134,6 +128,56 @@ def create_app(config_class=Config):
     moment.init_app(app)
     babel.init_app(app)
 
+    # The group committer batches post submissions from concurrent requests into a single transaction. It imports the
+    # models, so just like the blueprints below it is imported right before it is used to avoid circular imports.
+    from app.group_commit import group_commit
+    group_commit.init_app(app)
+
+    # Count the queries and the database time of every request, and warn about N+1 query patterns
+    from app import instrumentation
+    instrumentation.init_app(app)
+
+    # Latency histograms per endpoint and the other runtime metrics, exposed at /metrics
+    from app import metrics
+    metrics.init_app(app)
+
+    # Profile a sample of the requests (or the ones an admin asks for) and keep the profiles for flamegraphs
+    from app import profiling
+    profiling.init_app(app)
+
+    # Compiled templates are kept in a bytecode cache on disk that all the workers share (see app/templating.py)
+    from app import templating
+    templating.init_app(app)
+
+    # Static files are served under content-hashed names with long lived caching once "flask assets build" has run
+    from app import assets
+    assets.init_app(app)
+
+    # Explore pages shared by all the workers through files on disk
+    if app.config['PAGE_CACHE_ENABLED']:
+        from app import page_cache
+        page_cache.init_app(app)
+
+    # The newest posts are kept in memory for the first explore pages
+    if app.config['RECENT_POSTS_ENABLED']:
+        from app import recent_posts
+        recent_posts.init_app(app)
+
+    # The follow graph kept in memory in compact arrays, loaded on first use
+    if app.config['GRAPH_ENABLED']:
+        from app import graph
+        graph.init_app(app)
+
+    # New posts pushed to the open home pages over server-sent events, off unless asked for (see app/live.py)
+    if app.config['LIVE_ENABLED']:
+        from app import live
+        live.init_app(app)
+
+    # One structured JSON line per request with its timing breakdown, written on a background thread
+    if app.config['ACCESS_LOG_ENABLED']:
+        from app import access_log
+        access_log.init_app(app)
+
     # To register a blueprint, the register_blueprint() method of the Flask application instance is used. When a
     # blueprint is registered, any view functions, templates, static files, error handlers, etc. are connected to the
     # application. Import of the blueprint goes right above the app.register_blueprint() to avoid circular dependencies.
@@ -158,15 +202,42 @@ def create_app(config_class=Config):
     from app.main import bp as main_bp
     app.register_blueprint(main_bp)
 
+    # The JSON API for scripts and mobile clients, versioned in its URL so that it can change without breaking them
+    from app.api import bp as api_bp
+    app.register_blueprint(api_bp, url_prefix='/api/v1')
+
+    # With TEMPLATE_WARMUP every template is compiled now, so that the first requests of a new worker do not pay for it
+    if app.config['TEMPLATE_WARMUP']:
+        compiled, errors = templating.compile_templates(app)
+        for name, error in errors:
+            app.logger.error('Template %s does not compile: %s', name, error)
+
+    # HTML and JSON responses are gzipped by a WSGI middleware wrapped around the application (see app/compression.py)
+    if app.config['COMPRESSION_ENABLED']:
+        from app import compression
+        compression.init_app(app)
+
+    # Sentry error and performance monitoring is only set up when a SENTRY_DSN is configured, and never in unit tests.
+    # It used to be initialized at import time, which slowed down every import of the package and started the Sentry
+    # transport threads even in tests and CLI commands. See init_sentry() below for the options that keep its cost
+    # predictable.
+    if app.config['SENTRY_DSN'] and not app.testing:
+        init_sentry(app)
+
     # I'm only going to enable the email logger when the application is running without debug mode, indicated by
     # app.debug being True, and also when the email server exists in the configuration.
     #
     # Setting up the email logger is somewhat tedious due to having to handle optional security options that are present
-    # in many email servers. But in essence, the code below creates a SMTPHandler instance, sets its level so that it
-    # only reports errors and not warnings, informational or debugging messages, and finally attaches it to the
-    # app.logger object from Flask.
+    # in many email servers. But in essence, the code below creates an email handler instance, sets its level so that
+    # it only reports errors and not warnings, informational or debugging messages.
+    #
+    # The handlers are NOT attached to app.logger directly. They are handed to attach_queued_handlers() (see
+    # app/logging_pipeline.py) which puts a queue in between: logging a record only enqueues it, and a background
+    # thread does the slow work of writing the file and talking to the mail server. The email handler also collects
+    # the errors and sends them together, at most one email every LOG_MAIL_INTERVAL seconds.
     if not app.debug and not app.testing:
-        # EXPLAIN FURTHER
+        handlers = []
+
         if app.config['MAIL_SERVER']:
 
             auth = None
@@ -178,27 +249,29 @@ def create_app(config_class=Config):
             if app.config['MAIL_USE_TLS']:
                 secure = ()
 
-            mail_handler = SMTPHandler(
+            mail_handler = AggregatingSMTPHandler(
                 mailhost=(app.config['MAIL_SERVER'], app.config['MAIL_PORT']),
                 fromaddr='no-reply@' + app.config['MAIL_SERVER'],
                 toaddrs=app.config['ADMINS'], subject='Microblog Failure',
-                credentials=auth, secure=secure)
+                credentials=auth, secure=secure,
+                interval=app.config['LOG_MAIL_INTERVAL'], max_records=app.config['LOG_MAIL_MAX_RECORDS'])
 
             mail_handler.setLevel(logging.ERROR)
-            app.logger.addHandler(mail_handler)
+            handlers.append(mail_handler)
 
         # Receiving errors via email is nice, but sometimes this isn't enough. There are some failure conditions
         # that do not end in a Python exception and are not a major problem, but they may still be interesting enough to
         # save for debugging purposes. For this reason, I'm also going to maintain a log file for the application.
         #
-        # To enable a file based log another handler, this time of type RotatingFileHandler, needs to be attached to the
-        # application logger, in a similar way to the email handler.
+        # To enable a file based log another handler, this time of type RotatingFileHandler, is added next to the
+        # email handler.
         #
         # Write the log file with name microblog.log in a logs directory, which I create if it doesn't already exist.
         #
         # The RotatingFileHandler class is nice because it rotates the logs, ensuring that the log files do not grow too
-        # large when the application runs for a long time. In this case I'm limiting the size of the log file to 10KB,
-        # and I'm keeping the last ten log files as backup.
+        # large when the application runs for a long time. The size of each file is LOG_MAX_BYTES (10MB by default, a
+        # limit of a few KB means renaming files all the time under production traffic) and I'm keeping the last
+        # LOG_BACKUP_COUNT log files as backup.
         #
         # The logging.Formatter class provides custom formatting for the log messages. Since these messages are going to
         # a file, I want them to have as much information as possible.I'm using a format that includes the timestamp,
@@ -214,11 +287,14 @@ def create_app(config_class=Config):
 
             os.mkdir('logs')
 
-        file_handler = RotatingFileHandler('logs/microblog.log', maxBytes=10240, backupCount=10)
+        file_handler = RotatingFileHandler('logs/microblog.log', maxBytes=app.config['LOG_MAX_BYTES'],
+                                           backupCount=app.config['LOG_BACKUP_COUNT'])
         file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s '
                                                     '[in %(pathname)s:%(lineno)d]'))
         file_handler.setLevel(logging.INFO)
-        app.logger.addHandler(file_handler)
+        handlers.append(file_handler)
+
+        attach_queued_handlers(app.logger, handlers, maxsize=app.config['LOG_QUEUE_SIZE'])
 
         app.logger.setLevel(logging.INFO)
         app.logger.info("Acorn's Microblog startup")
@@ -227,6 +303,33 @@ def create_app(config_class=Config):
 
 # -------------------------------------------------------------------------------------------------------------------
 
+# Sentry is a process wide client, so it is initialized once per process even if create_app() is called again. The
+# sentry_sdk import is done here so that the package is not even loaded when Sentry is not configured.
+#
+#   traces_sample_rate    -->  the fraction of the requests that are sent as performance traces (0 disables them)
+#   transport_queue_size  -->  events are sent by a background thread from a queue of this size; when the queue is
+#                              full new events are dropped instead of making the request that raised them wait
+#   shutdown_timeout      -->  how many seconds the process waits at exit for the queued events to be sent
+
+
+def init_sentry(app):
+    import sentry_sdk
+    from sentry_sdk.integrations.flask import FlaskIntegration
+
+    if sentry_sdk.Hub.current.client is not None:
+        return
+
+    sentry_sdk.init(
+        dsn=app.config['SENTRY_DSN'],
+        environment=app.config['SENTRY_ENVIRONMENT'],
+        integrations=[FlaskIntegration()],
+        sample_rate=app.config['SENTRY_SAMPLE_RATE'],
+        traces_sample_rate=app.config['SENTRY_TRACES_SAMPLE_RATE'],
+        transport_queue_size=app.config['SENTRY_TRANSPORT_QUEUE_SIZE'],
+        shutdown_timeout=app.config['SENTRY_SHUTDOWN_TIMEOUT'])
+
+# -------------------------------------------------------------------------------------------------------------------
+
 # The Babel instance provides a localeselector decorator. The decorated function is invoked for each request to
 # select a language translation to use for that request:
 #
@@ -0,0 +1,208 @@
+import gzip
+import json
+import logging
+import math
+import os
+import threading
+from datetime import datetime
+from logging.handlers import MemoryHandler, RotatingFileHandler
+from time import perf_counter, time
+from flask import _request_ctx_stack, before_render_template, g, has_request_context, request, template_rendered
+from app.instrumentation import current_stats
+from app.logging_pipeline import attach_queued_handlers
+
+
+# ----------------------------------------------- ACCESS LOG -----------------------------------------------------
+#
+# One JSON object per line, per request, written to ACCESS_LOG_PATH:
+#
+#   {"ts": "2019-05-20T10:31:02.120Z", "method": "GET", "path": "/explore", "endpoint": "main.explore",
+#    "status": 200, "user_id": 12, "latency_ms": 41.2, "db_ms": 12.9, "db_queries": 14, "template_ms": 18.3,
+#    "cache_hits": 0, "cache_misses": 1, "bytes": 15234}
+#
+# The timing breakdown comes from the SQL instrumentation (db_ms, db_queries), from Flask's template signals
+# (template_ms, the time between before_render_template and template_rendered) and from the caches, which count
+# their hits and misses in the request with record_cache_lookup().
+#
+# Writing the log must not slow down the requests, so the lines go through the same queue and background thread as
+# the application log (app/logging_pipeline.py), and they are written to the file in batches of ACCESS_LOG_BUFFER
+# lines (or once a second, whichever comes first) instead of one write and flush per request.
+#
+# The "flask accesslog stats" command (app/cli.py) reads these files back with stats() below.
+# ----------------------------------------------------------------------------------------------------------------
+
+logger = logging.getLogger('microblog.access')
+
+
+# Called for every cache lookup (by record_cache() in app/metrics.py), so each line tells how the request was served
+def record_cache_lookup(hit):
+    if not has_request_context():
+        return
+    if hit:
+        g._cache_hits = g.get('_cache_hits', 0) + 1
+    else:
+        g._cache_misses = g.get('_cache_misses', 0) + 1
+
+
+def _before_render(sender, template, context, **extra):
+    g._render_start = perf_counter()
+
+
+def _rendered(sender, template, context, **extra):
+    start = g.pop('_render_start', None)
+    if start is not None:
+        g._template_time = g.get('_template_time', 0.0) + perf_counter() - start
+
+
+def _start_request():
+    g._access_start = perf_counter()
+
+
+def _finish_request(response):
+    start = g.get('_access_start')
+    if start is None:
+        return response
+
+    # Only report the user if Flask-Login already loaded it for this request, asking for current_user here would
+    # run a query on requests that did not need the user at all
+    user = getattr(_request_ctx_stack.top, 'user', None)
+    stats = current_stats()
+    entry = {
+        'ts': datetime.utcnow().isoformat() + 'Z',
+        'method': request.method,
+        'path': request.path,
+        'endpoint': request.endpoint,
+        'status': response.status_code,
+        'user_id': user.id if user is not None and user.is_authenticated else None,
+        'latency_ms': round((perf_counter() - start) * 1000, 3),
+        'db_ms': round(stats.time * 1000, 3) if stats is not None else None,
+        'db_queries': stats.count if stats is not None else None,
+        'template_ms': round(g.get('_template_time', 0.0) * 1000, 3),
+        'cache_hits': g.get('_cache_hits', 0),
+        'cache_misses': g.get('_cache_misses', 0),
+        # Streamed responses do not know their size yet
+        'bytes': response.content_length if not response.is_streamed else None,
+    }
+    logger.info(json.dumps(entry, separators=(',', ':')))
+    return response
+
+
+# A MemoryHandler that also flushes when its oldest buffered line is more than max_delay seconds old. The age is
+# checked when a line arrives and by a timer thread, so the last lines before traffic stops still reach the file
+# within max_delay instead of waiting in memory for the next request. The thread is started with the first line, in
+# the process that writes it (threads do not survive the fork of a worker).
+class _TimedMemoryHandler(MemoryHandler):
+    def __init__(self, capacity, target, max_delay=1.0):
+        super(_TimedMemoryHandler, self).__init__(capacity, flushLevel=logging.CRITICAL, target=target)
+        self.max_delay = max_delay
+        self.first = None
+        self.closed = threading.Event()
+        self.timer = None
+        self.pid = None
+
+    def shouldFlush(self, record):
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.timer = threading.Thread(target=self._flush_when_old, name='access-log-flush', daemon=True)
+            self.timer.start()
+        if self.first is None:
+            self.first = time()
+        return super(_TimedMemoryHandler, self).shouldFlush(record) or time() - self.first >= self.max_delay
+
+    def _flush_when_old(self):
+        while not self.closed.wait(self.max_delay / 2):
+            first = self.first
+            if first is not None and time() - first >= self.max_delay:
+                self.flush()
+
+    def flush(self):
+        self.acquire()
+        try:
+            super(_TimedMemoryHandler, self).flush()
+            self.first = None
+        finally:
+            self.release()
+
+    def close(self):
+        self.closed.set()
+        super(_TimedMemoryHandler, self).close()
+
+
+def init_app(app):
+    path = app.config['ACCESS_LOG_PATH']
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+
+    # The access log is its own logger, its lines must not end up in microblog.log or in the error emails
+    if not logger.handlers:
+        file_handler = RotatingFileHandler(path, maxBytes=app.config['ACCESS_LOG_MAX_BYTES'],
+                                           backupCount=app.config['ACCESS_LOG_BACKUP_COUNT'])
+        file_handler.setFormatter(logging.Formatter('%(message)s'))
+        attach_queued_handlers(logger, [_TimedMemoryHandler(app.config['ACCESS_LOG_BUFFER'], file_handler)])
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_rendered, app)
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+
+
+# ------------------------------------------------ ANALYSIS ------------------------------------------------------
+#
+# Percentiles are computed with a histogram of logarithmic buckets (each bucket is 5% wider than the previous one),
+# so the memory used does not depend on the number of lines: the files are streamed line by line and each line only
+# increments one counter. The percentiles that come out are accurate to within the width of a bucket (5%).
+
+class LatencyHistogram(object):
+    GROWTH = 1.05
+    MIN_MS = 0.1
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.max = 0.0
+        self.errors = 0
+
+    def add(self, ms, status):
+        index = 0 if ms <= self.MIN_MS else int(math.log(ms / self.MIN_MS, self.GROWTH)) + 1
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.max = max(self.max, ms)
+        if status >= 500:
+            self.errors += 1
+
+    def percentile(self, p):
+        rank = max(int(math.ceil(p / 100.0 * self.count)), 1)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                # Upper bound of the bucket, never above the largest value that was actually seen
+                return min(self.MIN_MS * self.GROWTH ** index, self.max)
+        return self.max
+
+
+def _open(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt')
+    return open(path)
+
+
+def stats(paths):
+    histograms = {}
+    skipped = 0
+    for path in paths:
+        with _open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    endpoint = entry['endpoint'] or 'unknown'
+                    histogram = histograms.get(endpoint)
+                    if histogram is None:
+                        histogram = histograms[endpoint] = LatencyHistogram()
+                    histogram.add(entry['latency_ms'], entry['status'])
+                except (ValueError, KeyError, TypeError):
+                    skipped += 1
+    return histograms, skipped
@@ -0,0 +1,49 @@
+from functools import wraps
+from flask import g, request
+from app.api.errors import error_response
+from app.models import User
+
+
+# ------------------------------------------------- API AUTHENTICATION -------------------------------------------
+#
+# The API does not use the session cookie of the web application (and therefore does not need the CSRF protection of
+# the web forms). A client exchanges a username and password for a token once, with HTTP Basic authentication:
+#
+#   POST /api/v1/tokens           Authorization: Basic <base64 of username:password>   -->  {"token": "..."}
+#
+# and then sends the token with every request:
+#
+#   GET /api/v1/timeline/home     Authorization: Bearer <token>
+#
+# Checking a token is one indexed lookup of the user table, so polling clients are cheap to authenticate, much
+# cheaper than the password hash check of a login. The authenticated user is in g.current_user.
+# ----------------------------------------------------------------------------------------------------------------
+
+
+def basic_auth_required(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        auth = request.authorization
+        user = User.query.filter_by(username=auth.username).first() if auth and auth.username else None
+        if user is None or not user.check_password(auth.password or ''):
+            response = error_response(401, 'Invalid username or password.')
+            response.headers['WWW-Authenticate'] = 'Basic realm="Authentication Required"'
+            return response
+        g.current_user = user
+        return f(*args, **kwargs)
+    return decorated
+
+
+def token_auth_required(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        header = request.headers.get('Authorization', '')
+        scheme, _, token = header.partition(' ')
+        user = User.check_token(token.strip()) if scheme.lower() == 'bearer' and token else None
+        if user is None:
+            response = error_response(401, 'Missing, invalid or expired token.')
+            response.headers['WWW-Authenticate'] = 'Bearer realm="Authentication Required"'
+            return response
+        g.current_user = user
+        return f(*args, **kwargs)
+    return decorated
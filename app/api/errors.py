@@ -0,0 +1,19 @@
+from flask import jsonify
+from werkzeug.http import HTTP_STATUS_CODES
+
+
+# The API always answers with JSON, errors included: {"error": "Not Found", "message": "..."} with the status code of
+# the error, so that clients never have to parse the HTML error pages of the web application. The errors raised
+# outside of the API views (unknown URL, wrong method, uncaught exception) go through the application's error
+# handlers, which use this function for the URLs under /api/ (see app/errors/handlers.py).
+def error_response(status_code, message=None):
+    payload = {'error': HTTP_STATUS_CODES.get(status_code, 'Unknown error')}
+    if message:
+        payload['message'] = message
+    response = jsonify(payload)
+    response.status_code = status_code
+    return response
+
+
+def bad_request(message):
+    return error_response(400, message)
@@ -0,0 +1,99 @@
+from flask import current_app, g, jsonify, request
+from sqlalchemy import or_, select
+from app import db
+from app.api import bp
+from app.api.auth import token_auth_required
+from app.api.errors import bad_request, error_response
+from app.models import Post, User, followers
+
+
+# ------------------------------------------------- TIMELINES API ------------------------------------------------
+#
+#   GET /api/v1/timeline/home               the posts of the users the token's user follows, and its own
+#   GET /api/v1/timeline/explore            the posts of everyone
+#   GET /api/v1/users/<username>/posts      the posts of one user
+#
+# The posts come newest first, in id order, count (default API_PAGE_SIZE, at most API_MAX_PAGE_SIZE) at a time, and
+# the position in the timeline is given with ids rather than page numbers, which stays correct while new posts keep
+# arriving at the top:
+#
+#   since_id  -->  only posts with an id greater than since_id: a client polls with the newest_id of its previous
+#                  response and only gets what is new (usually nothing, which is one index lookup). These are the
+#                  count OLDEST posts after since_id (still sent newest first), so that nothing is skipped when more
+#                  than count posts arrived: a response with count posts may not be the end, and the client polls
+#                  again right away with its newest_id until it gets fewer
+#   max_id    -->  only posts with an id up to max_id: to go back in time, pass the next_max_id of the previous
+#                  response (it is null when there is nothing older, and always null with since_id)
+#
+# The rows are read with a Core select() of just the columns that are sent (the author comes from a join in the same
+# query) and turned into dicts directly, without building Post and User objects, so the cost of a response is
+# the query plus the JSON encoding.
+# ----------------------------------------------------------------------------------------------------------------
+
+post = Post.__table__
+user = User.__table__
+
+
+def _id_argument(name):
+    value = request.args.get(name)
+    if value is None:
+        return None
+    if not value.isdigit():
+        raise ValueError('{} must be a positive integer'.format(name))
+    return int(value)
+
+
+def _timeline(condition):
+    try:
+        since_id = _id_argument('since_id')
+        max_id = _id_argument('max_id')
+        count = _id_argument('count') or current_app.config['API_PAGE_SIZE']
+    except ValueError as e:
+        return bad_request(str(e))
+    count = min(count, current_app.config['API_MAX_PAGE_SIZE'])
+
+    query = select([post.c.id, post.c.body, post.c.timestamp, post.c.language, user.c.id, user.c.username]) \
+        .select_from(post.join(user, user.c.id == post.c.user_id))
+    if condition is not None:
+        query = query.where(condition)
+    if since_id is not None:
+        query = query.where(post.c.id > since_id)
+    if max_id is not None:
+        query = query.where(post.c.id <= max_id)
+    if since_id is not None:
+        rows = db.session.execute(query.order_by(post.c.id).limit(count)).fetchall()[::-1]
+    else:
+        rows = db.session.execute(query.order_by(post.c.id.desc()).limit(count)).fetchall()
+
+    posts = [{'id': post_id,
+              'body': body,
+              'timestamp': timestamp.isoformat() + 'Z',
+              'language': language or None,
+              'author': {'id': author_id, 'username': username}}
+             for post_id, body, timestamp, language, author_id, username in rows]
+    return jsonify({'posts': posts,
+                    'newest_id': posts[0]['id'] if posts else since_id,
+                    'next_max_id': posts[-1]['id'] - 1
+                    if since_id is None and len(posts) == count and posts[-1]['id'] > 1 else None})
+
+
+@bp.route('/timeline/home', methods=['GET'])
+@token_auth_required
+def home_timeline():
+    followed = select([followers.c.followed_id]).where(followers.c.follower_id == g.current_user.id)
+    return _timeline(or_(post.c.user_id.in_(followed), post.c.user_id == g.current_user.id))
+
+
+@bp.route('/timeline/explore', methods=['GET'])
+@token_auth_required
+def explore_timeline():
+    return _timeline(None)
+
+
+@bp.route('/users/<username>/posts', methods=['GET'])
+@token_auth_required
+def user_timeline(username):
+    user_id = db.session.query(User.id).filter_by(username=username).scalar()
+    if user_id is None:
+        return error_response(404, 'User {} not found.'.format(username))
+    return _timeline(post.c.user_id == user_id)
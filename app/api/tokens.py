@@ -0,0 +1,23 @@
+from flask import current_app, g, jsonify
+from app import db
+from app.api import bp
+from app.api.auth import basic_auth_required, token_auth_required
+
+
+# Exchanges a username and password (HTTP Basic) for a token, the same token is returned until it gets close to its
+# expiration
+@bp.route('/tokens', methods=['POST'])
+@basic_auth_required
+def get_token():
+    token = g.current_user.get_token(current_app.config['API_TOKEN_EXPIRATION'])
+    db.session.commit()
+    return jsonify({'token': token, 'expiration': g.current_user.token_expiration.isoformat() + 'Z'})
+
+
+# Revokes the token used to make the request
+@bp.route('/tokens', methods=['DELETE'])
+@token_auth_required
+def revoke_token():
+    g.current_user.revoke_token()
+    db.session.commit()
+    return '', 204
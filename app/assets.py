@@ -0,0 +1,155 @@
+import gzip
+import hashlib
+import io
+import json
+import mimetypes
+import os
+import shutil
+from flask import current_app, request, send_file
+from flask.helpers import safe_join
+from werkzeug.exceptions import NotFound
+
+# brotli is optional: without it the build only writes the gzip variants
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# ------------------------------------------- FINGERPRINTED ASSETS -----------------------------------------------
+#
+# The files in app/static used to be served under their plain names (css/main.css, loading.gif), so the browsers
+# could not cache them for long and revalidated them on every page.
+#
+# "flask assets build" copies every static file to app/static/dist under a name that contains a hash of its content
+# (css/main.css --> dist/css/main.3f2a9c1b.css) and writes a manifest.json with the original --> hashed names. The
+# text files also get precompressed variants next to them (main.3f2a9c1b.css.gz, and .br when brotli is installed),
+# so nothing is compressed while serving.
+#
+# When the manifest exists, url_for('static', filename='css/main.css') resolves to the hashed name, so the templates
+# do not change. The hashed files are served by serve() below instead of the normal static view:
+#
+#   - with Cache-Control: public, max-age=<one year>, immutable  -->  a hashed name never changes content, so the
+#     browser never has to revalidate it, a new build simply produces new names
+#   - with the smallest precompressed variant the client accepts (Content-Encoding: br or gzip)
+#   - with send_file(), which hands the file to the server's wsgi.file_wrapper (gunicorn uses sendfile(2) for it, a
+#     zero-copy transfer from the page cache to the socket), or with an X-Sendfile header when USE_X_SENDFILE is set
+#     and nginx/apache serve the file themselves
+#
+# Files of older builds are left in dist, so pages rendered before a deploy can still load their assets.
+# ----------------------------------------------------------------------------------------------------------------
+
+DIST = 'dist'
+MANIFEST = 'manifest.json'
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+# Only text formats are worth compressing, images such as loading.gif already are
+COMPRESSIBLE = ('.css', '.js', '.svg', '.html', '.txt', '.json', '.xml', '.map')
+
+
+def _fingerprint(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:8]
+
+
+def _compress(path, data):
+    written = []
+    # mtime=0 makes the .gz output reproducible, two builds of the same file give the same bytes
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=9, mtime=0) as f:
+        f.write(data)
+    gz = buffer.getvalue()
+    if len(gz) < len(data):
+        with open(path + '.gz', 'wb') as f:
+            f.write(gz)
+        written.append(path + '.gz')
+    if brotli is not None:
+        br = brotli.compress(data, quality=11)
+        if len(br) < len(data):
+            with open(path + '.br', 'wb') as f:
+                f.write(br)
+            written.append(path + '.br')
+    return written
+
+
+def build(static_folder):
+    dist = os.path.join(static_folder, DIST)
+    manifest = {}
+    for root, dirs, files in os.walk(static_folder):
+        if os.path.abspath(root) == os.path.abspath(static_folder) and DIST in dirs:
+            dirs.remove(DIST)
+        for name in files:
+            source = os.path.join(root, name)
+            relative = os.path.relpath(source, static_folder).replace(os.sep, '/')
+            stem, ext = os.path.splitext(relative)
+            hashed = '{}.{}{}'.format(stem, _fingerprint(source), ext)
+            target = os.path.join(dist, hashed)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            if not os.path.exists(target):
+                shutil.copyfile(source, target)
+                if ext.lower() in COMPRESSIBLE:
+                    with open(source, 'rb') as f:
+                        _compress(target, f.read())
+            manifest[relative] = hashed
+
+    # Written last and atomically, so a running server never reads a manifest that points to missing files
+    tmp = os.path.join(dist, MANIFEST + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp, os.path.join(dist, MANIFEST))
+    return manifest
+
+
+def load_manifest(app):
+    path = os.path.join(app.static_folder, DIST, MANIFEST)
+    try:
+        with open(path) as f:
+            app.extensions['assets'] = json.load(f)
+    except (OSError, ValueError):
+        app.extensions['assets'] = {}
+    return app.extensions['assets']
+
+
+# url_defaults callback: rewrites the filename of url_for('static', ...) to its hashed name in dist
+def _hashed_url(endpoint, values):
+    if endpoint != 'static':
+        return
+    hashed = current_app.extensions.get('assets', {}).get(values.get('filename'))
+    if hashed is not None:
+        values['filename'] = DIST + '/' + hashed
+
+
+def serve(filename):
+    directory = os.path.join(current_app.static_folder, DIST)
+    path = safe_join(directory, filename)
+    if path is None or not os.path.isfile(path):
+        raise NotFound()
+
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    encoding = None
+    # request.accept_encodings is the parsed Accept-Encoding header: the quality of an encoding is 0 when the client
+    # does not list it (or a * that covers it) or refuses it explicitly with q=0
+    for candidate, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if request.accept_encodings[candidate] > 0 and os.path.isfile(path + suffix):
+            path, encoding = path + suffix, candidate
+            break
+
+    response = send_file(path, mimetype=mimetype, conditional=True, cache_timeout=IMMUTABLE_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.max_age = IMMUTABLE_MAX_AGE
+    response.headers['Cache-Control'] += ', immutable'
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    if filename.lower().endswith(COMPRESSIBLE):
+        response.vary.add('Accept-Encoding')
+    return response
+
+
+def init_app(app):
+    load_manifest(app)
+    app.url_defaults(_hashed_url)
+    # More specific than the /static/<path:filename> rule of the static view, so the hashed files are routed here
+    app.add_url_rule(app.static_url_path + '/' + DIST + '/<path:filename>', 'assets', serve)
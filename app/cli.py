@@ -0,0 +1,158 @@
+from time import perf_counter
+import click
+
+
+# Custom commands for the flask command-line interface. The commands are attached to the application instance in
+# the register() function, which is called from microblog.py (the only place where the application exists in the
+# global scope).
+def register(app):
+
+    # flask seed --users 10000 --posts 1000000
+    #
+    # Fills the database with synthetic users, followers and posts for load and scale testing (see app/seed.py)
+    @app.cli.command()
+    @click.option('--users', default=1000, help='Number of users to create.')
+    @click.option('--posts', default=10000, help='Number of posts to create.')
+    @click.option('--follows', default=20, help='Average number of users each user follows.')
+    @click.option('--days', default=90, help='Spread the posts over this many days.')
+    @click.option('--password', default='password', help='Password of every seeded user.')
+    @click.option('--random-seed', type=int, default=None, help='Seed of the random generator (repeatable datasets).')
+    def seed(users, posts, follows, days, password, random_seed):
+        """Generate synthetic users, followers and posts."""
+        from app.seed import seed as run_seed
+
+        start = perf_counter()
+        created_users, edges, created_posts = run_seed(users, posts, follows, days, password, random_seed)
+        click.echo('Created {} users, {} follow relationships and {} posts in {:.1f}s'.format(
+            created_users, edges, created_posts, perf_counter() - start))
+
+    # flask accesslog stats logs/access.log logs/access.log.1 ...
+    #
+    # Streams the access log files line by line and prints the latency percentiles of every endpoint
+    @app.cli.group()
+    def accesslog():
+        """Access log commands."""
+        pass
+
+    @accesslog.command()
+    @click.argument('paths', nargs=-1, type=click.Path(exists=True))
+    def stats(paths):
+        """Per-endpoint latency percentiles from access log files."""
+        from app.access_log import stats as access_stats
+
+        histograms, skipped = access_stats(paths or [app.config['ACCESS_LOG_PATH']])
+        click.echo('{:<28} {:>9} {:>7} {:>9} {:>9} {:>9} {:>9}'.format(
+            'endpoint', 'requests', '5xx', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+        for endpoint, h in sorted(histograms.items(), key=lambda item: -item[1].count):
+            click.echo('{:<28} {:>9} {:>7} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}'.format(
+                endpoint, h.count, h.errors, h.percentile(50), h.percentile(95), h.percentile(99), h.max))
+        if skipped:
+            click.echo('{} lines could not be parsed and were skipped'.format(skipped))
+
+    # flask assets build
+    #
+    # Copies the static files to app/static/dist under content-hashed names, with gzip/brotli variants and a manifest
+    # (see app/assets.py). Run it on every deploy, the running servers pick the new manifest up when they restart
+    @app.cli.group()
+    def assets():
+        """Static assets commands."""
+        pass
+
+    @assets.command()
+    def build():
+        """Fingerprint and precompress the static files."""
+        from app.assets import build as build_assets
+
+        manifest = build_assets(app.static_folder)
+        for name, hashed in sorted(manifest.items()):
+            click.echo('{} -> {}'.format(name, hashed))
+
+    # flask templates compile
+    #
+    # Compiles every template into the shared bytecode cache (TEMPLATE_CACHE_DIR), run it at deploy time so that no
+    # worker has to compile a template while serving a request (see app/templating.py)
+    @app.cli.group()
+    def templates():
+        """Template commands."""
+        pass
+
+    @templates.command()
+    def compile():
+        """Compile all the templates into the bytecode cache."""
+        from app.templating import compile_templates
+
+        start = perf_counter()
+        compiled, errors = compile_templates(app)
+        for name, error in errors:
+            click.echo('{}: {}'.format(name, error), err=True)
+        click.echo('Compiled {} templates in {:.2f}s'.format(len(compiled), perf_counter() - start))
+        if errors:
+            raise SystemExit(1)
+
+    # flask counters reconcile [--fix]
+    #
+    # Recomputes the follower, following and post counters of every user from the tables and reports the users whose
+    # stored counters drifted, --fix also corrects them (see app/counters.py)
+    @app.cli.group()
+    def counters():
+        """User counters commands."""
+        pass
+
+    @counters.command()
+    @click.option('--fix', is_flag=True, help='Correct the counters that drifted.')
+    @click.option('--show', default=10, help='Number of drifted users to list.')
+    def reconcile(fix, show):
+        """Check the denormalized user counters against the tables."""
+        from app.counters import reconcile as run_reconcile
+
+        start = perf_counter()
+        checked, drift = run_reconcile(fix)
+        for user_id, wrong in drift[:show]:
+            click.echo('user {}: {}'.format(user_id, ', '.join(
+                '{} {} (actual {})'.format(name, stored, actual) for name, (stored, actual) in sorted(wrong.items()))))
+        click.echo('Checked {} users in {:.1f}s, {} with drifted counters{}'.format(
+            checked, perf_counter() - start, len(drift), ', fixed' if fix and drift else ''))
+
+    # flask graph stats
+    #
+    # Loads the follow graph into the compact in-memory arrays (see app/graph.py) and prints how long that took, how
+    # much memory it uses and who has the most followers
+    @app.cli.group()
+    def graph():
+        """Social graph commands."""
+        pass
+
+    @graph.command('stats')
+    @click.option('--top', default=5, help='Number of most followed users to list.')
+    def graph_stats(top):
+        """Load the follow graph in memory and print its size."""
+        from app.graph import SocialGraph
+
+        start = perf_counter()
+        social_graph = SocialGraph.load()
+        click.echo('Loaded {} users and {} follow relationships in {:.1f}s, {:.1f} MB of arrays'.format(
+            social_graph.users(), social_graph.edges(), perf_counter() - start, social_graph.nbytes() / 2 ** 20))
+        counts = sorted(((social_graph.followers_count(u), u) for u in range(social_graph.users())), reverse=True)
+        for followers_count, user_id in counts[:top]:
+            click.echo('user {}: {} followers, {} following, {} mutuals'.format(
+                user_id, followers_count, social_graph.following_count(user_id), len(social_graph.mutuals(user_id))))
+
+    # flask suggestions refresh [--full]
+    #
+    # Recomputes the "who to follow" suggestions of the users whose follow graph changed since the last run (of every
+    # user with --full), see app/suggestions.py. Meant to be run periodically, from cron for example
+    @app.cli.group()
+    def suggestions():
+        """Follow suggestions commands."""
+        pass
+
+    @suggestions.command()
+    @click.option('--full', is_flag=True, help='Recompute the suggestions of every user.')
+    def refresh(full):
+        """Refresh the follow suggestions."""
+        from app.suggestions import backend, refresh as run_refresh
+
+        start = perf_counter()
+        users, written = run_refresh(app.config['SUGGESTIONS_PER_USER'], full)
+        click.echo('Refreshed the suggestions of {} users ({} suggestions) in {:.1f}s with {}'.format(
+            users, written, perf_counter() - start, backend()))
@@ -0,0 +1,127 @@
+import zlib
+from werkzeug.http import parse_accept_header
+from werkzeug.wsgi import ClosingIterator
+
+
+# ------------------------------------------ RESPONSE COMPRESSION ------------------------------------------------
+#
+# The feed pages (index.html, user.html, explore) carry the whole Bootstrap base layout and were sent uncompressed.
+# HTML compresses very well (typically 5-10x), so gzipping them trades a little CPU for much less bandwidth, which is
+# what slow and mobile clients are waiting on. See benchmarks/compression.py for the numbers at every level.
+#
+# CompressionMiddleware wraps app.wsgi_app and gzips a response when:
+#
+#   - the client accepts gzip (Accept-Encoding), and the request is not a HEAD request
+#   - the content type is one of COMPRESSION_MIMETYPES (HTML and JSON by default)
+#   - the response is not compressed already (the precompressed static assets carry their own Content-Encoding),
+#     is not a 204/304 and does not ask for Cache-Control: no-transform
+#   - its Content-Length is at least COMPRESSION_MIN_SIZE bytes, small bodies do not win anything
+#
+# Responses with a Content-Length are compressed in one go and get the new length. Streamed responses (no
+# Content-Length, see stream_with_context) are compressed chunk by chunk: every chunk is followed by a zlib
+# SYNC_FLUSH, so the client receives and can render each piece as soon as the application yields it, instead of the
+# compressor holding on to it until its internal buffer is full.
+#
+# When a front-end server (nginx, a CDN) already compresses the responses, set COMPRESSION_DISABLED.
+# ----------------------------------------------------------------------------------------------------------------
+
+
+class CompressionMiddleware(object):
+    def __init__(self, app, level=6, min_size=500, mimetypes=('text/html', 'application/json')):
+        self.app = app
+        self.level = level
+        self.min_size = min_size
+        self.mimetypes = set(mimetypes)
+
+    def __call__(self, environ, start_response):
+        if environ['REQUEST_METHOD'] == 'HEAD' or \
+                not parse_accept_header(environ.get('HTTP_ACCEPT_ENCODING', ''))['gzip']:
+            return self.app(environ, start_response)
+
+        captured = []
+        written = []
+
+        # The real start_response is delayed until it is known whether (and how) the body will be compressed. The
+        # application may also use the legacy write() callable, what it writes is kept and sent before the body.
+        def capture(status, headers, exc_info=None):
+            captured[:] = [status, headers, exc_info]
+            return written.append
+
+        app_iter = self.app(environ, capture)
+        status, headers, exc_info = captured
+        length = self._compressible_length(status, headers)
+        if length is False:
+            start_response(status, headers, exc_info)
+            if written:
+                return ClosingIterator(written + list(app_iter), getattr(app_iter, 'close', None))
+            return app_iter
+
+        headers = [(k, v) for k, v in headers if k.lower() != 'content-length']
+        headers.append(('Content-Encoding', 'gzip'))
+        self._add_vary(headers)
+        self._weaken_etag(headers)
+
+        if length is None:
+            start_response(status, headers, exc_info)
+            return ClosingIterator(self._stream(written, app_iter), getattr(app_iter, 'close', None))
+
+        try:
+            compressor = self._compressor()
+            body = compressor.compress(b''.join(written) + b''.join(app_iter)) + compressor.flush()
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+        headers.append(('Content-Length', str(len(body))))
+        start_response(status, headers, exc_info)
+        return [body]
+
+    def _compressor(self):
+        # wbits = 16 + MAX_WBITS writes the gzip header and trailer around the deflate stream
+        return zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def _stream(self, written, app_iter):
+        compressor = self._compressor()
+        for chunk in written:
+            yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        for chunk in app_iter:
+            if chunk:
+                yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+
+    # Returns False when the response must be sent as is, None when it is streamed (its length is unknown) and its
+    # Content-Length otherwise
+    def _compressible_length(self, status, headers):
+        code = int(status.split(None, 1)[0])
+        if code < 200 or code in (204, 304):
+            return False
+        values = {k.lower(): v for k, v in headers}
+        if 'content-encoding' in values or 'no-transform' in values.get('cache-control', ''):
+            return False
+        if values.get('content-type', '').split(';')[0].strip().lower() not in self.mimetypes:
+            return False
+        if 'content-length' not in values:
+            return None
+        length = int(values['content-length'])
+        return length if length >= self.min_size else False
+
+    @staticmethod
+    def _add_vary(headers):
+        for i, (key, value) in enumerate(headers):
+            if key.lower() == 'vary':
+                if 'accept-encoding' not in value.lower():
+                    headers[i] = (key, value + ', Accept-Encoding')
+                return
+        headers.append(('Vary', 'Accept-Encoding'))
+
+    # The compressed body is a different representation of the resource, so a strong ETag must not be reused for it
+    @staticmethod
+    def _weaken_etag(headers):
+        for i, (key, value) in enumerate(headers):
+            if key.lower() == 'etag' and not value.startswith('W/'):
+                headers[i] = (key, 'W/' + value)
+
+
+def init_app(app):
+    app.wsgi_app = CompressionMiddleware(app.wsgi_app, level=app.config['COMPRESSION_LEVEL'],
+                                         min_size=app.config['COMPRESSION_MIN_SIZE'],
+                                         mimetypes=app.config['COMPRESSION_MIMETYPES'])
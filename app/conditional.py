@@ -0,0 +1,72 @@
+from hashlib import sha1
+from time import time
+from flask import current_app, g, make_response, request, session
+from flask_login import current_user
+from app import db
+from app.metrics import record_cache
+from app.models import Post
+
+
+# ----------------------------------------------- CONDITIONAL GET ------------------------------------------------
+#
+# Refreshing the explore page or a user page used to run every query and render the whole template again, even
+# when nothing had changed since the last time the browser got it. These pages now carry an ETag, and when the
+# browser sends it back (If-None-Match) and it still matches, the view answers 304 Not Modified with an empty body.
+#
+# The ETag is a hash of a few cheap validators that are checked BEFORE the heavy queries and the rendering:
+#
+#   explore     -->  newest post id (an index lookup), page number
+#   user page   -->  newest post id of that user (an index lookup), the profile fields shown on the page, the user's
+#                    graph_version (changes with every follow/unfollow from or to that user), page number
+#
+# plus, for every page, what the page shows about the viewer: viewer id, username and graph_version (the
+# follow/unfollow link on the user pages), the locale, and a time bucket of CONDITIONAL_GET_MAX_STALENESS seconds.
+# The bucket bounds the staleness of what the validators do not cover, such as another author changing their
+# username or avatar: after at most that many seconds the ETag changes anyway.
+#
+# A page with flashed messages waiting is never answered with 304, the messages have to be shown.
+# ----------------------------------------------------------------------------------------------------------------
+
+
+def newest_post_id(user=None):
+    query = db.session.query(db.func.max(Post.id))
+    if user is not None:
+        query = query.filter(Post.user_id == user.id)
+    return query.scalar()
+
+
+# Returns the ETag of the current page built from the given validators, or None when the page must not be cached
+def page_etag(*validators):
+    if not current_app.config['CONDITIONAL_GET_ENABLED'] or session.get('_flashes'):
+        return None
+    bucket = int(time() // current_app.config['CONDITIONAL_GET_MAX_STALENESS'])
+    key = validators + (current_user.id, current_user.username, current_user.graph_version, g.get('locale'), bucket)
+    return sha1(repr(key).encode('utf-8')).hexdigest()
+
+
+# The 304 response when the browser already has the page, None when the page has to be rendered
+def not_modified(etag):
+    if etag is None or not request.if_none_match:
+        return None
+    # Weak comparison, the compression middleware turns the ETag of compressed responses into a weak one
+    hit = request.if_none_match.contains_weak(etag)
+    record_cache('conditional_get', hit)
+    if hit:
+        return _add_validators(make_response('', 304), etag)
+    return None
+
+
+# Attaches the ETag to a rendered page (a string or a response, such as the streamed ones)
+def with_etag(rv, etag):
+    response = make_response(rv)
+    if etag is not None:
+        _add_validators(response, etag)
+    return response
+
+
+def _add_validators(response, etag):
+    response.set_etag(etag)
+    # The page is personal (private) and must be revalidated every time (no-cache), which is cheap thanks to the ETag
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
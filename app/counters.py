@@ -0,0 +1,60 @@
+from sqlalchemy import bindparam
+from app import db
+from app.models import User, Post, followers
+
+
+# ---------------------------------------------- USER COUNTERS ---------------------------------------------------
+#
+# The profile page showed "N followers, M following" with two COUNT queries over the followers table, which for a
+# popular user means counting hundreds of thousands of rows on every visit. The counts are now stored in the user
+# row (followers_count, followed_count and posts_count) and kept up to date in the same transaction as the change:
+#
+#   follow() / unfollow()       -->  followed_count of the follower, followers_count of the followed user
+#   index view / group commit   -->  posts_count of the author
+#
+# Anything that writes to the tables without going through that code (a manual fix in the database, a bulk import,
+# a bug) makes the counters drift. reconcile() recomputes all of them with one GROUP BY query per counter, reports
+# the users whose stored values are wrong and, when asked to, corrects them (flask counters reconcile --fix).
+# ----------------------------------------------------------------------------------------------------------------
+
+# Counter column -> (table, column that points to the user) the counter counts the rows of
+COUNTERS = (
+    ('followers_count', followers, followers.c.followed_id),
+    ('followed_count', followers, followers.c.follower_id),
+    ('posts_count', Post.__table__, Post.__table__.c.user_id),
+)
+
+
+def _actual_counts(table, user_column):
+    rows = db.session.query(user_column, db.func.count()).select_from(table).group_by(user_column)
+    return dict(rows)
+
+
+# Returns the number of users checked and a list of (user_id, {counter: (stored, actual)}) for the users that have at
+# least one wrong counter. With fix=True the wrong counters are corrected and committed.
+def reconcile(fix=False):
+    actual = {name: _actual_counts(table, column) for name, table, column in COUNTERS}
+    names = [name for name, _, _ in COUNTERS]
+    stored = db.session.query(User.id, *[getattr(User, name) for name in names])
+
+    checked = 0
+    drift = []
+    for row in stored:
+        checked += 1
+        wrong = {}
+        for name, value in zip(names, row[1:]):
+            expected = actual[name].get(row[0], 0)
+            if value != expected:
+                wrong[name] = (value, expected)
+        if wrong:
+            drift.append((row[0], wrong))
+
+    if fix and drift:
+        # One UPDATE per user that drifted, with all its counters, sent as a single executemany
+        update = User.__table__.update().where(User.id == bindparam('user_id')).values(
+            {name: bindparam('new_' + name) for name in names})
+        db.session.execute(update, [dict({'user_id': user_id},
+                                         **{'new_' + name: actual[name].get(user_id, 0) for name in names})
+                                    for user_id, _ in drift])
+        db.session.commit()
+    return checked, drift
@@ -2,11 +2,15 @@ from threading import Thread
 from flask import current_app
 from flask_mail import Message
 from app import mail
+from app.metrics import email_queued, email_sent
 
 
 def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+    try:
+        with app.app_context():
+            mail.send(msg)
+    finally:
+        email_sent()
 
 
 # ----------------------------------------- Helper FN that sends an email -------------------------------------------
@@ -28,6 +32,7 @@ def send_email(subject, sender, recipients, text_body, html_body):
 
     # The current_app._get_current_object() expression extracts the actual application instance from inside the proxy
     #  object, so that is what I passed to the thread as an argument.
+    email_queued()
     Thread(target=send_async_email, args=(current_app._get_current_object(), msg)).start()
 
 # -------------------------------------------------------------------------------------------------------------------
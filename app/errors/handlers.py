@@ -1,5 +1,7 @@
-from flask import render_template
+from flask import render_template, request
+from werkzeug.exceptions import HTTPException
 from app import db
+from app.api.errors import error_response
 from app.errors import bp
 
 # Flask provides a mechanism for an application to install its own error pages, so that your users don't have to see
@@ -15,9 +17,18 @@ from app.errors import bp
 # pages, so I want the status code of the response to reflect that.
 
 
+# The API (app/api) answers with JSON even for the errors that happen before one of its views runs (an unknown URL, a
+# method it does not accept) and for the errors of the application itself, so these handlers answer with the JSON
+# error of the API instead of the HTML page for any URL under /api/
+def wants_json_response():
+    return request.path.startswith('/api/')
+
+
 # Error function for 404 error
 @bp.app_errorhandler(404)
 def not_found_error(error):
+    if wants_json_response():
+        return error_response(404)
     return render_template('errors/404.html'), 404
 
 
@@ -25,4 +36,15 @@ def not_found_error(error):
 @bp.app_errorhandler(500)
 def internal_error(error):
     db.session.rollback()
+    if wants_json_response():
+        return error_response(500)
     return render_template('errors/500.html'), 500
+
+
+# The other HTTP errors (405, 413...) keep Werkzeug's default page, except in the API. Flask 1.0 also sends the
+# routing redirects (a missing trailing slash) through here, those stay redirects.
+@bp.app_errorhandler(HTTPException)
+def http_error(error):
+    if wants_json_response() and error.code >= 400:
+        return error_response(error.code)
+    return error
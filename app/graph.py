@@ -0,0 +1,283 @@
+import threading
+from array import array
+from bisect import bisect_left
+from time import monotonic
+from flask import current_app
+from sqlalchemy import select
+from app import db
+from app.models import followers
+
+
+# ------------------------------------------------ SOCIAL GRAPH --------------------------------------------------
+#
+# Every question about the follow graph (does A follow B, who follows B, who do A and B both follow) is a query on
+# the followers table through the User.followed / User.followers dynamic relationships. With GRAPH_ENABLED every
+# worker also keeps the whole graph in memory, in the compressed sparse row (CSR) layout, once per direction:
+#
+#   offsets  -->  array of len(users) + 1 integers, the edges of user u are targets[offsets[u]:offsets[u + 1]]
+#   targets  -->  array of 32-bit user ids, the edges of every user one after the other, each run sorted
+#
+#   following:  u -> the users u follows        followers:  u -> the users following u
+#
+# That is 4 bytes per edge per direction plus 8 bytes per user, so 10 million edges take about 80 MB, instead of the
+# gigabytes a dict of sets of Python ints would take. "Does A follow B" is a binary search in A's run, degrees are a
+# subtraction, and the lists are slices.
+#
+# The arrays are immutable. Follows and unfollows made by this worker are applied on top of them as small overlays
+# (per user frozensets of added and removed edges, replaced rather than modified so that readers never need a lock),
+# and the graph is reloaded from the database every GRAPH_RELOAD_INTERVAL seconds, or as soon as the overlays hold
+# GRAPH_MAX_DELTA edges, on a background thread while the old graph keeps answering. The reload folds the overlays
+# into new arrays and picks up the changes made by the other workers, which this worker does not see before that.
+# The graph is therefore only used where a slightly stale answer is fine, never for the Follow/Un-Follow decisions,
+# which keep asking the database. Today that is the "follows you" marks of the follower and following lists (see
+# _follow_list() in app/main/routes.py): the graph is loaded by the first list a worker shows.
+#
+# "flask suggestions refresh" (app/suggestions.py) and "flask graph stats" run in their own process, they load a
+# SocialGraph of their own rather than going through the service.
+# ----------------------------------------------------------------------------------------------------------------
+
+LOAD_CHUNK = 50000
+
+_EMPTY = frozenset()
+
+
+# Groups (key, value) pairs by key with a counting sort, in two passes over the pairs. The sort is stable, so when
+# the pairs come sorted by value every run of the result is sorted too.
+def _csr(keys, values, size):
+    offsets = array('q', bytes(8 * (size + 1)))
+    for key in keys:
+        offsets[key + 1] += 1
+    for i in range(size):
+        offsets[i + 1] += offsets[i]
+    position = array('q', offsets)
+    targets = array('i', bytes(4 * len(values)))
+    for key, value in zip(keys, values):
+        targets[position[key]] = value
+        position[key] += 1
+    return _Adjacency(offsets, targets)
+
+
+class _Adjacency(object):
+    __slots__ = ('offsets', 'targets')
+
+    def __init__(self, offsets, targets):
+        self.offsets = offsets
+        self.targets = targets
+
+    def bounds(self, node):
+        if node + 1 >= len(self.offsets):
+            return 0, 0
+        return self.offsets[node], self.offsets[node + 1]
+
+    def row(self, node):
+        lo, hi = self.bounds(node)
+        return self.targets[lo:hi]
+
+    def contains(self, node, target):
+        lo, hi = self.bounds(node)
+        i = bisect_left(self.targets, target, lo, hi)
+        return i < hi and self.targets[i] == target
+
+    def degree(self, node):
+        lo, hi = self.bounds(node)
+        return hi - lo
+
+    def nbytes(self):
+        return self.offsets.itemsize * len(self.offsets) + self.targets.itemsize * len(self.targets)
+
+
+class SocialGraph(object):
+    def __init__(self, following, followers_of):
+        self._following = following
+        self._followers = followers_of
+        # user id -> frozenset of user ids, the changes made since the arrays were built
+        self._added = ({}, {})
+        self._removed = ({}, {})
+        self.delta = 0
+        self.lock = threading.Lock()
+
+    # Loads the followers table ordered by (follower_id, followed_id), in chunks so that the rows never all exist as
+    # Python tuples at the same time
+    @classmethod
+    def load(cls):
+        sources = array('i')
+        destinations = array('i')
+        query = select([followers.c.follower_id, followers.c.followed_id]) \
+            .order_by(followers.c.follower_id, followers.c.followed_id)
+        result = db.session.execute(query.execution_options(stream_results=True))
+        while True:
+            rows = result.fetchmany(LOAD_CHUNK)
+            if not rows:
+                break
+            for follower_id, followed_id in rows:
+                sources.append(follower_id)
+                destinations.append(followed_id)
+        size = max(max(sources, default=0), max(destinations, default=0)) + 1
+        # The rows are sorted by follower, so grouping them by followed gives runs sorted by follower
+        return cls(_csr(sources, destinations, size), _csr(destinations, sources, size))
+
+    # --- changes ---
+
+    def _change(self, direction, node, target, add):
+        added, removed = self._added[direction], self._removed[direction]
+        if add:
+            removed[node] = removed.get(node, _EMPTY) - {target}
+            added[node] = added.get(node, _EMPTY) | {target}
+        else:
+            added[node] = added.get(node, _EMPTY) - {target}
+            removed[node] = removed.get(node, _EMPTY) | {target}
+
+    def follow(self, follower_id, followed_id):
+        with self.lock:
+            self._change(0, follower_id, followed_id, True)
+            self._change(1, followed_id, follower_id, True)
+            self.delta += 1
+
+    def unfollow(self, follower_id, followed_id):
+        with self.lock:
+            self._change(0, follower_id, followed_id, False)
+            self._change(1, followed_id, follower_id, False)
+            self.delta += 1
+
+    # --- queries ---
+
+    def _contains(self, direction, adjacency, node, target):
+        if target in self._removed[direction].get(node, _EMPTY):
+            return False
+        return target in self._added[direction].get(node, _EMPTY) or adjacency.contains(node, target)
+
+    def _row(self, direction, adjacency, node):
+        row = adjacency.row(node)
+        added = self._added[direction].get(node, _EMPTY)
+        removed = self._removed[direction].get(node, _EMPTY)
+        if not added and not removed:
+            return list(row)
+        return sorted(set(user_id for user_id in row if user_id not in removed) | added)
+
+    def _degree(self, direction, adjacency, node):
+        if node not in self._added[direction] and node not in self._removed[direction]:
+            return adjacency.degree(node)
+        return len(self._row(direction, adjacency, node))
+
+    def is_following(self, follower_id, followed_id):
+        return self._contains(0, self._following, follower_id, followed_id)
+
+    # The ids of the users that user_id follows, sorted
+    def following(self, user_id):
+        return self._row(0, self._following, user_id)
+
+    # The ids of the users that follow user_id, sorted
+    def followers(self, user_id):
+        return self._row(1, self._followers, user_id)
+
+    def following_count(self, user_id):
+        return self._degree(0, self._following, user_id)
+
+    def followers_count(self, user_id):
+        return self._degree(1, self._followers, user_id)
+
+    # The users that user_id follows and that follow user_id back. The shorter of the two lists is walked and every
+    # user in it is looked up in the other direction with a binary search.
+    def mutuals(self, user_id):
+        if self.following_count(user_id) <= self.followers_count(user_id):
+            return [other for other in self.following(user_id) if self.is_following(other, user_id)]
+        return [other for other in self.followers(user_id) if self.is_following(user_id, other)]
+
+    # The offsets and targets arrays of the following direction, as loaded (without the overlays), for code that
+    # works on the whole graph at once (see app/suggestions.py)
+    def following_arrays(self):
+        return self._following.offsets, self._following.targets
+
+    # --- size ---
+
+    def users(self):
+        return len(self._following.offsets) - 1
+
+    def edges(self):
+        return len(self._following.targets)
+
+    def nbytes(self):
+        return self._following.nbytes() + self._followers.nbytes()
+
+
+# Holds the graph of the worker and reloads it in the background when it gets too old or too far from its arrays
+class GraphService(object):
+    def __init__(self, app):
+        self.app = app
+        self.reload_interval = app.config['GRAPH_RELOAD_INTERVAL']
+        self.max_delta = app.config['GRAPH_MAX_DELTA']
+        self.graph = None
+        self.loaded_at = 0.0
+        self.lock = threading.Lock()
+        self.reloading = False
+        # Changes made while a reload runs, replayed on the new graph (the reload may have read the table before them)
+        self.journal = []
+
+    def get(self):
+        graph = self.graph
+        if graph is None:
+            with self.lock:
+                if self.graph is None:
+                    self.graph = SocialGraph.load()
+                    self.loaded_at = monotonic()
+                return self.graph
+        if monotonic() - self.loaded_at > self.reload_interval or graph.delta >= self.max_delta:
+            self._start_reload()
+        return graph
+
+    def _start_reload(self):
+        with self.lock:
+            if self.reloading:
+                return
+            self.reloading = True
+            self.journal = []
+        threading.Thread(target=self._reload, name='graph-reload', daemon=True).start()
+
+    def _reload(self):
+        try:
+            with self.app.app_context():
+                graph = SocialGraph.load()
+                db.session.remove()
+            with self.lock:
+                for follow, follower_id, followed_id in self.journal:
+                    (graph.follow if follow else graph.unfollow)(follower_id, followed_id)
+                self.graph = graph
+                self.loaded_at = monotonic()
+        except Exception:
+            self.app.logger.exception('Social graph reload failed')
+            # Keep the old graph, and do not try again before the next interval
+            self.loaded_at = monotonic()
+        finally:
+            with self.lock:
+                self.reloading = False
+                self.journal = []
+
+    def changed(self, follow, follower_id, followed_id):
+        with self.lock:
+            if self.graph is not None:
+                (self.graph.follow if follow else self.graph.unfollow)(follower_id, followed_id)
+            if self.reloading:
+                self.journal.append((follow, follower_id, followed_id))
+
+
+# Returns the graph of this worker, or None when GRAPH_ENABLED is not set
+def get():
+    service = current_app.extensions.get('graph')
+    return service.get() if service is not None else None
+
+
+# Called after a follow or an unfollow is committed, they do nothing when the graph is not enabled
+def followed(follower_id, followed_id):
+    service = current_app.extensions.get('graph')
+    if service is not None:
+        service.changed(True, follower_id, followed_id)
+
+
+def unfollowed(follower_id, followed_id):
+    service = current_app.extensions.get('graph')
+    if service is not None:
+        service.changed(False, follower_id, followed_id)
+
+
+def init_app(app):
+    app.extensions['graph'] = GraphService(app)
@@ -0,0 +1,158 @@
+import os
+import threading
+from collections import Counter, deque
+from datetime import datetime
+from time import monotonic
+from flask import current_app
+from sqlalchemy import bindparam
+from app import db, live, recent_posts
+from app.models import Post, User
+
+
+# ---------------------------------------------- GROUP COMMIT ----------------------------------------------------
+#
+# Every post submitted from main.index runs its own db.session.commit(), and every commit is one fsync on the database
+# file. Under a burst of submissions the disk, not Python, is what limits how many posts per second we can accept.
+#
+# Group commit is the classic answer to this problem: instead of committing each post on its own, the posts coming
+# from concurrent requests are handed to a single writer thread. The writer waits a few milliseconds
+# (GROUP_COMMIT_WINDOW_MS) to collect whatever else arrives, inserts the whole batch in ONE transaction and only then
+# wakes up the requests that are waiting on it. That way every request is still acknowledged only once its post is
+# durable, but the cost of the fsync is shared by the whole batch.
+#
+# The mode is optional and is switched on with GROUP_COMMIT_ENABLED. When it is off, the index route keeps using the
+# plain session add/commit.
+# ----------------------------------------------------------------------------------------------------------------
+
+
+class GroupCommitError(Exception):
+    pass
+
+
+# One post waiting to be written. The request thread blocks on the done event until the writer has committed (or
+# failed to commit) the batch the post belongs to.
+class _PendingPost(object):
+    __slots__ = ('values', 'done', 'error')
+
+    def __init__(self, values):
+        self.values = values
+        self.done = threading.Event()
+        self.error = None
+
+
+# The writer owns the queue and the background thread for ONE application instance
+class _Writer(object):
+    def __init__(self, app):
+        self.app = app
+        self.window = app.config['GROUP_COMMIT_WINDOW_MS'] / 1000.0
+        self.max_batch = app.config['GROUP_COMMIT_MAX_BATCH']
+        self.queue = deque()
+        self.cond = threading.Condition()
+        self.thread = None
+        self.pid = None
+
+    # The thread is started lazily, on the first submission, so that CLI commands and unit tests that never write a
+    # post do not pay for it. The pid check restarts it in a worker process that was forked after it was started
+    # (threads do not survive a fork).
+    def _ensure_started(self):
+        if self.thread is not None and self.thread.is_alive() and self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.thread = threading.Thread(target=self._run, name='group-commit', daemon=True)
+        self.thread.start()
+
+    def submit(self, values, timeout):
+        pending = _PendingPost(values)
+        with self.cond:
+            self._ensure_started()
+            self.queue.append(pending)
+            self.cond.notify()
+
+        if not pending.done.wait(timeout):
+            # A post that is still queued is taken out, so it is never written and the user can safely submit it again.
+            # One that the writer has already taken is in a transaction right now, and its outcome is waited for:
+            # giving up on it would tell the user it failed while it may well be committed a moment later.
+            with self.cond:
+                try:
+                    self.queue.remove(pending)
+                except ValueError:
+                    pass
+                else:
+                    raise GroupCommitError('Timed out waiting for the post to be committed.')
+            pending.done.wait()
+        if pending.error is not None:
+            raise GroupCommitError('The post could not be committed: {}'.format(pending.error))
+
+    # Wait for the first post, then keep collecting until the window closes or the batch is full
+    def _next_batch(self):
+        with self.cond:
+            while not self.queue:
+                self.cond.wait()
+
+            deadline = monotonic() + self.window
+            while len(self.queue) < self.max_batch:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+
+            count = min(len(self.queue), self.max_batch)
+            return [self.queue.popleft() for _ in range(count)]
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            with self.app.app_context():
+                self.flush(batch)
+
+    # Write the whole batch with a single multi-row INSERT and a single COMMIT, then release the waiting requests
+    def flush(self, batch):
+        try:
+            db.session.execute(Post.__table__.insert(), [pending.values for pending in batch])
+            # The posts counters of the authors are updated in the same transaction, one UPDATE per author
+            per_user = Counter(pending.values['user_id'] for pending in batch)
+            db.session.execute(User.__table__.update()
+                               .where(User.id == bindparam('author_id'))
+                               .values(posts_count=User.posts_count + bindparam('new_posts')),
+                               [{'author_id': user_id, 'new_posts': n} for user_id, n in per_user.items()])
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            self.app.logger.exception('Group commit of %d posts failed', len(batch))
+            for pending in batch:
+                pending.error = e
+        else:
+            # The hooks run before the requests are released, so the redirect after a post already sees it. The batch
+            # is committed by now, so a failing hook is only logged: it must not be reported to the authors as a
+            # failure of posts that were saved, nor keep the other hook from running.
+            for hook in (recent_posts.posts_created, live.posts_created):
+                try:
+                    hook()
+                except Exception:
+                    self.app.logger.exception('%s failed after a group commit', hook.__module__)
+        finally:
+            db.session.remove()
+            for pending in batch:
+                pending.done.set()
+
+
+class GroupCommitter(object):
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('GROUP_COMMIT_ENABLED', False)
+        app.config.setdefault('GROUP_COMMIT_WINDOW_MS', 5)
+        app.config.setdefault('GROUP_COMMIT_MAX_BATCH', 100)
+        app.config.setdefault('GROUP_COMMIT_TIMEOUT', 5)
+        app.extensions['group_commit'] = _Writer(app)
+
+    # Queue a post for the next batch and block until it has been committed. The values are the column values of the
+    # post table, the timestamp is taken here so the post keeps the time it was submitted, not the time it was written
+    def submit_post(self, body, user_id, language):
+        values = {'body': body, 'user_id': user_id, 'language': language, 'timestamp': datetime.utcnow()}
+        current_app.extensions['group_commit'].submit(values, current_app.config['GROUP_COMMIT_TIMEOUT'])
+
+
+group_commit = GroupCommitter()
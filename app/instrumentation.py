@@ -0,0 +1,117 @@
+import re
+from collections import Counter
+from time import perf_counter
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+# ------------------------------------------ PER-REQUEST SQL STATS ----------------------------------------------
+#
+# A page like main.user issues many queries (the user lookup, the paginate count, the paginate items, the post
+# authors, followers.count(), followed.count() and is_following) and until now there was no way to see them.
+#
+# SQLAlchemy fires a before_cursor_execute and an after_cursor_execute event around every statement it sends to the
+# database. Listening to those events on the Engine class means every query of every engine is seen, and while a
+# request is being handled I accumulate, in the g object of that request:
+#
+#   - the number of queries
+#   - the total time spent in the database
+#   - how many times each statement "shape" was executed
+#
+# The shape of a statement is its SQL text with the whitespace collapsed and IN (...) lists reduced to one
+# placeholder. Because the ORM always uses bound parameters, two queries with the same shape are the same query run
+# with different values. When the same shape shows up SQL_N_PLUS_ONE_THRESHOLD times or more in one request, that is
+# almost always an N+1 pattern (a lazy load inside a loop) and a warning is logged.
+#
+# The numbers are exposed as X-DB-Query-Count / X-DB-Time-Ms response headers in debug mode (or when
+# SQL_STATS_HEADERS is set), and written to the application log otherwise.
+# ----------------------------------------------------------------------------------------------------------------
+
+_whitespace = re.compile(r'\s+')
+_in_list = re.compile(r'IN \((\?|%\(\w+\)s|:\w+)(, (\?|%\(\w+\)s|:\w+))*\)')
+
+
+def statement_shape(statement):
+    shape = _whitespace.sub(' ', statement).strip()
+    return _in_list.sub('IN (?)', shape)
+
+
+class QueryStats(object):
+    __slots__ = ('count', 'time', 'shapes')
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+        self.shapes = Counter()
+
+    def record(self, statement, elapsed):
+        self.count += 1
+        self.time += elapsed
+        self.shapes[statement_shape(statement)] += 1
+
+    # Statement shapes that were repeated often enough in this request to look like an N+1 pattern
+    def repeated(self, threshold):
+        return [(shape, n) for shape, n in self.shapes.most_common() if n >= threshold]
+
+
+# Returns the stats of the request being handled, or None when there is no request (CLI commands, background threads)
+def current_stats():
+    if not has_request_context():
+        return None
+    return g.get('_query_stats')
+
+
+# The start time is kept on the execution context of the statement, which only lives as long as the statement: a
+# statement that fails never reaches after_cursor_execute, and its start time simply goes away with the context
+# instead of staying behind on the pooled connection. (Flask-SQLAlchemy's query recording already uses
+# _query_start_time on the context, with another clock, hence the different name.)
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._sql_stats_start = perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = context._sql_stats_start
+    stats = current_stats()
+    if stats is not None:
+        stats.record(statement, perf_counter() - start)
+
+
+def _start_request():
+    g._query_stats = QueryStats()
+
+
+def _finish_request(response):
+    stats = g.get('_query_stats')
+    if stats is None:
+        return response
+
+    for shape, n in stats.repeated(current_app.config['SQL_N_PLUS_ONE_THRESHOLD']):
+        current_app.logger.warning('Possible N+1 query in %s: statement executed %d times: %s',
+                                   request.endpoint, n, shape)
+
+    if current_app.debug or current_app.config['SQL_STATS_HEADERS']:
+        response.headers['X-DB-Query-Count'] = str(stats.count)
+        response.headers['X-DB-Time-Ms'] = '{:.2f}'.format(stats.time * 1000)
+    else:
+        current_app.logger.info('%s %s: %d queries, %.2f ms in the database',
+                                request.method, request.endpoint, stats.count, stats.time * 1000)
+    return response
+
+
+_listening = False
+
+
+def init_app(app):
+    global _listening
+    app.config.setdefault('SQL_N_PLUS_ONE_THRESHOLD', 5)
+    app.config.setdefault('SQL_STATS_HEADERS', False)
+
+    # The engine events are process wide, they only need to be registered once no matter how many apps are created
+    if not _listening:
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        _listening = True
+
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
@@ -0,0 +1,254 @@
+import json
+import os
+import threading
+from collections import deque
+from time import monotonic
+from flask import current_app
+from sqlalchemy import or_, select
+from app import db
+from app.models import Post, User, followers
+
+
+# ---------------------------------------------- LIVE NEW POSTS --------------------------------------------------
+#
+# To see new posts, users kept reloading the home page, and every reload ran the whole followed posts query. With
+# LIVE_ENABLED the home page opens a server-sent events stream (GET /stream, text/event-stream) instead, and the
+# server pushes the new posts of the users it follows as they are created; the page shows "N new posts" and the user
+# reloads when they want to read them.
+#
+# Every worker has one hub:
+#
+#   pump         -->  one background thread that asks the database for the posts newer than the last one it saw
+#                     (a primary key range query) every LIVE_POLL_INTERVAL seconds, or right away when this worker
+#                     commits a post. Posts written by the other workers are found the same way, so nothing needs
+#                     to be shared between them. Every post is encoded as an event ONCE, and the same string is handed
+#                     to all the subscribers that want it
+#   subscribers  -->  one per open stream, indexed by the ids of the users it follows (read once, when the stream is
+#                     opened), so a post only goes to the streams of the author's followers. Each subscriber has a
+#                     bounded queue (a deque with a maxlen of LIVE_QUEUE_SIZE): a client that does not read fast
+#                     enough loses its oldest events, never the memory of the worker, and is told with an "overflow"
+#                     event
+#
+# An idle stream is a generator waiting on an Event, with a ": keepalive" comment every LIVE_HEARTBEAT seconds so that
+# proxies do not close it, and nothing else: no thread, no database connection (the request context, and with it the
+# session, is gone by the time the response is iterated). But with the servers in requirements.txt (the development
+# server, or gunicorn with sync or gthread workers) the response is still iterated by a thread of the worker, so every
+# open stream holds one of its threads for up to LIVE_MAX_AGE. A worker therefore accepts at most LIVE_MAX_STREAMS
+# streams (default 10, keep it well under the number of threads of a worker so that pages are still served); above
+# that the stream is answered with a retry line only, and the browser tries again FULL_RETRY_MS later while the page
+# works as if live posts were off. For thousands of idle streams per worker, install gevent, serve the application
+# with gunicorn -k gevent (which monkey patches threading, so the waits below become cooperative) and raise
+# LIVE_MAX_STREAMS accordingly.
+#
+# Post ids are handed out at insert time but become visible at commit time, so with concurrent writers (several
+# workers, the group committer) a post can show up after a post with a higher id was published. The pump therefore
+# also looks ID_WINDOW ids below the newest id it published, for the ids it has not published yet (the same window
+# as the recent posts buffer, see app/recent_posts.py). A post that becomes visible later than that is not pushed;
+# it is still on the home page at the next reload.
+#
+# A stream is closed after LIVE_MAX_AGE seconds. The browser's EventSource reconnects by itself, sending the id of the
+# last event it got (Last-Event-ID), and the new stream starts with the posts it missed, then uses the follows as
+# they are at that moment.
+# ----------------------------------------------------------------------------------------------------------------
+
+# Posts read by one query of the pump
+PUMP_BATCH = 500
+
+# How far below the newest published id the pump looks for posts committed late
+ID_WINDOW = 100
+
+# Milliseconds the browser waits before reconnecting a stream that was closed
+RETRY_MS = 2000
+
+# Milliseconds the browser waits before trying again when the worker already has LIVE_MAX_STREAMS open streams
+FULL_RETRY_MS = 30000
+
+post = Post.__table__
+user = User.__table__
+
+
+def _posts_query():
+    return select([post.c.id, post.c.body, post.c.timestamp, post.c.language, user.c.id, user.c.username]) \
+        .select_from(post.join(user, user.c.id == post.c.user_id))
+
+
+# Returns (author_id, event) for a row of _posts_query()
+def _event(row):
+    post_id, body, timestamp, language, author_id, username = row
+    data = json.dumps({'id': post_id, 'body': body, 'timestamp': timestamp.isoformat() + 'Z',
+                       'language': language or None, 'author': {'id': author_id, 'username': username}})
+    return author_id, 'id: {}\nevent: post\ndata: {}\n\n'.format(post_id, data)
+
+
+class Subscriber(object):
+    __slots__ = ('authors', 'queue', 'wakeup', 'overflowed', 'closed')
+
+    def __init__(self, authors, size):
+        self.authors = authors
+        self.queue = deque(maxlen=size)
+        self.wakeup = threading.Event()
+        self.overflowed = False
+        self.closed = False
+
+    def push(self, event):
+        if len(self.queue) == self.queue.maxlen:
+            self.overflowed = True
+        self.queue.append(event)
+        self.wakeup.set()
+
+    # Returns the queued events and whether some were dropped since the last call. The Event is cleared BEFORE the
+    # queue is emptied, so an event pushed in between is either returned now or wakes up the next wait.
+    def drain(self):
+        self.wakeup.clear()
+        events = []
+        while True:
+            try:
+                events.append(self.queue.popleft())
+            except IndexError:
+                break
+        overflowed, self.overflowed = self.overflowed, False
+        return events, overflowed
+
+
+class Hub(object):
+    def __init__(self, app):
+        self.app = app
+        self.queue_size = app.config['LIVE_QUEUE_SIZE']
+        self.poll_interval = app.config['LIVE_POLL_INTERVAL']
+        self.heartbeat = app.config['LIVE_HEARTBEAT']
+        self.max_age = app.config['LIVE_MAX_AGE']
+        self.max_streams = app.config['LIVE_MAX_STREAMS']
+        # author id -> set of the subscribers that follow the author
+        self.by_author = {}
+        self.subscribers = 0
+        # Held while a batch of posts is published and last_id moves past it, so a new subscriber sees either all of
+        # the batch or none of it (and then gets it from its backfill)
+        self.lock = threading.Lock()
+        self.last_id = None
+        # The ids published in the window below last_id, which the pump does not read again
+        self.published = set()
+        self.poke = threading.Event()
+        self.thread = None
+        self.pid = None
+
+    # Started by the first subscriber, like the group committer (see app/group_commit.py), and restarted in a worker
+    # forked after it was started. Must be called with the lock held, in an application context.
+    def _ensure_started(self):
+        if self.thread is not None and self.thread.is_alive() and self.pid == os.getpid():
+            return
+        self.last_id = db.session.query(db.func.max(Post.id)).scalar() or 0
+        # The posts that exist when the pump starts count as published, the window is for the ones committed later
+        self.published = {post_id for post_id, in db.session.query(Post.id)
+                          .filter(Post.id > self.last_id - ID_WINDOW)}
+        self.pid = os.getpid()
+        self.thread = threading.Thread(target=self._run, name='live-pump', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            self.poke.wait(self.poll_interval)
+            self.poke.clear()
+            try:
+                with self.app.app_context():
+                    self.pump()
+                    db.session.remove()
+            except Exception:
+                self.app.logger.exception('Live posts pump failed')
+
+    # Publishes the posts created since the last call, and those committed late in the window below the newest one
+    def pump(self):
+        while True:
+            query = _posts_query().where(post.c.id > self.last_id - ID_WINDOW)
+            if self.published:
+                query = query.where(~post.c.id.in_(self.published))
+            rows = db.session.execute(query.order_by(post.c.id).limit(PUMP_BATCH)).fetchall()
+            if not rows:
+                return
+            with self.lock:
+                for row in rows:
+                    # Posts that no open stream follows the author of are not even encoded
+                    if row[4] in self.by_author:
+                        self.publish(*_event(row))
+                    self.published.add(row[0])
+                self.last_id = max(self.last_id, rows[-1][0])
+                self.published = {post_id for post_id in self.published if post_id > self.last_id - ID_WINDOW}
+
+    def publish(self, author_id, event):
+        for subscriber in self.by_author.get(author_id, ()):
+            subscriber.push(event)
+
+    # Returns the new subscriber and the id its stream starts after, or None for the subscriber when the worker already
+    # has max_streams open streams
+    def subscribe(self, authors):
+        subscriber = Subscriber(frozenset(authors), self.queue_size)
+        with self.lock:
+            if self.subscribers >= self.max_streams:
+                return None, self.last_id
+            self._ensure_started()
+            for author_id in subscriber.authors:
+                self.by_author.setdefault(author_id, set()).add(subscriber)
+            self.subscribers += 1
+            return subscriber, self.last_id
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            if subscriber.closed:
+                return
+            subscriber.closed = True
+            for author_id in subscriber.authors:
+                subscribers = self.by_author.get(author_id)
+                if subscribers is not None:
+                    subscribers.discard(subscriber)
+                    if not subscribers:
+                        del self.by_author[author_id]
+            self.subscribers -= 1
+
+    # Yields the text of the stream of a subscriber: the backfilled events, then the published ones as they arrive,
+    # until max_age. The caller unsubscribes when the response is closed, which also happens when the client goes away
+    # or when the generator is never started.
+    def events(self, subscriber, backfill=()):
+        yield 'retry: {}\n\n'.format(RETRY_MS)
+        if backfill:
+            yield ''.join(backfill)
+        deadline = monotonic() + self.max_age
+        while monotonic() < deadline:
+            if not subscriber.wakeup.wait(min(self.heartbeat, max(deadline - monotonic(), 0))):
+                yield ': keepalive\n\n'
+                continue
+            events, overflowed = subscriber.drain()
+            if overflowed:
+                yield 'event: overflow\ndata: {}\n\n'
+            if events:
+                yield ''.join(events)
+
+
+def get():
+    return current_app.extensions.get('live')
+
+
+# The ids of the users whose posts user_id sees in its home page: the users it follows and itself
+def authors_of(user_id):
+    rows = db.session.query(followers.c.followed_id).filter(followers.c.follower_id == user_id)
+    return {author_id for author_id, in rows} | {user_id}
+
+
+# The events of the posts of user_id's timeline with an id in (since_id, until_id], at most limit of them (the newest)
+def backfill(user_id, since_id, until_id, limit):
+    followed = select([followers.c.followed_id]).where(followers.c.follower_id == user_id)
+    rows = db.session.execute(_posts_query()
+                              .where(or_(post.c.user_id == user_id, post.c.user_id.in_(followed)))
+                              .where(post.c.id > since_id).where(post.c.id <= until_id)
+                              .order_by(post.c.id.desc()).limit(limit)).fetchall()
+    return [_event(row)[1] for row in reversed(rows)]
+
+
+# Called after posts are committed by this worker, so that the pump reads them now rather than at its next poll. It
+# does nothing when live posts are not enabled.
+def posts_created():
+    hub = get()
+    if hub is not None:
+        hub.poke.set()
+
+
+def init_app(app):
+    app.extensions['live'] = Hub(app)
@@ -0,0 +1,128 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+from logging.handlers import QueueHandler, QueueListener, SMTPHandler
+from time import time
+
+
+# -------------------------------------------- LOGGING PIPELINE --------------------------------------------------
+#
+# The email and file handlers used to be attached straight to app.logger, which means that logging an error did a
+# synchronous SMTP conversation INSIDE the request that failed, making a failing request even slower (or hanging it
+# while the mail server times out).
+#
+# Now app.logger only has a QueueHandler, which just puts the record on a queue and returns. A QueueListener running
+# on a background thread takes the records off the queue and hands them to the real handlers (the file and the email
+# handlers). The queue is bounded: if the background thread cannot keep up, new records are dropped and counted
+# instead of making the requests wait or using unbounded memory.
+#
+# The email handler is also rate limited: the errors are collected and sent in ONE email at most every
+# LOG_MAIL_INTERVAL seconds, so a burst of errors results in one email with all of them instead of hundreds of emails.
+# ----------------------------------------------------------------------------------------------------------------
+
+
+class AggregatingSMTPHandler(SMTPHandler):
+    def __init__(self, *args, interval=300, max_records=50, **kwargs):
+        super(AggregatingSMTPHandler, self).__init__(*args, **kwargs)
+        self.interval = interval
+        self.max_records = max_records
+        self.buffer = []
+        self.dropped = 0
+        self.last_sent = 0.0
+        self.timer = None
+
+    def emit(self, record):
+        if len(self.buffer) < self.max_records:
+            self.buffer.append(self.format(record))
+        else:
+            self.dropped += 1
+        if time() - self.last_sent >= self.interval:
+            self.flush()
+        elif self.timer is None:
+            # Make sure the buffered errors go out once the interval is over, even if nothing else is logged
+            self.timer = threading.Timer(self.last_sent + self.interval - time(), self._flush_from_timer)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _flush_from_timer(self):
+        self.acquire()
+        try:
+            self.timer = None
+            self.flush()
+        finally:
+            self.release()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        body = '\n\n'.join(self.buffer)
+        if self.dropped:
+            body += '\n\n... and {} more errors that were not included in this email.'.format(self.dropped)
+        count = len(self.buffer) + self.dropped
+        self.buffer = []
+        self.dropped = 0
+        self.last_sent = time()
+        record = logging.makeLogRecord({'msg': body, 'levelno': logging.ERROR, 'levelname': 'ERROR'})
+        subject = self.subject
+        self.subject = '{} ({} error{})'.format(subject, count, 's' if count > 1 else '')
+        try:
+            # The records are already formatted, so the aggregated record is sent without formatting it again
+            formatter, self.formatter = self.formatter, None
+            super(AggregatingSMTPHandler, self).emit(record)
+        finally:
+            self.formatter = formatter
+            self.subject = subject
+
+    def close(self):
+        self.acquire()
+        try:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            self.flush()
+        finally:
+            self.release()
+        super(AggregatingSMTPHandler, self).close()
+
+
+# The queue handler that sits on app.logger. A listener thread does not survive a fork, so if the process id changes
+# (a worker forked from a master that already created the app) a new listener is started in the new process.
+class BoundedQueueHandler(QueueHandler):
+    def __init__(self, handlers, maxsize):
+        super(BoundedQueueHandler, self).__init__(queue.Queue(maxsize))
+        self.handlers = handlers
+        self.dropped = 0
+        self.listener = None
+        self.pid = None
+        self._start_listener()
+
+    def _start_listener(self):
+        self.pid = os.getpid()
+        self.queue = queue.Queue(self.queue.maxsize)
+        self.listener = QueueListener(self.queue, *self.handlers, respect_handler_level=True)
+        self.listener.start()
+
+    def enqueue(self, record):
+        if self.pid != os.getpid():
+            self._start_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def stop(self):
+        if self.listener is not None and self.pid == os.getpid():
+            self.listener.stop()
+            self.listener = None
+            for handler in self.handlers:
+                handler.close()
+
+
+# Attach the handlers to the logger through a queue, and make sure the queue is drained when the process exits
+def attach_queued_handlers(logger, handlers, maxsize=10000):
+    handler = BoundedQueueHandler(handlers, maxsize)
+    logger.addHandler(handler)
+    atexit.register(handler.stop)
+    return handler
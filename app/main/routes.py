@@ -1,11 +1,17 @@
 from datetime import datetime
-from flask import render_template, flash, redirect, url_for, request, g, jsonify, current_app
+from flask import render_template, flash, redirect, url_for, request, g, jsonify, current_app, Markup, Response, \
+    abort
 from flask_login import current_user, login_required
 from flask_babel import _, get_locale
 from guess_language import guess_language
-from app import db
+from app import db, graph, live, recent_posts
+from app.conditional import newest_post_id, not_modified, page_etag, with_etag
+from app.group_commit import GroupCommitError, group_commit
 from app.main.forms import EditProfileForm, PostForm
-from app.models import User, Post
+from app.models import FOLLOW_STATE_CHUNK, User, Post, followers
+from app.pagination import keyset_page
+from app.page_cache import cached_fragment
+from app.streaming import StreamedPage, stream_template
 from app.translate import translate
 from app.main import bp
 
@@ -60,9 +66,23 @@ def index():
         if language == 'UNKNOWN' or len(language) > 5:
             language = ''
 
-        post = Post(body=form.post.data, author=current_user, language=language)
-        db.session.add(post)
-        db.session.commit()
+        # With group commit enabled the post is handed to the writer thread, which commits it together with the posts
+        # of any other requests that arrived in the same few milliseconds. The call only returns once the batch is
+        # durable, so the redirect below still means the post is live. When it fails or times out the post was not
+        # written (see _Writer.submit), so the user is told to submit it again rather than shown an error page.
+        if current_app.config['GROUP_COMMIT_ENABLED']:
+            try:
+                group_commit.submit_post(form.post.data, current_user.id, language)
+            except GroupCommitError:
+                flash('Your post could not be saved, please try again.')
+                return redirect(url_for('main.index'))
+        else:
+            post = Post(body=form.post.data, author=current_user, language=language)
+            db.session.add(post)
+            current_user.increment(posts_count=1)
+            db.session.commit()
+            recent_posts.post_created(post)
+            live.posts_created()
 
         # Display the success message and redirect/refresh to home page so user can see updated page with post
         flash('Your post is now live!')
@@ -98,6 +118,21 @@ def index():
     #       The items attribute of this object contains the list of items in the requested page
 
     page = request.args.get('page', 1, type=int)  # Arg 1: Query Variable, Arg 2: Default Value, Arg 3: D-TYPE (INT)
+
+    # "Who to follow", precomputed by "flask suggestions refresh" (see app/suggestions.py)
+    suggestions = current_user.suggested_users(current_app.config['SUGGESTIONS_SHOWN'])
+
+    # The first page listens for new posts instead of being reloaded to find them (see app/live.py)
+    stream_url = url_for('main.stream') if live.get() is not None and page == 1 else None
+
+    # With STREAMING_FEEDS the page is sent while it is rendered, see app/streaming.py
+    if current_app.config['STREAMING_FEEDS']:
+        posts = StreamedPage(current_user.followed_posts(), page, current_app.config['POSTS_PER_PAGE'])
+        return stream_template('index.html', title='Home Page', posts=posts, form=form, suggestions=suggestions,
+                               stream_url=stream_url,
+                               next_url=posts.next_url(url_for('main.index', page=posts.page + 1)),
+                               prev_url=url_for('main.index', page=posts.page - 1) if posts.page > 1 else None)
+
     posts = current_user.followed_posts().paginate(page, current_app.config['POSTS_PER_PAGE'], False)
 
     # Further Notes on PAGINATE class from SQL-Alchemy
@@ -123,8 +158,39 @@ def index():
     #   - Just provide the name of the template and the variables
     #   - This will load the template you indicated and will pass the variables to the template as keyword arguments
     #   - In this case we are calling index.html & passing the string for title and array containing the posts
-    return render_template('index.html',
-                           title='Home Page', posts=posts.items, form=form, next_url=next_url, prev_url=prev_url)
+    return render_template('index.html', title='Home Page', posts=posts.items, form=form, suggestions=suggestions,
+                           stream_url=stream_url, next_url=next_url, prev_url=prev_url)
+
+
+# Server-sent events of the new posts of the home page (see app/live.py). The stream starts after the post id given
+# by the Last-Event-ID header (sent by the browser when it reconnects) or the since_id argument, and otherwise with
+# the next new post.
+@bp.route('/stream')
+@login_required
+def stream():
+    hub = live.get()
+    if hub is None:
+        abort(404)
+    since_id = request.headers.get('Last-Event-ID') or request.args.get('since_id')
+    since_id = int(since_id) if since_id is not None and since_id.isdigit() else None
+
+    # Everything the stream needs from the database is read now, the generator runs after the session is closed
+    subscriber, last_id = hub.subscribe(live.authors_of(current_user.id))
+    if subscriber is None:
+        # Every stream holds a thread of the worker, past the limit the browser is told to come back later
+        return Response('retry: {}\n\n'.format(live.FULL_RETRY_MS), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache'})
+    try:
+        backfill = live.backfill(current_user.id, since_id, last_id, hub.queue_size) if since_id is not None else []
+    except Exception:
+        hub.unsubscribe(subscriber)
+        raise
+    response = Response(hub.events(subscriber, backfill), mimetype='text/event-stream')
+    response.call_on_close(lambda: hub.unsubscribe(subscriber))
+    response.headers['Cache-Control'] = 'no-cache'
+    # Tells nginx not to buffer the response, the events would only reach the browser once the buffer is full
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 
 # This is the FN for viewing a user profile and is associated with a custom URL dependant upon the user (/user/<>)
@@ -135,6 +201,16 @@ def user(username):
     # Return the matching user object resulting from a db query using the html passed username variable (first or 404)
     user = User.query.filter_by(username=username).first_or_404()
 
+    # If the browser already has this page and none of its validators changed, answer 304 before running the queries
+    # that render it (see app/conditional.py). last_seen is shown with minute precision, hence the truncation.
+    page = request.args.get('page', 1, type=int)
+    etag = page_etag('user', user.id, user.username, user.email, user.about_me,
+                     user.last_seen.replace(second=0, microsecond=0) if user.last_seen else None,
+                     user.graph_version, newest_post_id(user), page)
+    response = not_modified(etag)
+    if response is not None:
+        return response
+
     # Get all posts from the current user and pass it as an argument to the html template view to be displayed
     #
     # The followed_posts method of the User class returns a SQLAlchemy query object that is configured to grab the
@@ -149,14 +225,64 @@ def user(username):
     # Take this query and add an order_by() clause so that I get the newest posts first, and then do the pagination
     # exactly like I did for the posts in the index and explore pages. Note that the pagination links that are
     # generated by the url_for() function need the extra username argument (point back at the user profile page)
-    page = request.args.get('page', 1, type=int)
+    if current_app.config['STREAMING_FEEDS']:
+        posts = StreamedPage(user.posts.order_by(Post.timestamp.desc()), page, current_app.config['POSTS_PER_PAGE'])
+        return with_etag(stream_template('user.html', user=user, posts=posts,
+                                         next_url=posts.next_url(url_for('main.user', username=user.username,
+                                                                         page=posts.page + 1)),
+                                         prev_url=url_for('main.user', username=user.username, page=posts.page - 1)
+                                         if posts.page > 1 else None), etag)
+
     posts = user.posts.order_by(Post.timestamp.desc()).paginate(page, current_app.config['POSTS_PER_PAGE'], False)
 
     next_url = url_for('main.user', username=user.username, page=posts.next_num) if posts.has_next else None
     prev_url = url_for('main.user', username=user.username, page=posts.prev_num) if posts.has_prev else None
 
     # Return html (if not 404'd) for user.html passing the queried user object and the fake posts
-    return render_template('user.html', user=user, posts=posts.items, next_url=next_url, prev_url=prev_url)
+    return with_etag(render_template('user.html', user=user, posts=posts.items, next_url=next_url,
+                                     prev_url=prev_url), etag)
+
+
+# These are the FNs for the lists of the followers of a user and of the users a user follows
+# (/user/<username>/followers and /user/<username>/following)
+#
+# Both lists are read from the followers association table in user id order with keyset pagination (see
+# app/pagination.py), so the last page of the followers of an account with a million followers is as fast as the
+# first one. The users of the page come in the same query (a join with the user table), and whether the viewer follows
+# each of them is resolved with one more query for the whole page (User.following_ids).
+@bp.route('/user/<username>/followers')
+@login_required
+def user_followers(username):
+    user = User.query.filter_by(username=username).first_or_404()
+    return _follow_list(user, 'followers', followers.c.follower_id, followers.c.followed_id, 'main.user_followers')
+
+
+@bp.route('/user/<username>/following')
+@login_required
+def user_following(username):
+    user = User.query.filter_by(username=username).first_or_404()
+    return _follow_list(user, 'following', followers.c.followed_id, followers.c.follower_id, 'main.user_following')
+
+
+# member is the column of the followers table that holds the users listed, owner the one that holds the user the list
+# belongs to
+def _follow_list(user, kind, member, owner, endpoint):
+    query = User.query.join(followers, member == User.id).filter(owner == user.id)
+    page = keyset_page(query, member, lambda u: u.id, current_app.config['USERS_PER_PAGE'],
+                       after=request.args.get('after', type=int), before=request.args.get('before', type=int))
+
+    next_url = url_for(endpoint, username=user.username, after=page.last_key) if page.has_next else None
+    prev_url = url_for(endpoint, username=user.username, before=page.first_key) if page.has_prev else None
+    following = current_user.following_ids([u.id for u in page.items])
+    # With the follow graph in memory (GRAPH_ENABLED, see app/graph.py) the users that follow the current user back
+    # are marked, a few binary searches instead of one more query. The graph may be a little behind the database,
+    # which is fine for a mark.
+    social_graph = graph.get()
+    follows_you = {u.id for u in page.items if social_graph.is_following(u.id, current_user.id)} \
+        if social_graph is not None else set()
+    return render_template('follow_list.html', title='{} {}'.format(user.username, kind), user=user, kind=kind,
+                           users=page.items, following=following, follows_you=follows_you, next_url=next_url,
+                           prev_url=prev_url)
 
 
 # This is the FN for editing a profile and is associated with the /edit_profile address
@@ -176,6 +302,8 @@ def edit_profile():
         current_user.about_me = form.about_me.data
 
         db.session.commit()
+        # The posts of the user in the recent posts buffers show the old name and avatar (see app/recent_posts.py)
+        recent_posts.profile_changed()
         flash('Your changes have been saved.')
         # Redirect to the edit profile page (passing the current_user) so that the user can see updated default fields
         return redirect(url_for('main.edit_profile'))
@@ -213,6 +341,7 @@ def follow(username):
     # Call the follow module to update the database field and then commit the changes to memory
     current_user.follow(user)
     db.session.commit()
+    graph.followed(current_user.id, user.id)
 
     # Display a success message and redirect the user to their appropriate user page
     flash('You are following {}!'.format(username))
@@ -240,12 +369,61 @@ def unfollow(username):
     # Call the unfollow module to update the database field and then commit the changes to memory
     current_user.unfollow(user)
     db.session.commit()
+    graph.unfollowed(current_user.id, user.id)
 
     # Display a success message and redirect the user to their appropriate user page
     flash('You are not following {}.'.format(username))
     return redirect(url_for('main.user', username=username))
 
 
+# This is the FN for following and un-following many users in one request (for example when importing a contact list)
+# and is associated with the /bulk_follow path. It takes and returns JSON:
+#
+#   request   -->  {"follow": ["susan", "mary"], "unfollow": ["david"]}
+#   response  -->  {"followed": ["susan"], "unfollowed": ["david"], "unchanged": ["mary"], "not_found": []}
+#
+# The users are looked up with one query and the changes are applied by User.bulk_follow() in a single transaction
+# with set-based statements, instead of one is_following() query, one INSERT or DELETE and one commit per user.
+#
+# The body is only read when it is sent as application/json (get_json() ignores anything else), a content type that
+# a form on another site cannot send without the browser asking this server first (CORS), which is what protects
+# this endpoint from cross-site requests in place of the CSRF token of the web forms.
+@bp.route('/bulk_follow', methods=['POST'])
+@login_required
+def bulk_follow():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Expected a JSON object with "follow" and/or "unfollow" lists of usernames.'}), 400
+    to_follow = data.get('follow') or []
+    to_unfollow = data.get('unfollow') or []
+    if not all(isinstance(names, list) and all(isinstance(name, str) for name in names)
+               for names in (to_follow, to_unfollow)):
+        return jsonify({'error': '"follow" and "unfollow" must be lists of usernames.'}), 400
+    if len(to_follow) + len(to_unfollow) > current_app.config['BULK_FOLLOW_MAX']:
+        return jsonify({'error': 'At most {} users per request.'.format(current_app.config['BULK_FOLLOW_MAX'])}), 400
+
+    names = set(to_follow) | set(to_unfollow)
+    ids = {}
+    chunk = list(names)
+    for i in range(0, len(chunk), FOLLOW_STATE_CHUNK):
+        ids.update((username, user_id) for user_id, username in db.session.query(User.id, User.username)
+                   .filter(User.username.in_(chunk[i:i + FOLLOW_STATE_CHUNK])))
+
+    followed, unfollowed = current_user.bulk_follow([ids[name] for name in to_follow if name in ids],
+                                                    [ids[name] for name in to_unfollow if name in ids])
+    db.session.commit()
+    for user_id in followed:
+        graph.followed(current_user.id, user_id)
+    for user_id in unfollowed:
+        graph.unfollowed(current_user.id, user_id)
+
+    changed = followed | unfollowed
+    return jsonify({'followed': sorted(name for name in names if ids.get(name) in followed),
+                    'unfollowed': sorted(name for name in names if ids.get(name) in unfollowed),
+                    'unchanged': sorted(name for name in names if name in ids and ids[name] not in changed),
+                    'not_found': sorted(name for name in names if name not in ids)})
+
+
 # This is the FN for viewing the global stream of posts from all users and is associated with the /explore path
 # This page requires the user to be authenticated to be accessed
 @bp.route('/explore')
@@ -254,13 +432,60 @@ def explore():
     # Get all the posts from the post table ordered by timestamp
     # For notes on pagination see index route and/or flask documentation
     page = request.args.get('page', 1, type=int)
-    posts = Post.query.order_by(Post.timestamp.desc()).paginate(page, current_app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('main.explore', page=posts.next_num) if posts.has_next else None
-    prev_url = url_for('main.explore', page=posts.prev_num) if posts.has_prev else None
+
+    # Answer 304 when the browser's copy is still current, before any query runs (see app/conditional.py). With the
+    # recent posts buffer the newest post is known without a query.
+    buffer = recent_posts.get()
+    newest = buffer.newest_id() if buffer is not None else newest_post_id()
+    etag = page_etag('explore', newest, page)
+    response = not_modified(etag)
+    if response is not None:
+        return response
+
+    # The posts part of the page is the same for every user, so it comes from the shared page cache when it is enabled
+    # (see app/page_cache.py). A stale copy is sent without the ETag, which belongs to the current posts. Only the
+    # first pages are cached, the deep ones are rarely asked for twice.
+    if 'page_cache' in current_app.extensions and 1 <= page <= current_app.config['PAGE_CACHE_MAX_PAGE']:
+        posts_html, fresh = cached_fragment('explore_page', (page, g.locale), newest,
+                                            lambda: _render_explore_posts(page))
+        return with_etag(render_template('index.html', title='Explore', posts_html=Markup(posts_html)),
+                         etag if fresh else None)
+
+    if current_app.config['STREAMING_FEEDS']:
+        posts = StreamedPage(Post.query.order_by(Post.timestamp.desc()), page, current_app.config['POSTS_PER_PAGE'])
+        return with_etag(stream_template('index.html', title='Explore', posts=posts,
+                                         next_url=posts.next_url(url_for('main.explore', page=posts.page + 1)),
+                                         prev_url=url_for('main.explore', page=posts.page - 1)
+                                         if posts.page > 1 else None), etag)
+
     # Return the home page html without the form argument being passed
     # The explore page should be identical except not limited to the user and his/her followed users
     # Additionally it should not contain the ability to write a post (no form)
-    return render_template('index.html', title='Explore', posts=posts.items, next_url=next_url, prev_url=prev_url)
+    return with_etag(render_template('index.html', title='Explore', **_explore_posts(page)), etag)
+
+
+# The posts and the pager links of an explore page. The first pages come from the recent posts buffer when it is
+# enabled (see app/recent_posts.py), the others from the database.
+def _explore_posts(page):
+    per_page = current_app.config['POSTS_PER_PAGE']
+    buffer = recent_posts.get()
+    served = buffer.page(max(page, 1), per_page) if buffer is not None else None
+    if served is not None:
+        items, has_next = served
+        page = max(page, 1)
+        return {'posts': items,
+                'next_url': url_for('main.explore', page=page + 1) if has_next else None,
+                'prev_url': url_for('main.explore', page=page - 1) if page > 1 else None}
+
+    posts = Post.query.order_by(Post.timestamp.desc()).paginate(page, per_page, False)
+    return {'posts': posts.items,
+            'next_url': url_for('main.explore', page=posts.next_num) if posts.has_next else None,
+            'prev_url': url_for('main.explore', page=posts.prev_num) if posts.has_prev else None}
+
+
+# Renders the posts and the pager of an explore page on their own, to be stored in the page cache
+def _render_explore_posts(page):
+    return render_template('_posts.html', **_explore_posts(page))
 
 
 # This is the FN called when a user wishes to translate a post from one language to another (it accepts only POST req)
@@ -0,0 +1,333 @@
+import json
+import os
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import perf_counter, time
+from flask import Response, abort, current_app, g, request
+from app.access_log import record_cache_lookup
+from app.instrumentation import current_stats
+
+# fcntl only exists on Unix, elsewhere two workers could fold the same dead snapshot at the same time and count it
+# twice, and a scrape could read the snapshots in the middle of a fold
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# ------------------------------------------------ METRICS ------------------------------------------------------
+#
+# A small metrics registry that is exposed at /metrics in the Prometheus text exposition format. It keeps three
+# kinds of metrics, each one identified by a name and a set of labels:
+#
+#   counter    -->  a value that only goes up (cache hits, cache misses)
+#   gauge      -->  a value that goes up and down (emails waiting to be sent)
+#   histogram  -->  a distribution of observations in fixed buckets (request latency, DB time, translator latency)
+#
+# On the hot path recording a value is one lock, one dictionary lookup and, for histograms, one bisect into the
+# bucket bounds, so it is cheap enough to run on every request.
+#
+# In production the application runs in several worker processes and each process has its own registry. When
+# METRICS_DIR is set, every process periodically writes a snapshot of its registry to METRICS_DIR/<pid>.json, and the
+# worker that answers a /metrics scrape merges the snapshots of all of them: counters and histograms are summed,
+# gauges are summed over the processes that are still alive. Without METRICS_DIR only the local process is reported.
+#
+# The snapshot of a worker that has exited is folded into METRICS_DIR/dead.json (its counters and histograms, gauges
+# die with it) and removed, so the totals never go backwards, even when the pid is later reused by a new worker: a
+# worker that finds a snapshot under its own pid before it wrote one folds it too, before replacing it.
+#
+# /metrics is only served to scrapers that send "Authorization: Bearer <METRICS_TOKEN>". Without a METRICS_TOKEN it
+# answers 404, except in debug mode and in the tests.
+# ----------------------------------------------------------------------------------------------------------------
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0)
+
+_help = {
+    'microblog_request_duration_seconds': ('histogram', 'Request latency per endpoint.'),
+    'microblog_db_duration_seconds': ('histogram', 'Time spent in the database per request, per endpoint.'),
+    'microblog_translate_duration_seconds': ('histogram', 'Latency of calls to the translation service.'),
+    'microblog_cache_requests_total': ('counter', 'Cache lookups per cache, by result (hit or miss).'),
+    'microblog_email_queue_depth': ('gauge', 'Emails handed to a background thread and not sent yet.'),
+}
+
+
+class Registry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def inc(self, name, labels=(), amount=1):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set_gauge(self, name, labels=(), delta=0):
+        key = (name, labels)
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + delta
+
+    # A histogram is stored as [bucket counts..., sum, count]. The bucket counts are NOT cumulative here, they are
+    # made cumulative when they are rendered.
+    def observe(self, name, labels, value):
+        key = (name, labels)
+        index = bisect_left(LATENCY_BUCKETS, value)
+        with self.lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = [0] * (len(LATENCY_BUCKETS) + 3)
+            h[index] += 1
+            h[-2] += value
+            h[-1] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'counters': [[name, list(labels), v] for (name, labels), v in self.counters.items()],
+                'gauges': [[name, list(labels), v] for (name, labels), v in self.gauges.items()],
+                'histograms': [[name, list(labels), list(v)] for (name, labels), v in self.histograms.items()],
+            }
+
+
+registry = Registry()
+
+
+# ---------------------------------------------- RECORDING -------------------------------------------------------
+# These are the helpers the rest of the application calls. Labels are tuples of (name, value) pairs.
+
+def record_cache(cache, hit):
+    registry.inc('microblog_cache_requests_total', (('cache', cache), ('result', 'hit' if hit else 'miss')))
+    record_cache_lookup(hit)
+
+
+def email_queued():
+    registry.set_gauge('microblog_email_queue_depth', delta=1)
+
+
+def email_sent():
+    registry.set_gauge('microblog_email_queue_depth', delta=-1)
+
+
+def observe_translate(seconds):
+    registry.observe('microblog_translate_duration_seconds', (), seconds)
+
+
+# ------------------------------------------ MULTI-PROCESS SUPPORT ------------------------------------------------
+
+DEAD_SNAPSHOT = 'dead.json'
+
+# The pid that this process last wrote a snapshot as (it changes in a forked child)
+_written_pid = None
+
+
+def _snapshot_path(directory, pid):
+    return os.path.join(directory, '{}.json'.format(pid))
+
+
+def _write_json(path, data):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    # The rename is atomic, so a scrape never reads a half written file
+    os.replace(tmp, path)
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+# Locks the snapshots directory: exclusive to fold a snapshot into dead.json, shared to read them all
+@contextmanager
+def _directory_lock(directory, exclusive):
+    with open(os.path.join(directory, '.lock'), 'w') as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+
+
+# Adds the counters and histograms of the snapshot at path to the dead workers' totals, and removes it. The directory
+# is locked so that two workers cleaning up at the same time do not both add it.
+def _fold_into_dead(directory, path):
+    with _directory_lock(directory, exclusive=True):
+        snap = _read_json(path)
+        if snap is None:
+            # Already folded by another worker (or unreadable, and then there is nothing to save)
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        dead_path = os.path.join(directory, DEAD_SNAPSHOT)
+        dead = _read_json(dead_path) or {'counters': [], 'gauges': [], 'histograms': []}
+        merged = _merge([dead, snap], [False, False])
+        _write_json(dead_path, merged)
+        os.remove(path)
+
+
+def write_snapshot(directory):
+    global _written_pid
+    pid = os.getpid()
+    path = _snapshot_path(directory, pid)
+    if _written_pid != pid:
+        # A snapshot under this pid that this process did not write belongs to an exited worker with the same pid
+        if os.path.exists(path):
+            _fold_into_dead(directory, path)
+        _written_pid = pid
+    _write_json(path, registry.snapshot())
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+# Sums the snapshots, the gauges only of those whose alive flag is set
+def _merge(snapshots, alive):
+    counters, gauges, histograms = {}, {}, {}
+    for snap, snap_alive in zip(snapshots, alive):
+        for name, labels, v in snap['counters']:
+            key = (name, tuple(map(tuple, labels)))
+            counters[key] = counters.get(key, 0) + v
+        if snap_alive:
+            for name, labels, v in snap['gauges']:
+                key = (name, tuple(map(tuple, labels)))
+                gauges[key] = gauges.get(key, 0) + v
+        for name, labels, v in snap['histograms']:
+            key = (name, tuple(map(tuple, labels)))
+            h = histograms.setdefault(key, [0] * len(v))
+            for i, x in enumerate(v):
+                h[i] += x
+
+    return {
+        'counters': [[name, list(labels), v] for (name, labels), v in counters.items()],
+        'gauges': [[name, list(labels), v] for (name, labels), v in gauges.items()],
+        'histograms': [[name, list(labels), v] for (name, labels), v in histograms.items()],
+    }
+
+
+def collect(directory=None):
+    if not directory:
+        return registry.snapshot()
+
+    write_snapshot(directory)
+    for filename in os.listdir(directory):
+        if filename.endswith('.json') and filename[:-5].isdigit() and not _alive(int(filename[:-5])):
+            _fold_into_dead(directory, os.path.join(directory, filename))
+
+    # A fold writes dead.json and then removes the worker's snapshot, so without the lock a scrape in between would
+    # count that worker twice, and one that listed the directory before the fold would miss it
+    snapshots, alive = [], []
+    with _directory_lock(directory, exclusive=False):
+        for filename in os.listdir(directory):
+            if not filename.endswith('.json'):
+                continue
+            snap = _read_json(os.path.join(directory, filename))
+            if snap is None:
+                continue
+            snapshots.append(snap)
+            alive.append(filename != DEAD_SNAPSHOT)
+    return _merge(snapshots, alive)
+
+
+# ----------------------------------------- TEXT EXPOSITION FORMAT -----------------------------------------------
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, _escape(v)) for k, v in pairs) + '}'
+
+
+def render(snap):
+    families = {}
+    for kind in ('counters', 'gauges', 'histograms'):
+        for name, labels, v in snap[kind]:
+            families.setdefault(name, []).append((kind, [tuple(pair) for pair in labels], v))
+
+    lines = []
+    for name in sorted(families):
+        kind, text = _help.get(name, (None, name))
+        lines.append('# HELP {} {}'.format(name, text))
+        lines.append('# TYPE {} {}'.format(name, kind or 'untyped'))
+        for series_kind, labels, v in sorted(families[name], key=lambda s: s[1]):
+            if series_kind != 'histograms':
+                lines.append('{}{} {}'.format(name, _labels(labels), v))
+                continue
+            cumulative = 0
+            for bound, n in zip(LATENCY_BUCKETS + ('+Inf',), v):
+                cumulative += n
+                lines.append('{}_bucket{} {}'.format(name, _labels(labels + [('le', bound)]), cumulative))
+            lines.append('{}_sum{} {}'.format(name, _labels(labels), v[-2]))
+            lines.append('{}_count{} {}'.format(name, _labels(labels), v[-1]))
+    return '\n'.join(lines) + '\n'
+
+
+# ------------------------------------------- REQUEST HOOKS ------------------------------------------------------
+
+def _start_request():
+    g._request_start = perf_counter()
+
+
+def _finish_request(response):
+    start = g.get('_request_start')
+    if start is None:
+        return response
+
+    endpoint = request.endpoint or 'unknown'
+    registry.observe('microblog_request_duration_seconds', (('endpoint', endpoint),), perf_counter() - start)
+    stats = current_stats()
+    if stats is not None:
+        registry.observe('microblog_db_duration_seconds', (('endpoint', endpoint),), stats.time)
+
+    # Write this process' snapshot at most once every METRICS_FLUSH_INTERVAL seconds
+    directory = current_app.config['METRICS_DIR']
+    if directory:
+        global _last_flush
+        now = time()
+        if now - _last_flush >= current_app.config['METRICS_FLUSH_INTERVAL']:
+            _last_flush = now
+            write_snapshot(directory)
+    return response
+
+
+_last_flush = 0.0
+
+
+def metrics_view():
+    token = current_app.config['METRICS_TOKEN']
+    if not token:
+        # Nothing to check the scraper against: only open in debug mode and in the tests
+        if not current_app.debug and not current_app.testing:
+            abort(404)
+    elif request.headers.get('Authorization') != 'Bearer ' + token:
+        abort(403)
+    text = render(collect(current_app.config['METRICS_DIR']))
+    return Response(text, mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app):
+    app.config.setdefault('METRICS_ENABLED', True)
+    app.config.setdefault('METRICS_DIR', None)
+    app.config.setdefault('METRICS_FLUSH_INTERVAL', 5)
+    app.config.setdefault('METRICS_TOKEN', None)
+    if not app.config['METRICS_ENABLED']:
+        return
+
+    if app.config['METRICS_DIR'] and not os.path.exists(app.config['METRICS_DIR']):
+        os.makedirs(app.config['METRICS_DIR'])
+
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
@@ -1,9 +1,11 @@
-from datetime import datetime
-from flask import current_app
+from datetime import datetime, timedelta
+from flask import current_app, g, has_request_context
 from app import db, login
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
+from sqlalchemy import inspect
 from hashlib import md5
+import secrets
 from time import time
 import jwt
 
@@ -18,7 +20,25 @@ followers = db.Table('followers',
                                db.ForeignKey('user.id')),
                      db.Column('followed_id',
                                db.Integer,
-                               db.ForeignKey('user.id')))
+                               db.ForeignKey('user.id')),
+                     # The followers of a user and the users a user follows, in user id order, are both read straight
+                     # from an index: the follower and followed lists page through them (see app/pagination.py), and
+                     # is_following() finds its row without scanning the followed users of the follower
+                     db.Index('ix_followers_followed_id_follower_id', 'followed_id', 'follower_id'),
+                     db.Index('ix_followers_follower_id_followed_id', 'follower_id', 'followed_id'))
+
+
+# Maximum number of ids in the IN (...) list of one follow state query
+FOLLOW_STATE_CHUNK = 500
+
+
+# The follow state that is already known in this request for the given follower, as a dict of followed user id ->
+# True/False. It lives in the g object, so it is thrown away at the end of the request, and follow() and unfollow()
+# keep it up to date. Outside of a request (and for a user that is not in the database yet) nothing is remembered.
+def _follow_state(follower_id):
+    if not has_request_context() or follower_id is None:
+        return {}
+    return g.setdefault('_follow_state', {}).setdefault(follower_id, {})
 
 
 # ----- User Class -----
@@ -120,14 +140,87 @@ class User(UserMixin, db.Model):
     def follow(self, user):
         if not self.is_following(user):
             self.followed.append(user)
+            self.increment(followed_count=1, followed_version=1, graph_version=1)
+            user.increment(followers_count=1, graph_version=1)
+            _follow_state(self.id)[user.id] = True
 
     def unfollow(self, user):
         if self.is_following(user):
             self.followed.remove(user)
+            self.increment(followed_count=-1, followed_version=1, graph_version=1)
+            user.increment(followers_count=-1, graph_version=1)
+            _follow_state(self.id)[user.id] = False
+
+    # follow() and unfollow() for many users at once, by id, with a fixed number of statements whatever the number of
+    # users: one query for the current follow state (following_ids), one INSERT with all the new rows of the followers
+    # table (executemany), one DELETE per chunk of removed rows, and the counters of every user involved updated with
+    # one UPDATE each, also sent as a single executemany. Ids that are already in the requested state, and the user
+    # itself, are skipped. Returns the sets of ids that were followed and unfollowed, the caller commits.
+    def bulk_follow(self, follow_ids, unfollow_ids):
+        follow_ids = set(follow_ids) - {self.id}
+        unfollow_ids = set(unfollow_ids) - follow_ids - {self.id}
+        following = self.following_ids(follow_ids | unfollow_ids)
+        followed = follow_ids - following
+        unfollowed = unfollow_ids & following
+
+        if followed:
+            db.session.execute(followers.insert(), [{'follower_id': self.id, 'followed_id': user_id}
+                                                    for user_id in sorted(followed)])
+        removed = sorted(unfollowed)
+        for i in range(0, len(removed), FOLLOW_STATE_CHUNK):
+            db.session.execute(followers.delete().where(db.and_(
+                followers.c.follower_id == self.id, followers.c.followed_id.in_(removed[i:i + FOLLOW_STATE_CHUNK]))))
+
+        if followed or unfollowed:
+            self.increment(followed_count=len(followed) - len(unfollowed), followed_version=1, graph_version=1)
+            db.session.execute(User.__table__.update().where(User.id == db.bindparam('changed_id')).values(
+                followers_count=User.followers_count + db.bindparam('delta'), graph_version=User.graph_version + 1),
+                [{'changed_id': user_id, 'delta': 1} for user_id in sorted(followed)] +
+                [{'changed_id': user_id, 'delta': -1} for user_id in removed])
+            # The users changed behind the back of the ORM, their counters are reloaded the next time they are read
+            for user_id in followed | unfollowed:
+                user = db.session.identity_map.get(db.session.identity_key(User, user_id))
+                if user is not None:
+                    db.session.expire(user, ['followers_count', 'graph_version'])
+
+        state = _follow_state(self.id)
+        state.update(dict.fromkeys(followed, True))
+        state.update(dict.fromkeys(unfollowed, False))
+        return followed, unfollowed
+
+    # Adds to the counter columns of the user (followers_count, followed_count, posts_count and the versions), as part
+    # of the current transaction. For a user that is already in the database the addition is done by the database
+    # (UPDATE user SET followers_count = followers_count + 1 ...): two concurrent follows computing the new value in
+    # Python would both read the same count and one of the two increments would be lost. The UPDATE is sent right away,
+    # one per call, and the attributes are expired so they are read back from the row: keeping the expression in the
+    # attribute until the next flush would let a second call in the same session replace the first one.
+    def increment(self, **deltas):
+        if not inspect(self).persistent:
+            for name, delta in deltas.items():
+                setattr(self, name, (getattr(self, name) or 0) + delta)
+            return
+        table = User.__table__
+        db.session.execute(table.update().where(table.c.id == self.id)
+                           .values({name: table.c[name] + delta for name, delta in deltas.items()}))
+        db.session.expire(self, list(deltas))
 
     def is_following(self, user):
-        return self.followed.filter(
-            followers.c.followed_id == user.id).count() > 0
+        return user.id in self.following_ids([user.id])
+
+    # Returns the set of the given user ids that this user follows. The ids that are not known yet are looked up with
+    # ONE query (followed_id IN (...), in chunks to stay under the bound parameter limit of SQLite), and the answers are
+    # remembered until the end of the request, so a page that shows the Follow/Un-Follow state of many users, or asks
+    # about the same user several times, does not run one COUNT query per user.
+    def following_ids(self, user_ids):
+        state = _follow_state(self.id)
+        missing = list({user_id for user_id in user_ids if user_id not in state})
+        for i in range(0, len(missing), FOLLOW_STATE_CHUNK):
+            chunk = missing[i:i + FOLLOW_STATE_CHUNK]
+            found = {row[0] for row in db.session.query(followers.c.followed_id).filter(
+                followers.c.follower_id == self.id, followers.c.followed_id.in_(chunk))}
+            for user_id in chunk:
+                state[user_id] = user_id in found
+        return {user_id for user_id in user_ids if state[user_id]}
 
     # ---------------------------------------------------------------------------------------------------------------
     # The follow() and unfollow() methods use the append() and remove() methods of the relationship object
@@ -138,20 +231,20 @@ class User(UserMixin, db.Model):
     #  For Example:  If I ask user1 to follow user2, but it turns out that this following relationship already exists
     #                in the database, I do not want to add a duplicate. The same logic can be applied to unfollowing.
     #
-    # The is_following() method issues a query on the followed relationship to check if a link between two users
-    # already exists. You have seen the filter_by() method of the SQLAlchemy query object before.
+    # The is_following() method asks following_ids() about a single user, which issues a query on the followers
+    # association table to check if a link between two users already exists. You have seen the filter_by() method of
+    # the SQLAlchemy query object before.
     #
     #  For Example:  To find a user given its username.
     #                The filter() method that I'm using here can include arbitrary filtering conditions unlike
     #                filter_by() which can only check for equality to a constant value.
     #
-    # The condition that I'm using in is_following() looks for items in the association table that have
-    # the left side foreign key set to the self user, and the right side set to the user argument.
-    #
-    # The query is terminated with a count() method, which returns the number of results.
-    # The result of this query is going to be 0 or 1 (WE CAN USE =1 OR >0)
+    # The condition that I'm using in following_ids() looks for items in the association table that have
+    # the left side foreign key set to the self user, and the right side set to ANY of the users asked about
+    # (followed_id IN (...)), so one query answers for a whole list of users.
     #
-    # NOTE: Other query terminators we have used are  all()  and  first()  .
+    # NOTE: The query used to be terminated with a count() method, returning 0 or 1 for a single user. Other query
+    #       terminators we have used are  all()  and  first()  .
     #
     # ---------------------------------------------------------------------------------------------------------------
     # ----------------------------------- Obtaining the Posts from Followed Users -----------------------------------
@@ -212,6 +305,33 @@ class User(UserMixin, db.Model):
     # last_seen is used to store a timestamp (utc for now) that represents the last time the user accessed the site
     last_seen = db.Column(db.DateTime, default=datetime.utcnow)
 
+    # graph_version is a counter of the changes to the followers of the user and to the users it follows, it changes
+    # every time the user follows or unfollows someone, or gains or loses a follower, which makes it a cheap validator
+    # for the pages that show the follow graph around the user (see app/conditional.py)
+    graph_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    # Denormalized counters, so that the profile page does not need two COUNT queries over the followers table. They
+    # are maintained by follow(), unfollow() and the post creation code with increment(), and "flask counters
+    # reconcile" recomputes them from the tables and reports any drift (see app/counters.py)
+    followers_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    followed_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    posts_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    # followed_version only changes when the user follows or unfollows someone, not when it gains or loses followers,
+    # and suggestions_version is the followed_version the "who to follow" suggestions of the user were computed at,
+    # NULL until they are computed for the first time (see app/suggestions.py)
+    followed_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    suggestions_version = db.Column(db.Integer)
+
+    # The users suggested to this user, best first, leaving out the ones followed since the suggestions were computed
+    def suggested_users(self, limit):
+        return User.query.join(Suggestion, Suggestion.suggested_id == User.id) \
+            .filter(Suggestion.user_id == self.id) \
+            .filter(~db.exists().where(db.and_(followers.c.follower_id == self.id,
+                                               followers.c.followed_id == Suggestion.suggested_id))) \
+            .order_by(Suggestion.score.desc(), Suggestion.suggested_id) \
+            .limit(limit).all()
+
     # .METHOD() to CREATE a hash for input password string received when a user is registering
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
@@ -220,6 +340,34 @@ class User(UserMixin, db.Model):
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
+    # token and token_expiration authenticate the clients of the JSON API (see app/api/auth.py). The token is random,
+    # stored as is and looked up through its unique index
+    token = db.Column(db.String(32), index=True, unique=True)
+    token_expiration = db.Column(db.DateTime)
+
+    # .METHOD() to GET the API token of the user, the current one while it has more than a minute left, a new one
+    # otherwise
+    def get_token(self, expires_in=3600):
+        now = datetime.utcnow()
+        if self.token and self.token_expiration > now + timedelta(seconds=60):
+            return self.token
+        self.token = secrets.token_urlsafe(24)
+        self.token_expiration = now + timedelta(seconds=expires_in)
+        db.session.add(self)
+        return self.token
+
+    # .METHOD() to REVOKE the API token by making it expired
+    def revoke_token(self):
+        self.token_expiration = datetime.utcnow() - timedelta(seconds=1)
+
+    # Returns the user the token belongs to, or None when the token is unknown or expired
+    @staticmethod
+    def check_token(token):
+        user = User.query.filter_by(token=token).first()
+        if user is None or user.token_expiration < datetime.utcnow():
+            return None
+        return user
+
     # .METHOD() to CREATE/PASS an avatar from gravatar that is unique based upon the email of a given user (digest)
     def avatar(self, size):
         digest = md5(self.email.lower().encode('utf-8')).hexdigest()
@@ -344,7 +492,8 @@ class Post(db.Model):
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
 
     # user_id initialized as a FOREIGN KEY to user.id (references id value from USERS table)(requires db.relationship())
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    # (indexed, so the posts of one user, and the newest of them, are found without scanning the whole table)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
 
     language = db.Column(db.String(5))
 
@@ -352,6 +501,18 @@ class Post(db.Model):
         return '<Post {}>'.format(self.body)
 
 
+# ----- SUGGESTION CLASS -----
+# A "who to follow" suggestion: suggested_id is followed by score of the users that user_id follows. Only the best
+# SUGGESTIONS_PER_USER of every user are stored, they are computed in batch by "flask suggestions refresh"
+class Suggestion(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    suggested_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    score = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):
+        return '<Suggestion {} -> {}>'.format(self.user_id, self.suggested_id)
+
+
 # -----FLASK-LOGIN EXTENSION-----
 # Works with the application's user model and expects certain properties and methods to be implemented (UserMixin)
 #
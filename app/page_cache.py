@@ -0,0 +1,160 @@
+import os
+import tempfile
+from hashlib import sha1
+from time import sleep, time
+from flask import current_app
+from app.metrics import record_cache
+
+
+# ------------------------------------------------ PAGE CACHE ----------------------------------------------------
+#
+# The explore feed is the same for every user, yet every request queried and rendered it again. The posts part of
+# the explore pages (the list of posts and the pager, _posts.html) is now kept in a cache shared by all the worker
+# processes: one file per page in PAGE_CACHE_DIR, written atomically. The rest of the page (navbar, greeting, flashed
+# messages) is personal and still rendered for every request, but without touching the posts.
+#
+# Every entry stores the validator it was built for (the newest post id, see app/conditional.py) and is:
+#
+#   fresh  -->  same validator and younger than PAGE_CACHE_TTL: served as is
+#   stale  -->  otherwise, as long as it is younger than PAGE_CACHE_TTL + PAGE_CACHE_STALE_TTL: ONE worker rebuilds
+#               it while all the others keep serving the stale copy (stale-while-revalidate)
+#   gone   -->  older than that, or missing: it has to be built before the page can be served
+#
+# Rebuilds are coalesced with a lock file created with O_CREAT | O_EXCL, which only one process can create: the
+# process that gets it rebuilds the entry, the others serve the stale copy, or wait up to PAGE_CACHE_WAIT seconds for
+# the new one when there is no copy to serve. A lock older than PAGE_CACHE_LOCK_TIMEOUT was left behind by a worker
+# that died while building, and is taken over.
+#
+# Only the first PAGE_CACHE_MAX_PAGE pages are cached (the view decides), so a crawler walking ?page=N cannot fill
+# the directory, and every worker removes the entries that are past their stale lifetime (they would be rebuilt
+# anyway), and temporary files or locks left behind, at most once per PAGE_CACHE_TTL + PAGE_CACHE_STALE_TTL.
+# ----------------------------------------------------------------------------------------------------------------
+
+
+class PageCache(object):
+    def __init__(self, directory, ttl, stale_ttl, wait=2.0, lock_timeout=30.0):
+        self.directory = directory
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.wait = wait
+        self.lock_timeout = lock_timeout
+        self.next_prune = 0.0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, sha1(repr(key).encode('utf-8')).hexdigest())
+
+    # Returns (validator, html, age) of the entry, or None when there is no entry
+    def _read(self, path):
+        try:
+            with open(path, encoding='utf-8') as f:
+                age = time() - os.fstat(f.fileno()).st_mtime
+                validator = f.readline().rstrip('\n')
+                return validator, f.read(), age
+        except FileNotFoundError:
+            return None
+
+    def _write(self, path, validator, html):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(validator + '\n')
+                f.write(html)
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def _lock(self, path):
+        lock = path + '.lock'
+        for _ in range(2):
+            try:
+                os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return True
+            except FileExistsError:
+                try:
+                    if time() - os.path.getmtime(lock) < self.lock_timeout:
+                        return False
+                    os.remove(lock)
+                except FileNotFoundError:
+                    pass
+        return False
+
+    def _unlock(self, path):
+        try:
+            os.remove(path + '.lock')
+        except FileNotFoundError:
+            pass
+
+    def _build(self, path, validator, build):
+        html = build()
+        self._write(path, validator, html)
+        return html
+
+    # Removes the entries too old to be served even as stale copies, and the leftovers of workers that died while
+    # writing an entry or holding a lock. Returns the number of files removed.
+    def prune(self):
+        now = time()
+        removed = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            max_age = self.lock_timeout if name.endswith('.lock') or name.startswith('.tmp-') \
+                else self.ttl + self.stale_ttl
+            try:
+                if now - os.path.getmtime(path) > max_age:
+                    os.remove(path)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
+
+    # Returns (html, fresh): fresh is False when a stale copy is served while another worker rebuilds it
+    def get(self, key, validator, build):
+        if time() >= self.next_prune:
+            self.next_prune = time() + self.ttl + self.stale_ttl
+            self.prune()
+        path = self._path(key)
+        validator = str(validator)
+        entry = self._read(path)
+        if entry is not None and entry[0] == validator and entry[2] < self.ttl:
+            return entry[1], True
+
+        if self._lock(path):
+            try:
+                return self._build(path, validator, build), True
+            finally:
+                self._unlock(path)
+
+        # Another worker is rebuilding this page
+        if entry is not None and entry[2] < self.ttl + self.stale_ttl:
+            return entry[1], False
+        deadline = time() + self.wait
+        while time() < deadline:
+            sleep(0.05)
+            entry = self._read(path)
+            if entry is not None and entry[0] == validator:
+                return entry[1], True
+        # The other worker is too slow, build it here rather than keep the request waiting
+        return self._build(path, validator, build), True
+
+
+# Returns the cached html of the fragment identified by key, building it with build() when needed. The second value
+# is False when the html is a stale copy, built for another validator.
+def cached_fragment(cache_name, key, validator, build):
+    cache = current_app.extensions['page_cache']
+    built = []
+
+    def counting_build():
+        built.append(True)
+        return build()
+
+    html, fresh = cache.get((cache_name,) + key, validator, counting_build)
+    record_cache(cache_name, not built)
+    return html, fresh
+
+
+def init_app(app):
+    app.extensions['page_cache'] = PageCache(app.config['PAGE_CACHE_DIR'], app.config['PAGE_CACHE_TTL'],
+                                             app.config['PAGE_CACHE_STALE_TTL'], app.config['PAGE_CACHE_WAIT'],
+                                             app.config['PAGE_CACHE_LOCK_TIMEOUT'])
@@ -0,0 +1,44 @@
+# ---------------------------------------------- KEYSET PAGINATION -----------------------------------------------
+#
+# paginate() asks the database for LIMIT per_page OFFSET (page - 1) * per_page, and to honour the OFFSET the database
+# has to walk through all the rows of the pages before: page 5000 of the followers of a popular account reads 100000
+# index entries to return 20. It also runs a COUNT of the whole list for the page numbers.
+#
+# Keyset pagination remembers where the page ended instead of how many rows came before it. The rows are ordered by a
+# unique key (a user id, a post id), the link to the next page carries the key of the last row (?after=1234) and the
+# next page is WHERE key > 1234 ORDER BY key LIMIT per_page, which an index on the key answers by seeking straight to
+# 1234. Every page costs the same, however deep it is. The link to the previous page carries the key of the first row
+# (?before=1200), and that page is read backwards (WHERE key < 1200 ORDER BY key DESC) and flipped.
+#
+# One row more than the page size is fetched to know whether there is a page after it, so no COUNT is needed.
+# ----------------------------------------------------------------------------------------------------------------
+
+
+class KeysetPage(object):
+    def __init__(self, items, first_key, last_key, has_next, has_prev):
+        self.items = items
+        self.first_key = first_key
+        self.last_key = last_key
+        self.has_next = has_next
+        self.has_prev = has_prev
+
+
+# Returns the page of query that comes after the key after, or before the key before, ordered by key. query returns
+# one row per key, and key_of(row) gives the key of a row.
+def keyset_page(query, key, key_of, per_page, after=None, before=None):
+    if before is not None:
+        rows = query.filter(key < before).order_by(key.desc()).limit(per_page + 1).all()
+        has_prev = len(rows) > per_page
+        rows = rows[:per_page][::-1]
+        has_next = True
+    else:
+        if after is not None:
+            query = query.filter(key > after)
+        rows = query.order_by(key).limit(per_page + 1).all()
+        has_next = len(rows) > per_page
+        rows = rows[:per_page]
+        has_prev = after is not None
+    if not rows:
+        # Past either end of the list, there is no key left to link from
+        return KeysetPage([], None, None, False, False)
+    return KeysetPage(rows, key_of(rows[0]), key_of(rows[-1]), has_next, has_prev)
@@ -0,0 +1,132 @@
+import cProfile
+import os
+import pstats
+import random
+from time import perf_counter, strftime
+from flask import current_app, g, request
+from flask_login import current_user
+
+
+# ----------------------------------------------- PROFILING ------------------------------------------------------
+#
+# When a page is slow in production the logs only tell us THAT it is slow, not where the time goes. This module runs
+# cProfile around a sample of the requests and writes each profile to PROFILE_DIR in two formats:
+#
+#   <name>.pstats     -->  the raw profile, it can be loaded with pstats or with tools such as snakeviz
+#   <name>.collapsed  -->  "collapsed stacks", one line per call path with its time in microseconds, which is the
+#                          input format of flamegraph.pl / speedscope / inferno to draw a flamegraph
+#
+# A request is profiled when:
+#
+#   1. random() < PROFILE_SAMPLE_RATE  (0 disables sampling, 0.01 profiles one request in a hundred), or
+#   2. it carries the PROFILE_HEADER header (X-Profile by default) AND the logged in user is one of the ADMINS
+#
+# Only the newest PROFILE_MAX_FILES profiles are kept, older ones are deleted as new ones are written.
+# ----------------------------------------------------------------------------------------------------------------
+
+
+def _wants_profile():
+    rate = current_app.config['PROFILE_SAMPLE_RATE']
+    if rate and random.random() < rate:
+        return True
+
+    # The header is checked first so that current_user (which may have to load the user) is only touched when needed
+    if request.headers.get(current_app.config['PROFILE_HEADER']):
+        return current_user.is_authenticated and current_user.email in current_app.config['ADMINS']
+    return False
+
+
+def _start_profile():
+    if _wants_profile():
+        g._profiler = cProfile.Profile()
+        g._profile_start = perf_counter()
+        g._profiler.enable()
+
+
+def _finish_profile(response):
+    profiler = g.pop('_profiler', None)
+    if profiler is None:
+        return response
+    profiler.disable()
+
+    elapsed_ms = (perf_counter() - g.pop('_profile_start')) * 1000
+    endpoint = (request.endpoint or 'unknown').replace('.', '-')
+    name = '{}-{}-{}-{:.0f}ms'.format(strftime('%Y%m%d-%H%M%S'), os.getpid(), endpoint, elapsed_ms)
+    try:
+        write_profile(profiler, current_app.config['PROFILE_DIR'], name)
+        rotate(current_app.config['PROFILE_DIR'], current_app.config['PROFILE_MAX_FILES'])
+    except OSError:
+        current_app.logger.exception('Could not write the profile of %s', request.path)
+    return response
+
+
+def write_profile(profiler, directory, name):
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    stats = pstats.Stats(profiler)
+    stats.dump_stats(os.path.join(directory, name + '.pstats'))
+    with open(os.path.join(directory, name + '.collapsed'), 'w') as f:
+        for stack, microseconds in collapsed_stacks(stats):
+            f.write('{} {}\n'.format(stack, microseconds))
+
+
+# Keep only the newest max_files profiles (a profile is the .pstats and .collapsed pair with the same name)
+def rotate(directory, max_files):
+    names = sorted({os.path.splitext(f)[0] for f in os.listdir(directory) if f.endswith(('.pstats', '.collapsed'))})
+    for name in names[:-max_files] if max_files else []:
+        for ext in ('.pstats', '.collapsed'):
+            path = os.path.join(directory, name + ext)
+            if os.path.exists(path):
+                os.remove(path)
+
+
+# ----------------------------------------- COLLAPSED STACKS -----------------------------------------------------
+#
+# cProfile does not record full call stacks, only caller -> callee edges with the time spent along each edge. To
+# draw a flamegraph the stacks are rebuilt by walking the call graph from the root functions down: the time of a
+# function is split between the paths that reach it in proportion to the time each calling edge accounts for. This
+# is the same approximation used by tools like flameprof, exact for call trees and close enough for everything else.
+
+def _label(func):
+    filename, line, name = func
+    return '{} ({}:{})'.format(name, os.path.basename(filename), line).replace(';', ',').replace(' ', '_')
+
+
+def collapsed_stacks(stats, max_depth=64):
+    callees = {}
+    for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+        for caller, edge in callers.items():
+            callees.setdefault(caller, []).append((func, edge[3]))
+
+    roots = [func for func, value in stats.stats.items() if not value[4]]
+    lines = {}
+
+    def walk(func, path, fraction):
+        cc, nc, tt, ct, callers = stats.stats[func]
+        path = path + [_label(func)]
+        own = int(tt * fraction * 1e6)
+        if own > 0:
+            key = ';'.join(path)
+            lines[key] = lines.get(key, 0) + own
+        if len(path) >= max_depth:
+            return
+        for callee, edge_ct in callees.get(func, ()):
+            total = stats.stats[callee][3]
+            if total <= 0 or _label(callee) in path:
+                continue
+            share = fraction * edge_ct / total
+            if share * total * 1e6 >= 1:
+                walk(callee, path, share)
+
+    for root in roots:
+        walk(root, [], 1.0)
+    return sorted(lines.items())
+
+
+def init_app(app):
+    app.config.setdefault('PROFILE_DIR', 'profiles')
+    app.config.setdefault('PROFILE_HEADER', 'X-Profile')
+    app.config.setdefault('PROFILE_MAX_FILES', 100)
+    app.config.setdefault('PROFILE_SAMPLE_RATE', 0.0)
+    app.before_request(_start_profile)
+    app.after_request(_finish_profile)
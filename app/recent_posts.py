@@ -0,0 +1,255 @@
+import os
+import tempfile
+import threading
+from collections import deque
+from flask import current_app
+from sqlalchemy.orm import joinedload
+from app import db
+from app.models import Post, User
+
+# fcntl only exists on Unix, elsewhere two workers publishing at the same instant could overwrite each other's value,
+# which at worst delays the other workers until the next change
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# --------------------------------------------- RECENT POSTS BUFFER ----------------------------------------------
+#
+# The first explore pages are by far the most requested ones, and they were loaded from the database every time.
+# Every worker now keeps the RECENT_POSTS_SIZE newest posts in memory, in a ring buffer (a deque with a maxlen: when
+# a new post goes in at the front, the oldest one falls off the back), together with the author fields the templates
+# need. The explore pages that fall inside the buffer are rendered from it without any query.
+#
+# The buffer is loaded when the worker handles its first request. The worker that creates a post puts it in its own
+# buffer right away. The other workers learn about it through a change feed: a small file (RECENT_POSTS_FEED) with
+# the newest post id and a "profiles epoch":
+#
+#   newest post id  -->  written by whoever creates posts (the index view, the group committer). A worker that sees
+#                        an id newer than the newest one it has loads the posts it is missing (id > its newest id,
+#                        a primary key range query)
+#   profiles epoch  -->  incremented when a user edits their profile (username, email and therefore avatar), which
+#                        changes how their posts are shown. A worker that sees a new epoch reloads the whole buffer
+#
+# Checking the feed costs one stat() per request, the file is only read when it has changed.
+#
+# Post ids are handed out when the posts are inserted, but they become visible when they are committed, and with
+# concurrent writers (two workers, the group committer) a post can be committed after a post with a higher id. So
+# when the feed changes, the posts are read from ID_WINDOW ids below the newest id the buffer has, and the ones it
+# does not hold yet are merged in. A post that becomes visible more than ID_WINDOW ids late is never picked up by
+# the other workers until their next reload (the next profiles epoch or restart).
+# ----------------------------------------------------------------------------------------------------------------
+
+
+# The author of a buffered post, with what _post.html shows about it
+class RecentAuthor(object):
+    __slots__ = ('id', 'username', 'email')
+
+    def __init__(self, user):
+        self.id = user.id
+        self.username = user.username
+        self.email = user.email
+
+    avatar = User.avatar
+
+
+class RecentPost(object):
+    __slots__ = ('id', 'body', 'timestamp', 'language', 'user_id', 'author')
+
+    def __init__(self, post, author):
+        self.id = post.id
+        self.body = post.body
+        self.timestamp = post.timestamp
+        self.language = post.language
+        self.user_id = post.user_id
+        self.author = author
+
+
+# How far below the newest id of the buffer the change feed looks for posts committed late
+ID_WINDOW = 100
+
+
+# Explore shows the posts newest first, by timestamp
+def _order(post):
+    return post.timestamp, post.id
+
+
+class RecentPosts(object):
+    def __init__(self, size, feed_path):
+        self.size = size
+        self.feed_path = feed_path
+        self.lock = threading.Lock()
+        self.posts = deque(maxlen=size)
+        # Readers use this immutable copy of the buffer, so they never need the lock
+        self.snapshot = ()
+        self.max_id = 0
+        self.epoch = 0
+        # True when the buffer holds every post there is, so pages past its end are known to be empty
+        self.complete = False
+        self.loaded = False
+        self.feed_stat = None
+        directory = os.path.dirname(feed_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    # --- change feed ---
+
+    def _read_feed(self):
+        try:
+            with open(self.feed_path) as f:
+                newest, epoch = f.read().split()
+                return int(newest), int(epoch)
+        except (OSError, ValueError):
+            return 0, 0
+
+    def _stat_feed(self):
+        try:
+            st = os.stat(self.feed_path)
+            return st.st_ino, st.st_mtime_ns, st.st_size
+        except FileNotFoundError:
+            return None
+
+    # Returns the stat of the feed that was written when the feed was at the stat seen before (nobody else changed it
+    # since this worker last read it), None otherwise
+    def _publish(self, newest=0, bump_epoch=False, seen=False):
+        lock_file = open(self.feed_path + '.lock', 'a')
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            unchanged = self._stat_feed() == seen
+            current_newest, epoch = self._read_feed()
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.feed_path) or '.', prefix='.tmp-')
+            with os.fdopen(fd, 'w') as f:
+                f.write('{} {}'.format(max(current_newest, newest), epoch + 1 if bump_epoch else epoch))
+            os.replace(tmp, self.feed_path)
+            return self._stat_feed() if unchanged else None
+        finally:
+            lock_file.close()
+
+    # --- loading ---
+
+    def _query(self):
+        return Post.query.options(joinedload(Post.author))
+
+    def _wrap(self, posts):
+        authors = {}
+        wrapped = []
+        for post in posts:
+            author = authors.get(post.user_id)
+            if author is None:
+                author = authors[post.user_id] = RecentAuthor(post.author)
+            wrapped.append(RecentPost(post, author))
+        return wrapped
+
+    def _reload(self, epoch):
+        posts = self._wrap(self._query().order_by(Post.timestamp.desc(), Post.id.desc()).limit(self.size))
+        self.posts = deque(posts, maxlen=self.size)
+        self.max_id = max((post.id for post in posts), default=0)
+        self.complete = len(posts) < self.size
+        self.epoch = epoch
+        self.loaded = True
+
+    def _merge(self, new):
+        present = {post.id for post in self.posts}
+        new = [post for post in new if post.id not in present]
+        if not new:
+            return
+        new.sort(key=_order)
+        self.complete = self.complete and len(self.posts) + len(new) <= self.size
+        if not self.posts or _order(new[0]) > _order(self.posts[0]):
+            # The usual case, the new posts are all newer than the buffer: push them at the front
+            self.posts.extendleft(new)
+        else:
+            # A deque with a maxlen keeps the items at its right end, the oldest ones here, so it is cut first
+            merged = sorted(list(self.posts) + new, key=_order, reverse=True)
+            self.posts = deque(merged[:self.size], maxlen=self.size)
+        self.max_id = max(self.max_id, max(post.id for post in new))
+
+    # Brings the buffer up to date with the change feed
+    def sync(self):
+        stat = self._stat_feed()
+        if self.loaded and stat == self.feed_stat:
+            return
+        with self.lock:
+            _, epoch = self._read_feed()
+            if not self.loaded or epoch != self.epoch:
+                self._reload(epoch)
+            else:
+                # Also when the newest id did not move: a post with a lower id may just have been committed
+                self._merge(self._wrap(self._query().filter(Post.id > self.max_id - ID_WINDOW)))
+            self.feed_stat = stat
+            self.snapshot = tuple(self.posts)
+
+    # --- writers ---
+
+    # A post created by this worker goes straight into its buffer, and the other workers are told about it. When no
+    # other worker changed the feed in the meantime, this worker's own change needs no query to catch up with.
+    def add(self, post):
+        with self.lock:
+            if self.loaded:
+                self._merge([RecentPost(post, RecentAuthor(post.author))])
+                self.snapshot = tuple(self.posts)
+            seen = self.feed_stat if self.loaded else False
+        written = self._publish(newest=post.id, seen=seen)
+        with self.lock:
+            if written is not None and self.feed_stat == seen:
+                self.feed_stat = written
+
+    def posts_created(self, newest):
+        self._publish(newest=newest)
+
+    def profile_changed(self):
+        self._publish(bump_epoch=True)
+
+    # --- readers ---
+
+    def newest_id(self):
+        self.sync()
+        return self.max_id or None
+
+    # Returns (posts, has_next) for the page, or None when the page goes past the end of the buffer
+    def page(self, page, per_page):
+        self.sync()
+        snapshot = self.snapshot
+        start = (page - 1) * per_page
+        end = start + per_page
+        if end <= len(snapshot):
+            return list(snapshot[start:end]), end < len(snapshot) or not self.complete
+        if self.complete:
+            return list(snapshot[start:end]), False
+        return None
+
+
+def get():
+    return current_app.extensions.get('recent_posts')
+
+
+# Called after posts are committed, they do nothing when the buffer is not enabled
+def post_created(post):
+    buffer = get()
+    if buffer is not None:
+        buffer.add(post)
+
+
+def posts_created():
+    buffer = get()
+    if buffer is not None:
+        buffer.posts_created(db.session.query(db.func.max(Post.id)).scalar() or 0)
+
+
+def profile_changed():
+    buffer = get()
+    if buffer is not None:
+        buffer.profile_changed()
+
+
+def init_app(app):
+    buffer = RecentPosts(app.config['RECENT_POSTS_SIZE'], app.config['RECENT_POSTS_FEED'])
+    app.extensions['recent_posts'] = buffer
+
+    # Loaded by the first request of every worker, rather than by create_app(), which also runs for the flask commands
+    # (flask db upgrade runs before the tables even exist)
+    @app.before_first_request
+    def load_recent_posts():
+        buffer.sync()
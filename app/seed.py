@@ -0,0 +1,167 @@
+import math
+import random
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from itertools import accumulate
+from werkzeug.security import generate_password_hash
+from app import db
+from app.counters import reconcile
+from app.models import User, Post, followers
+
+
+# ---------------------------------------------- SYNTHETIC DATA --------------------------------------------------
+#
+# tests.py creates four users and four posts, which is fine for checking that the code is correct but says nothing
+# about how the application behaves with a real amount of data. The functions below generate a synthetic but
+# realistic dataset:
+#
+#   users      -->  N users called user<id>, all with the same password (hashing a password on purpose takes a long
+#                   time, so it is hashed once and the hash is shared by every seeded user)
+#   followers  -->  a power-law graph: the number of users each user follows is drawn from a Pareto distribution
+#                   (most follow a few, a handful follow very many) and who they follow is chosen by popularity, so a
+#                   few accounts end up with a huge number of followers, like on any real social network
+#   posts      -->  M posts, written mostly by the popular users, with timestamps that get denser towards the
+#                   present and follow a day/night cycle, in a mix of languages
+#
+# Everything is written with bulk inserts (executemany in chunks of CHUNK rows) instead of ORM objects, which is what
+# makes it possible to load a million posts in well under a minute.
+# ----------------------------------------------------------------------------------------------------------------
+
+CHUNK = 20000
+
+# Language codes and the share of the posts that are written in each one
+LANGUAGES = (('en', 0.70), ('fr', 0.15), ('es', 0.10), ('de', 0.05))
+
+PHRASES = {
+    'en': ('Just finished a great book', 'Coffee first, then code', 'What a beautiful morning',
+           'Shipping a new feature today', 'Anyone going to the meetup tonight?', 'Learning something new every day'),
+    'fr': ('Je viens de finir un super livre', "D'abord le café, ensuite le code", 'Quelle belle matinée',
+           'Une nouvelle fonctionnalité aujourd\'hui', 'Qui vient à la soirée ce soir ?'),
+    'es': ('Acabo de terminar un gran libro', 'Primero el café, luego el código', 'Qué mañana tan bonita',
+           'Hoy publicamos una nueva función', '¿Alguien va a la reunión esta noche?'),
+    'de': ('Gerade ein tolles Buch beendet', 'Erst Kaffee, dann Code', 'Was für ein schöner Morgen',
+           'Heute gibt es ein neues Feature'),
+}
+
+
+# Cumulative popularity weights that follow Zipf's law: the user of rank r gets a weight of 1 / r^exponent. The
+# ranks are shuffled so that popularity is not simply the order in which the users were created.
+def popularity(user_ids, rng, exponent=1.0):
+    ranked = list(user_ids)
+    rng.shuffle(ranked)
+    weights = [1.0 / (rank ** exponent) for rank in range(1, len(ranked) + 1)]
+    return ranked, list(accumulate(weights))
+
+
+def pick(ranked, cum_weights, rng):
+    return ranked[bisect_left(cum_weights, rng.random() * cum_weights[-1])]
+
+
+# Rows are handed straight to the executemany() of the database driver. Going through session.execute() would work
+# too, but SQLAlchemy then processes every parameter of every row in Python, which costs more than the insert itself
+# when there are millions of rows. The drivers convert ints, strings and datetimes on their own.
+def _insert(table, rows):
+    if not rows:
+        return
+    keys = list(rows[0])
+    compiled = table.insert().compile(dialect=db.engine.dialect, column_keys=keys)
+    cursor = db.session.connection().connection.cursor()
+    try:
+        for i in range(0, len(rows), CHUNK):
+            chunk = rows[i:i + CHUNK]
+            if compiled.positional:
+                chunk = [tuple(row[key] for key in compiled.positiontup) for row in chunk]
+            cursor.executemany(str(compiled), chunk)
+    finally:
+        cursor.close()
+
+
+def seed_users(count, password, rng, now):
+    start = (db.session.query(db.func.max(User.id)).scalar() or 0) + 1
+    password_hash = generate_password_hash(password)
+    rows = [{'id': i,
+             'username': 'user{}'.format(i),
+             'email': 'user{}@example.com'.format(i),
+             'password_hash': password_hash,
+             'last_seen': now - timedelta(minutes=rng.randrange(60 * 24 * 30)),
+             'graph_version': 0,
+             'followers_count': 0,
+             'followed_count': 0,
+             'posts_count': 0,
+             'followed_version': 0}
+            for i in range(start, start + count)]
+    _insert(User.__table__, rows)
+    return list(range(start, start + count))
+
+
+# Each user follows a Pareto distributed number of users (the mean of Pareto(alpha) scaled by xm is
+# xm * alpha / (alpha - 1), so xm is chosen to make the mean equal to avg_follows), picked by popularity
+def seed_followers(user_ids, avg_follows, rng, alpha=2.0):
+    if len(user_ids) < 2 or avg_follows <= 0:
+        return 0
+    ranked, cum_weights = popularity(user_ids, rng)
+    xm = avg_follows * (alpha - 1) / alpha
+    rows = []
+    for follower in user_ids:
+        degree = min(int(xm * rng.paretovariate(alpha)), len(user_ids) - 1)
+        followed = set()
+        # Popular users are picked over and over, so give up after a bounded number of attempts
+        for _ in range(degree * 3):
+            if len(followed) >= degree:
+                break
+            candidate = pick(ranked, cum_weights, rng)
+            if candidate != follower:
+                followed.add(candidate)
+        rows.extend({'follower_id': follower, 'followed_id': f} for f in followed)
+    _insert(followers, rows)
+    return len(rows)
+
+
+# Timestamps: the day is an exponential decay backwards from today (mean age of days / 4, capped to days), and the
+# time of the day is drawn from a day/night curve so that there are few posts at night and a peak in the evening
+def _timestamp(rng, today, days, hour_weights):
+    age = int(min(rng.expovariate(4.0 / days), days))
+    hour = bisect_left(hour_weights, rng.random() * hour_weights[-1])
+    return today - timedelta(days=age, seconds=-(hour * 3600 + int(rng.random() * 3600)))
+
+
+def seed_posts(user_ids, count, days, rng, now):
+    if not user_ids or count <= 0:
+        return 0
+    ranked, cum_weights = popularity(user_ids, rng, exponent=0.8)
+    hour_weights = list(accumulate(1.2 + math.sin((h - 14) * math.pi / 12) for h in range(24)))
+    language_weights = list(accumulate(share for _, share in LANGUAGES))
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    for start in range(0, count, CHUNK):
+        rows = []
+        for _ in range(min(CHUNK, count - start)):
+            language = LANGUAGES[bisect_left(language_weights, rng.random() * language_weights[-1])][0]
+            phrases = PHRASES[language]
+            # Posts of today may land later in the day than now, those are moved back to now
+            rows.append({'body': '{} #{}'.format(phrases[int(rng.random() * len(phrases))],
+                                                 int(rng.random() * 100000)),
+                         'timestamp': min(_timestamp(rng, today, days, hour_weights), now),
+                         'user_id': pick(ranked, cum_weights, rng),
+                         'language': language})
+        _insert(Post.__table__, rows)
+    return count
+
+
+def seed(users, posts, avg_follows=20, days=90, password='password', random_seed=None):
+    rng = random.Random(random_seed)
+    now = datetime.utcnow()
+
+    user_ids = seed_users(users, password, rng, now)
+    edges = seed_followers(user_ids, avg_follows, rng)
+    written = seed_posts(user_ids, posts, days, rng, now)
+
+    # The user ids were given explicitly, so on PostgreSQL the sequence behind user.id has to be moved past them
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute("SELECT setval(pg_get_serial_sequence('user', 'id'), (SELECT max(id) FROM \"user\"))")
+
+    db.session.commit()
+
+    # The rows were inserted without going through the models, so the counters of the users are computed at the end
+    reconcile(fix=True)
+    return len(user_ids), edges, written
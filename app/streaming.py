@@ -0,0 +1,91 @@
+from flask import Response, before_render_template, current_app, stream_with_context, template_rendered
+from jinja2 import Markup
+from sqlalchemy.orm import joinedload
+from app.models import Post
+
+
+# ------------------------------------------- STREAMED FEED PAGES ------------------------------------------------
+#
+# render_template() builds the whole page in memory before the first byte is sent, so with a large POSTS_PER_PAGE
+# the browser stares at a blank page while the posts are loaded and rendered. With STREAMING_FEEDS set, the feed
+# pages (index, explore and the user pages) are sent with stream_template() instead:
+#
+#   - the page is rendered with Jinja's generate(), which produces the output piece by piece
+#   - the templates mark the points where what has been rendered so far should go out with {{ stream_flush }}:
+#     after the navbar (so the head, styles and navbar reach the browser before the posts are even queried) and
+#     after every post. Outside of stream_template() the variable is undefined and renders as nothing
+#   - the posts come from a StreamedPage, which runs the query when the template starts looping over it and fetches
+#     the rows in batches with yield_per() (a server-side cursor on PostgreSQL, stream_results), with the authors
+#     loaded in the same query. It fetches one post more than the page size to know if there is a next page, instead
+#     of the extra COUNT query of paginate(), so next_url is only known once the posts have been rendered, which
+#     is fine because the pager comes after them in the templates
+#
+# The query count, SQL time and template time of the access log and of the metrics are recorded when the view
+# returns, so for streamed pages they do not include the work done while the body is sent.
+# ----------------------------------------------------------------------------------------------------------------
+
+FLUSH_MARKER = '<!--stream-flush-->'
+YIELD_PER = 10
+
+
+# Groups the small strings produced by Jinja into one chunk per flush point
+def _chunks(fragments):
+    buffer = []
+    for fragment in fragments:
+        if FLUSH_MARKER in fragment:
+            buffer.append(fragment.replace(FLUSH_MARKER, ''))
+            yield ''.join(buffer)
+            buffer = []
+        else:
+            buffer.append(fragment)
+    if buffer:
+        yield ''.join(buffer)
+
+
+# The streaming counterpart of render_template(), it returns a streamed response
+def stream_template(template_name, **context):
+    app = current_app._get_current_object()
+    app.update_template_context(context)
+    context['stream_flush'] = Markup(FLUSH_MARKER)
+    template = app.jinja_env.get_template(template_name)
+
+    def generate():
+        before_render_template.send(app, template=template, context=context)
+        for chunk in _chunks(template.generate(context)):
+            yield chunk
+        template_rendered.send(app, template=template, context=context)
+
+    # stream_with_context keeps the request (current_user, g, the database session) alive while the body is sent
+    return Response(stream_with_context(generate()), mimetype='text/html')
+
+
+# Truthy once the page has been iterated and a next page exists, renders as the URL of that page
+class _NextURL(object):
+    def __init__(self, page, url):
+        self.page = page
+        self.url = url
+
+    def __bool__(self):
+        return self.page.has_next
+
+    def __str__(self):
+        return self.url if self.page.has_next else ''
+
+
+class StreamedPage(object):
+    def __init__(self, query, page, per_page):
+        self.query = query.options(joinedload(Post.author))
+        self.page = max(page, 1)
+        self.per_page = per_page
+        self.has_next = False
+
+    def __iter__(self):
+        rows = self.query.limit(self.per_page + 1).offset((self.page - 1) * self.per_page).yield_per(YIELD_PER)
+        for i, post in enumerate(rows):
+            if i == self.per_page:
+                self.has_next = True
+                break
+            yield post
+
+    def next_url(self, url):
+        return _NextURL(self, url)
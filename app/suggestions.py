@@ -0,0 +1,158 @@
+import heapq
+from collections import Counter
+from sqlalchemy import bindparam
+from app import db
+from app.graph import SocialGraph
+from app.models import Suggestion, User
+
+# numpy and scipy are in requirements.txt and the sparse matrix product below is what normally runs. The pure Python
+# path is only a fallback for an install without them, it gives the same result but is several times slower on large
+# graphs ("flask suggestions refresh" says which one it used)
+try:
+    import numpy
+    from scipy import sparse
+except ImportError:
+    numpy = None
+    sparse = None
+
+
+# ----------------------------------------------- WHO TO FOLLOW --------------------------------------------------
+#
+# The only way to discover users was the explore page. The home page now suggests users to follow, ranked by the
+# number of shared connections: the score of C for user U is the number of users that U follows who follow C
+# ("friends of friends"), leaving out U itself and the users U already follows.
+#
+# With A the adjacency matrix of the graph (A[u, v] = 1 when u follows v), the scores of every user are the rows of
+# the sparse matrix product A x A, which scipy computes in C. Rows are multiplied BATCH users at a time so that the
+# product never has to exist for the whole graph at once, and only the best SUGGESTIONS_PER_USER of every row are
+# kept, in the suggestion table.
+#
+# "flask suggestions refresh" (run it from cron) only recomputes what may have changed. The suggestions of a user are
+# computed from what the user follows and what those users follow, so when someone follows or unfollows, their own
+# suggestions and those of their followers are affected. Every user records the followed_version its suggestions were
+# computed at (suggestions_version), the users whose followed_version moved since are the ones that changed, and the
+# refresh recomputes them and their followers. Gaining a follower does not change followed_version, so the followers
+# of a popular account are not all recomputed every time it gets one more. --full recomputes everyone.
+# ----------------------------------------------------------------------------------------------------------------
+
+BATCH = 2000
+
+# Users whose suggestions are written together (also the size of the IN (...) list of their DELETE)
+STORE_CHUNK = 500
+
+
+def backend():
+    return 'scipy' if sparse is not None else 'python'
+
+
+# Yields (user_id, [(suggested_id, score), ...]) with at most per_user suggestions per user, best score first (ties go
+# to the lower id), for the given user ids
+def _compute_python(graph, user_ids, per_user):
+    for user_id in user_ids:
+        followed = graph.following(user_id)
+        scores = Counter()
+        for other in followed:
+            scores.update(graph.following(other))
+        scores.pop(user_id, None)
+        for other in followed:
+            scores.pop(other, None)
+        yield user_id, heapq.nsmallest(per_user, scores.items(), key=lambda item: (-item[1], item[0]))
+
+
+def _compute_scipy(graph, user_ids, per_user):
+    offsets, targets = graph.following_arrays()
+    size = len(offsets) - 1
+    adjacency = sparse.csr_matrix((numpy.ones(len(targets), dtype=numpy.int32),
+                                   numpy.frombuffer(targets, dtype=numpy.int32),
+                                   numpy.frombuffer(offsets, dtype=numpy.int64)), shape=(size, size))
+    # Users created after the graph was loaded follow nobody in it
+    for user_id in user_ids:
+        if user_id >= size:
+            yield user_id, []
+    user_ids = numpy.array([user_id for user_id in user_ids if user_id < size], dtype=numpy.int64)
+
+    for start in range(0, len(user_ids), BATCH):
+        rows = user_ids[start:start + BATCH]
+        followed = adjacency[rows]
+        scores = (followed @ adjacency).tocsr()
+        # Drop what the users already follow and themselves: the mask has a 1 on those entries, and subtracting the
+        # masked scores leaves explicit zeros that eliminate_zeros() removes
+        own = sparse.csr_matrix((numpy.ones(len(rows), dtype=numpy.int32), (numpy.arange(len(rows)), rows)),
+                                shape=scores.shape)
+        mask = followed + own
+        scores = scores - scores.multiply(mask > 0)
+        scores.eliminate_zeros()
+        for i, user_id in enumerate(rows.tolist()):
+            lo, hi = scores.indptr[i], scores.indptr[i + 1]
+            columns, values = scores.indices[lo:hi], scores.data[lo:hi]
+            # Only the entries that score at least as much as the per_user-th best are sorted, a partial sort
+            # (numpy.partition) finds that score in linear time
+            if hi - lo > per_user:
+                kth = numpy.partition(values, hi - lo - per_user)[hi - lo - per_user]
+                candidates = numpy.flatnonzero(values >= kth)
+                columns, values = columns[candidates], values[candidates]
+            best = numpy.lexsort((columns, -values))[:per_user]
+            yield user_id, list(zip(columns[best].tolist(), values[best].tolist()))
+
+
+def compute(graph, user_ids, per_user):
+    if sparse is not None:
+        return _compute_scipy(graph, user_ids, per_user)
+    return _compute_python(graph, user_ids, per_user)
+
+
+def _store_chunk(chunk, versions, full):
+    table = Suggestion.__table__
+    user_ids = [user_id for user_id, _ in chunk]
+    rows = [{'user_id': user_id, 'suggested_id': suggested, 'score': score}
+            for user_id, suggestions in chunk for suggested, score in suggestions]
+    if not full:
+        db.session.execute(table.delete().where(table.c.user_id.in_(user_ids)))
+    if rows:
+        db.session.execute(table.insert(), rows)
+    db.session.execute(User.__table__.update().where(User.id == bindparam('refreshed_id'))
+                       .values(suggestions_version=bindparam('version')),
+                       [{'refreshed_id': user_id, 'version': versions[user_id]} for user_id in user_ids])
+    return len(rows)
+
+
+# The suggestions are written STORE_CHUNK users at a time while they are computed, so that the rows of the whole graph
+# never sit in memory, and committed at the end, all at once
+def _store(results, versions, full):
+    if full:
+        db.session.execute(Suggestion.__table__.delete())
+    written = 0
+    chunk = []
+    for result in results:
+        chunk.append(result)
+        if len(chunk) == STORE_CHUNK:
+            written += _store_chunk(chunk, versions, full)
+            chunk = []
+    if chunk:
+        written += _store_chunk(chunk, versions, full)
+    db.session.commit()
+    return written
+
+
+# Recomputes the suggestions of the users that need it (of every user with full=True). Returns the number of users
+# refreshed and the number of suggestions written.
+def refresh(per_user, full=False):
+    # The versions are read before the graph: a follow committed in between is in the graph but leaves the user with
+    # a newer followed_version than the one recorded, so it is simply computed again next time
+    users = db.session.query(User.id, User.followed_version, User.suggestions_version).all()
+    versions = {user_id: version for user_id, version, _ in users}
+    changed = [user_id for user_id, version, computed in users if computed is None or computed != version]
+    if not full and not changed:
+        return 0, 0
+    graph = SocialGraph.load()
+
+    if full:
+        affected = set(versions)
+    else:
+        affected = set(changed)
+        for user_id in changed:
+            affected.update(graph.followers(user_id))
+        affected &= set(versions)
+
+    written = _store(compute(graph, sorted(affected), per_user), versions, full)
+    return len(affected), written
@@ -0,0 +1,57 @@
+import os
+import tempfile
+from jinja2 import FileSystemBytecodeCache, TemplateError
+
+
+# ------------------------------------------- TEMPLATE BYTECODE CACHE --------------------------------------------
+#
+# Jinja compiles every template to Python code the first time it is used, and every worker process does it again:
+# base.html, index.html, _post.html and the Flask-Bootstrap templates they extend are all compiled on the first
+# requests of a fresh worker, which makes those requests noticeably slower.
+#
+# With TEMPLATE_CACHE_DIR set, the compiled bytecode is stored in that directory and shared by all the workers (and
+# kept across restarts), so a template is compiled once per deploy instead of once per worker. Jinja checks the
+# source of the template against the cached entry, so an edited template is recompiled automatically.
+#
+# "flask templates compile" fills the cache at deploy time, and with TEMPLATE_WARMUP set create_app() loads every
+# template into memory before the application starts accepting requests (see compile_templates() below).
+# ----------------------------------------------------------------------------------------------------------------
+
+
+# Jinja writes the cache files in place, so a worker could read a file that another worker is halfway through
+# writing. Writing to a temporary file and renaming it over the real one means readers only ever see complete files.
+class AtomicFileSystemBytecodeCache(FileSystemBytecodeCache):
+    def dump_bytecode(self, bucket):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                bucket.write_bytecode(f)
+            os.replace(tmp, self._get_cache_filename(bucket))
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+
+# Loads (and therefore compiles) every template the application can render, its own and those of the extensions.
+# Returns the names of the templates that were compiled and a list of (name, error) for those that failed. Any
+# template error (a syntax error, a template that cannot be found) only fails that template, the warmup goes on.
+def compile_templates(app):
+    compiled = []
+    errors = []
+    for name in app.jinja_env.list_templates():
+        try:
+            app.jinja_env.get_template(name)
+            compiled.append(name)
+        except TemplateError as e:
+            errors.append((name, e))
+    return compiled, errors
+
+
+def init_app(app):
+    directory = app.config['TEMPLATE_CACHE_DIR']
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        # The Jinja environment already exists at this point (the extensions added their globals to it), so the cache
+        # is set on it directly rather than through app.jinja_options
+        app.jinja_env.bytecode_cache = AtomicFileSystemBytecodeCache(directory)
@@ -1,6 +1,8 @@
 import json
 import requests
+from time import perf_counter
 from flask import current_app
+from app.metrics import observe_translate
 
 
 def translate(text, source_language, dest_language):
@@ -10,8 +12,13 @@ def translate(text, source_language, dest_language):
 
     auth = {'Ocp-Apim-Subscription-Key': current_app.config['MS_TRANSLATOR_KEY']}
 
-    r = requests.get('https://api.microsofttranslator.com/v2/Ajax.svc'
-                     '/Translate?text={}&from={}&to={}'.format(text, source_language, dest_language), headers=auth)
+    # The call to the translation service is timed, it is the slowest dependency the application has
+    start = perf_counter()
+    try:
+        r = requests.get('https://api.microsofttranslator.com/v2/Ajax.svc'
+                         '/Translate?text={}&from={}&to={}'.format(text, source_language, dest_language), headers=auth)
+    finally:
+        observe_translate(perf_counter() - start)
 
     if r.status_code != 200:
         return 'Error: the translation service failed.'
@@ -0,0 +1,6 @@
+# Performance benchmarks for the microblog. They are not unit tests: each module is a script that is run on its own,
+# from the top-level directory, for example:
+#
+#   >>>   python -m benchmarks.group_commit
+#
+# All of them build their own throw-away database, so they never touch app.db.
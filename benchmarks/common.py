@@ -0,0 +1,46 @@
+import math
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from app import create_app, db
+from config import Config
+
+
+# Helpers shared by the benchmark scripts
+
+
+# Creates an application bound to a brand new SQLite file in a temporary directory (deleted on exit), with the tables
+# already created. The optional components are on or off as in the configuration (TESTING does not turn them off), with
+# their files in the same temporary directory. Extra keyword arguments override the configuration.
+@contextmanager
+def temporary_app(**overrides):
+    tmpdir = tempfile.mkdtemp(prefix='microblog-bench-')
+
+    class BenchConfig(Config):
+        TESTING = True
+        SECRET_KEY = 'benchmark'
+        WTF_CSRF_ENABLED = False
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(tmpdir, 'bench.db')
+        ACCESS_LOG_PATH = os.path.join(tmpdir, 'access.log')
+        PAGE_CACHE_DIR = os.path.join(tmpdir, 'pages')
+        RECENT_POSTS_FEED = os.path.join(tmpdir, 'recent_posts.feed')
+
+    for key, value in overrides.items():
+        setattr(BenchConfig, key, value)
+
+    try:
+        app = create_app(BenchConfig)
+        with app.app_context():
+            db.create_all()
+        yield app
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+# Nearest-rank percentile of an already sorted list
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    rank = max(int(math.ceil(p / 100.0 * len(sorted_values))), 1)
+    return sorted_values[min(rank, len(sorted_values)) - 1]
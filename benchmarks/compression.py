@@ -0,0 +1,102 @@
+import argparse
+import json
+import zlib
+from time import perf_counter
+from app.seed import seed
+from benchmarks.common import percentile, temporary_app
+
+
+# ----------------------------------------- COMPRESSION BENCHMARK ------------------------------------------------
+#
+# Shows the CPU versus bandwidth tradeoff of the response compression (app/compression.py) on real pages of the
+# application: the index, explore and user pages of a seeded database are rendered once, and then compressed at every
+# zlib level. For every page and level it reports:
+#
+#   ratio     -->  uncompressed size / compressed size
+#   cpu us    -->  median time to compress the page (what every request pays on the server)
+#   net ms    -->  time saved sending the page over a --bandwidth link, minus the time spent compressing it. Positive
+#                  means compression makes the page arrive sooner.
+#
+# The "stream" column is the size when the page is sent as --chunks streamed pieces, each followed by a sync flush
+# (the way streamed responses are compressed), to show what flushing every chunk costs in ratio.
+#
+#   >>>   python -m benchmarks.compression --bandwidth 10 --output compression.json
+# ----------------------------------------------------------------------------------------------------------------
+
+PAGES = ('/index', '/explore', '/user/user1')
+
+
+def render_pages(users, posts):
+    with temporary_app(COMPRESSION_ENABLED=False) as app:
+        with app.app_context():
+            seed(users, posts, random_seed=1)
+        client = app.test_client()
+        client.post('/auth/login', data={'username': 'user1', 'password': 'password'})
+        return {path: client.get(path).get_data() for path in PAGES}
+
+
+def compress(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress_streamed(data, level, chunks):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    size = max(len(data) // chunks, 1)
+    out = [compressor.compress(data[i:i + size]) + compressor.flush(zlib.Z_SYNC_FLUSH)
+           for i in range(0, len(data), size)]
+    out.append(compressor.flush())
+    return b''.join(out)
+
+
+def measure(data, level, repeat, bandwidth, chunks):
+    samples = []
+    for _ in range(repeat):
+        start = perf_counter()
+        compressed = compress(data, level)
+        samples.append(perf_counter() - start)
+    samples.sort()
+    cpu = percentile(samples, 50)
+    bytes_per_second = bandwidth * 1e6 / 8
+    saved = (len(data) - len(compressed)) / bytes_per_second
+    return {
+        'bytes': len(compressed),
+        'ratio': len(data) / len(compressed),
+        'cpu_seconds': cpu,
+        'net_seconds': saved - cpu,
+        'streamed_bytes': len(compress_streamed(data, level, chunks)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='CPU versus bandwidth tradeoff of gzip response compression.')
+    parser.add_argument('--users', type=int, default=200, help='seeded users')
+    parser.add_argument('--posts', type=int, default=5000, help='seeded posts')
+    parser.add_argument('--levels', default='1,3,6,9', help='comma separated zlib levels')
+    parser.add_argument('--bandwidth', type=float, default=10.0, help='client bandwidth in Mbit/s')
+    parser.add_argument('--chunks', type=int, default=10, help='pieces a streamed page is sent in')
+    parser.add_argument('--repeat', type=int, default=200, help='compressions timed per page and level')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    pages = render_pages(args.users, args.posts)
+    levels = [int(level) for level in args.levels.split(',')]
+    results = {}
+    print('{:<14} {:>8} {:>6} {:>9} {:>7} {:>9} {:>9} {:>9}'.format(
+        'page', 'bytes', 'level', 'gzipped', 'ratio', 'cpu us', 'net ms', 'stream'))
+    for path, data in pages.items():
+        results[path] = {'bytes': len(data), 'levels': {}}
+        for level in levels:
+            r = measure(data, level, args.repeat, args.bandwidth, args.chunks)
+            results[path]['levels'][level] = r
+            print('{:<14} {:>8} {:>6} {:>9} {:>6.1f}x {:>9.1f} {:>+9.2f} {:>9}'.format(
+                path, len(data), level, r['bytes'], r['ratio'], r['cpu_seconds'] * 1e6, r['net_seconds'] * 1000,
+                r['streamed_bytes']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'parameters': vars(args), 'pages': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
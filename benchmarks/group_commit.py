@@ -0,0 +1,77 @@
+import argparse
+import threading
+from time import perf_counter
+from app import db
+from app.group_commit import group_commit
+from app.models import User, Post
+from benchmarks.common import temporary_app
+
+
+# ---------------------------------------- GROUP COMMIT BENCHMARK ------------------------------------------------
+#
+# Simulates a burst of concurrent post submissions and reports how many posts per second are committed:
+#
+#   1. direct   -->  every "request" adds its post to the session and commits it (one fsync per post)
+#   2. group    -->  every "request" hands its post to the group committer and waits until its batch is durable
+#
+# The database is a real SQLite file in a temporary directory, since an in-memory database never fsyncs and would
+# hide exactly the cost that group commit is meant to remove.
+#
+#   >>>   python -m benchmarks.group_commit --threads 32 --posts 50
+# ----------------------------------------------------------------------------------------------------------------
+
+
+def submit_direct(user_id, n):
+    for i in range(n):
+        db.session.add(Post(body='direct post {}'.format(i), user_id=user_id, language='en'))
+        db.session.commit()
+
+
+def submit_grouped(user_id, n):
+    for i in range(n):
+        group_commit.submit_post('grouped post {}'.format(i), user_id, 'en')
+
+
+def run(mode, threads, posts, window_ms):
+    with temporary_app(GROUP_COMMIT_ENABLED=(mode == 'group'), GROUP_COMMIT_WINDOW_MS=window_ms) as app:
+        with app.app_context():
+            user = User(username='bench', email='bench@example.com')
+            db.session.add(user)
+            db.session.commit()
+            user_id = user.id
+
+        target = submit_grouped if mode == 'group' else submit_direct
+
+        def worker():
+            with app.app_context():
+                target(user_id, posts)
+                db.session.remove()
+
+        pool = [threading.Thread(target=worker) for _ in range(threads)]
+        start = perf_counter()
+        for t in pool:
+            t.start()
+        for t in pool:
+            t.join()
+        elapsed = perf_counter() - start
+
+        with app.app_context():
+            written = Post.query.count()
+        return written, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare posts/sec with and without group commit.')
+    parser.add_argument('--threads', type=int, default=16, help='concurrent submitters')
+    parser.add_argument('--posts', type=int, default=50, help='posts per submitter')
+    parser.add_argument('--window-ms', type=int, default=5, help='group commit collection window')
+    args = parser.parse_args()
+
+    print('{:<8} {:>8} {:>10} {:>12}'.format('mode', 'posts', 'seconds', 'posts/sec'))
+    for mode in ('direct', 'group'):
+        written, elapsed = run(mode, args.threads, args.posts, args.window_ms)
+        print('{:<8} {:>8} {:>10.3f} {:>12.1f}'.format(mode, written, elapsed, written / elapsed))
+
+
+if __name__ == '__main__':
+    main()
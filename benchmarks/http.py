@@ -0,0 +1,240 @@
+import argparse
+import json
+import platform
+import random
+import threading
+from datetime import datetime
+from time import perf_counter
+from werkzeug.serving import WSGIRequestHandler, make_server
+from app import db
+from app.models import User
+from app.seed import seed
+from benchmarks.common import percentile, temporary_app
+
+
+# ------------------------------------------- HTTP BENCHMARK -----------------------------------------------------
+#
+# Drives the main and auth blueprints end to end with a weighted mix of requests, the way a crowd of logged in users
+# would, and reports the p50/p95/p99 latency and the throughput of every endpoint.
+#
+# It runs completely offline. The database is a temporary SQLite file filled by the same generator as "flask seed",
+# and the requests go either:
+#
+#   --target client   -->  through the Flask test client (no sockets, measures the application alone), or
+#   --target server   -->  through a real local WSGI server on 127.0.0.1 (adds HTTP parsing and the network stack)
+#
+# The results are written as JSON (--output) so that two runs can be compared, for example before and after a
+# change:
+#
+#   >>>   python -m benchmarks.http --users 500 --posts 20000 --virtual-users 50 --output before.json
+#   >>>   python -m benchmarks.http --users 500 --posts 20000 --virtual-users 50 --output after.json \
+#                               --compare before.json
+#
+# The translate requests are answered without calling the translation service (there is no MS_TRANSLATOR_KEY in the
+# benchmark), so they measure the application overhead of the endpoint only.
+#
+# The page cache and the recent posts buffer are on, as they are by default, and so are the in-memory follow graph and
+# the live posts hub, so that what they cost and save is part of the numbers. Turn them off with the usual variables
+# (PAGE_CACHE_DISABLED, RECENT_POSTS_DISABLED) or --no-graph / --no-live to measure the application without them.
+# ----------------------------------------------------------------------------------------------------------------
+
+# Share of the traffic that goes to each kind of request
+MIX = (
+    ('main.index', 30),
+    ('main.explore', 20),
+    ('main.user', 20),
+    ('main.follow', 10),
+    ('post', 10),
+    ('main.translate_text', 10),
+)
+
+
+# The development server logs every request to stderr, which would drown the report
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class ClientDriver(object):
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def get(self, path):
+        return self.client.get(path).status_code
+
+    def post(self, path, data):
+        return self.client.post(path, data=data).status_code
+
+
+class ServerDriver(object):
+    def __init__(self, base_url):
+        import requests
+        self.base_url = base_url
+        self.session = requests.Session()
+
+    def get(self, path):
+        return self.session.get(self.base_url + path, allow_redirects=False).status_code
+
+    def post(self, path, data):
+        return self.session.post(self.base_url + path, data=data, allow_redirects=False).status_code
+
+
+# One virtual user: it logs in once, then keeps picking requests from the mix
+class VirtualUser(object):
+    def __init__(self, driver, username, usernames, rng):
+        self.driver = driver
+        self.username = username
+        self.usernames = usernames
+        self.rng = rng
+        self.following = set()
+
+    def login(self, password):
+        return self.driver.post('/auth/login', {'username': self.username, 'password': password})
+
+    def request(self, kind):
+        if kind == 'main.index':
+            return self.driver.get('/index?page={}'.format(self.rng.randint(1, 3)))
+        if kind == 'main.explore':
+            return self.driver.get('/explore?page={}'.format(self.rng.randint(1, 3)))
+        if kind == 'main.user':
+            return self.driver.get('/user/' + self.rng.choice(self.usernames))
+        if kind == 'main.follow':
+            other = self.rng.choice(self.usernames)
+            if other in self.following:
+                self.following.discard(other)
+                return self.driver.get('/unfollow/' + other)
+            self.following.add(other)
+            return self.driver.get('/follow/' + other)
+        if kind == 'post':
+            return self.driver.post('/index', {'post': 'Benchmark post {}'.format(self.rng.randrange(10 ** 6))})
+        if kind == 'main.translate_text':
+            return self.driver.post('/translate', {'text': 'Bonjour tout le monde', 'source_language': 'fr',
+                                                   'dest_language': 'en'})
+        raise ValueError(kind)
+
+
+def run(app, target, users, requests_per_user, concurrency, password, rng):
+    with app.app_context():
+        usernames = [username for (username,) in db.session.query(User.username).order_by(User.id)]
+
+    server = None
+    if target == 'server':
+        server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietRequestHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = 'http://127.0.0.1:{}'.format(server.server_port)
+
+    def new_driver():
+        return ServerDriver(base_url) if target == 'server' else ClientDriver(app)
+
+    kinds = [kind for kind, _ in MIX]
+    weights = [weight for _, weight in MIX]
+    samples = {kind: [] for kind in kinds}
+    errors = {kind: 0 for kind in kinds}
+    lock = threading.Lock()
+
+    virtual_users = []
+    for username in rng.sample(usernames, min(users, len(usernames))):
+        vu = VirtualUser(new_driver(), username, usernames, random.Random(rng.random()))
+        vu.login(password)
+        virtual_users.append(vu)
+
+    def worker(group):
+        local = {kind: [] for kind in kinds}
+        local_errors = {kind: 0 for kind in kinds}
+        for _ in range(requests_per_user):
+            for vu in group:
+                kind = vu.rng.choices(kinds, weights)[0]
+                start = perf_counter()
+                status = vu.request(kind)
+                local[kind].append(perf_counter() - start)
+                if status >= 400:
+                    local_errors[kind] += 1
+        with lock:
+            for kind in kinds:
+                samples[kind].extend(local[kind])
+                errors[kind] += local_errors[kind]
+
+    groups = [virtual_users[i::concurrency] for i in range(concurrency)]
+    threads = [threading.Thread(target=worker, args=(group,)) for group in groups if group]
+    start = perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = perf_counter() - start
+
+    if server is not None:
+        server.shutdown()
+    return summarize(samples, errors, wall)
+
+
+def summarize(samples, errors, wall):
+    endpoints = {}
+    for kind, values in samples.items():
+        values.sort()
+        endpoints[kind] = {
+            'requests': len(values),
+            'errors': errors[kind],
+            'p50_ms': percentile(values, 50) * 1000,
+            'p95_ms': percentile(values, 95) * 1000,
+            'p99_ms': percentile(values, 99) * 1000,
+            'mean_ms': (sum(values) / len(values) * 1000) if values else 0.0,
+            'throughput_rps': len(values) / wall if wall else 0.0,
+        }
+    total = sum(len(v) for v in samples.values())
+    return {'wall_seconds': wall, 'total_requests': total, 'throughput_rps': total / wall if wall else 0.0,
+            'endpoints': endpoints}
+
+
+def print_report(results, baseline=None):
+    print('{:<22} {:>8} {:>6} {:>9} {:>9} {:>9} {:>9}'.format(
+        'endpoint', 'requests', 'errors', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s'))
+    for kind, r in sorted(results['endpoints'].items()):
+        line = '{:<22} {:>8} {:>6} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.1f}'.format(
+            kind, r['requests'], r['errors'], r['p50_ms'], r['p95_ms'], r['p99_ms'], r['throughput_rps'])
+        if baseline and kind in baseline['endpoints'] and baseline['endpoints'][kind]['p95_ms']:
+            change = r['p95_ms'] / baseline['endpoints'][kind]['p95_ms'] - 1
+            line += '   p95 {:+.1%}'.format(change)
+        print(line)
+    print('total: {} requests in {:.2f}s, {:.1f} req/s'.format(
+        results['total_requests'], results['wall_seconds'], results['throughput_rps']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end HTTP benchmark of the main and auth blueprints.')
+    parser.add_argument('--target', choices=('client', 'server'), default='client')
+    parser.add_argument('--users', type=int, default=100, help='seeded users')
+    parser.add_argument('--posts', type=int, default=2000, help='seeded posts')
+    parser.add_argument('--virtual-users', type=int, default=20, help='logged in users driving the traffic')
+    parser.add_argument('--requests', type=int, default=25, help='requests per virtual user')
+    parser.add_argument('--concurrency', type=int, default=4, help='threads sending requests')
+    parser.add_argument('--random-seed', type=int, default=1)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare the p95 latency against')
+    parser.add_argument('--no-graph', action='store_true', help='do not keep the follow graph in memory')
+    parser.add_argument('--no-live', action='store_true', help='do not run the live posts hub')
+    args = parser.parse_args()
+
+    rng = random.Random(args.random_seed)
+    with temporary_app(GRAPH_ENABLED=not args.no_graph, LIVE_ENABLED=not args.no_live) as app:
+        with app.app_context():
+            seed(args.users, args.posts, random_seed=args.random_seed)
+        results = run(app, args.target, args.virtual_users, args.requests, args.concurrency, 'password', rng)
+
+    results['parameters'] = vars(args)
+    results['started'] = datetime.utcnow().isoformat()
+    results['python'] = platform.python_version()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+import argparse
+import json
+import random
+from time import perf_counter
+from app import db
+from app.models import User, followers
+from app.seed import seed
+from benchmarks.common import percentile, temporary_app
+
+
+# ---------------------------------------- USER MODEL MICROBENCHMARKS --------------------------------------------
+#
+# Times the User methods that sit on the hot paths of the application against seeded follower graphs of increasing
+# size (1k, 10k and 100k users by default, with POSTS_PER_USER posts each), and prints how the median cost of each
+# method grows with the size of the graph:
+#
+#   is_following()               -->  should stay flat, it is an indexed lookup
+#   followed_posts() first page  -->  grows with the number of posts of the followed users
+#   follow() + unfollow()        -->  should stay flat
+#   avatar()                     -->  pure Python, must not depend on the data at all
+#   check_password()             -->  deliberately slow (key stretching), must not depend on the data either
+#   get_reset_password_token()   -->  pure Python, flat
+#
+# The "growth" column is the median at the largest size divided by the median at the smallest size. Anything above
+# --alert is flagged, which is how an algorithmic regression (a method turning O(n) by accident) stands out.
+#
+#   >>>   python -m benchmarks.models --sizes 1000,10000,100000 --output models.json
+# ----------------------------------------------------------------------------------------------------------------
+
+POSTS_PER_USER = 5
+
+# How many times each method is timed per size (check_password is expensive by design, so it gets fewer runs)
+REPEAT = {
+    'is_following': 500,
+    'followed_posts': 100,
+    'follow_unfollow': 200,
+    'avatar': 2000,
+    'check_password': 10,
+    'get_reset_password_token': 1000,
+}
+
+
+def _time(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = perf_counter()
+        fn()
+        samples.append(perf_counter() - start)
+    samples.sort()
+    return percentile(samples, 50)
+
+
+def measure(size, rng):
+    with temporary_app() as app, app.app_context():
+        seed(size, size * POSTS_PER_USER, random_seed=rng.random())
+        ids = [i for (i,) in db.session.query(User.id)]
+        users = [User.query.get(i) for i in rng.sample(ids, min(len(ids), 200))]
+
+        def pair():
+            return rng.choice(users), rng.choice(users)
+
+        def is_following():
+            a, b = pair()
+            a.is_following(b)
+
+        def followed_posts():
+            rng.choice(users).followed_posts().limit(app.config['POSTS_PER_PAGE']).all()
+
+        # Pairs where a does not follow b yet, so that follow() always inserts and unfollow() only deletes the edge
+        # follow() just created: every iteration does the same work and the seeded graph is left as it was
+        sampled = {u.id for u in users}
+        edges = set(db.session.query(followers.c.follower_id, followers.c.followed_id)
+                    .filter(followers.c.follower_id.in_(sampled), followers.c.followed_id.in_(sampled)))
+        unrelated = [(a, b) for a in users for b in users if a is not b and (a.id, b.id) not in edges]
+
+        # Both changes are flushed so that the INSERT and the DELETE really run, the unfollow undoes the follow
+        def follow_unfollow():
+            a, b = rng.choice(unrelated)
+            a.follow(b)
+            db.session.flush()
+            a.unfollow(b)
+            db.session.flush()
+
+        def avatar():
+            rng.choice(users).avatar(70)
+
+        def check_password():
+            rng.choice(users).check_password('password')
+
+        def get_reset_password_token():
+            rng.choice(users).get_reset_password_token()
+
+        results = {}
+        for name, fn in (('is_following', is_following), ('followed_posts', followed_posts),
+                         ('follow_unfollow', follow_unfollow), ('avatar', avatar),
+                         ('check_password', check_password), ('get_reset_password_token', get_reset_password_token)):
+            results[name] = _time(fn, REPEAT[name])
+            db.session.rollback()
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Scaling microbenchmarks of the User model hot methods.')
+    parser.add_argument('--sizes', default='1000,10000,100000', help='comma separated numbers of users')
+    parser.add_argument('--alert', type=float, default=3.0, help='flag methods whose median grows more than this')
+    parser.add_argument('--random-seed', type=int, default=1)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    sizes = [int(s) for s in args.sizes.split(',')]
+    rng = random.Random(args.random_seed)
+    by_size = {}
+    for size in sizes:
+        by_size[size] = measure(size, rng)
+
+    header = '{:<26}'.format('method') + ''.join('{:>14}'.format('{} users'.format(s)) for s in sizes) + \
+             '{:>9}'.format('growth')
+    print(header)
+    for name in REPEAT:
+        medians = [by_size[s][name] for s in sizes]
+        growth = medians[-1] / medians[0] if medians[0] else 0.0
+        flag = '  <-- check' if growth > args.alert else ''
+        print('{:<26}'.format(name) + ''.join('{:>11.1f} us'.format(m * 1e6) for m in medians) +
+              '{:>8.1f}x{}'.format(growth, flag))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'sizes': sizes, 'median_seconds': {str(s): by_size[s] for s in sizes}}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+import argparse
+import json
+import random
+from time import perf_counter
+from sqlalchemy import bindparam
+from app import db, suggestions
+from app.graph import SocialGraph
+from app.models import User, followers
+from app.seed import seed
+from benchmarks.common import temporary_app
+
+
+# ---------------------------------------- FOLLOW SUGGESTIONS BENCHMARK ------------------------------------------
+#
+# Times the "who to follow" computation (app/suggestions.py) on a seeded follower graph of --users users (100k by
+# default) and reports:
+#
+#   load         -->  reading the followers table into the graph arrays
+#   scipy        -->  computing the top suggestions of every user with the sparse matrix product (when scipy is
+#                     installed)
+#   python       -->  the pure Python fallback, timed on --sample users and extrapolated to all of them
+#   full         -->  "flask suggestions refresh --full": load, compute and write the suggestion table
+#   incremental  -->  "flask suggestions refresh" after --changes random follows
+#
+#   >>>   python -m benchmarks.suggestions --users 100000 --follows 20 --output suggestions.json
+# ----------------------------------------------------------------------------------------------------------------
+
+
+def timed(function, *args):
+    start = perf_counter()
+    result = function(*args)
+    return result, perf_counter() - start
+
+
+def random_follows(user_ids, changes, rng):
+    rows = []
+    while len(rows) < changes:
+        follower, followed = rng.choice(user_ids), rng.choice(user_ids)
+        if follower != followed:
+            rows.append({'follower_id': follower, 'followed_id': followed})
+    db.session.execute(followers.insert(), rows)
+    db.session.execute(User.__table__.update().where(User.id == bindparam('changed_id'))
+                       .values(followed_version=User.followed_version + 1),
+                       [{'changed_id': row['follower_id']} for row in rows])
+    db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compute time of the follow suggestions.')
+    parser.add_argument('--users', type=int, default=100000, help='seeded users')
+    parser.add_argument('--follows', type=int, default=20, help='average number of users each user follows')
+    parser.add_argument('--per-user', type=int, default=20, help='suggestions kept per user')
+    parser.add_argument('--sample', type=int, default=2000, help='users the pure Python fallback is timed on')
+    parser.add_argument('--changes', type=int, default=100, help='random follows before the incremental refresh')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    results = {}
+    with temporary_app() as app:
+        with app.app_context():
+            _, edges, _ = seed(args.users, 0, args.follows, random_seed=1)
+            results['edges'] = edges
+            graph, results['load_seconds'] = timed(SocialGraph.load)
+            ids = list(range(1, args.users + 1))
+
+            if suggestions.sparse is not None:
+                _, results['scipy_seconds'] = timed(lambda: sum(1 for _ in suggestions._compute_scipy(
+                    graph, ids, args.per_user)))
+            sample = ids[:args.sample]
+            _, sample_seconds = timed(lambda: sum(1 for _ in suggestions._compute_python(
+                graph, sample, args.per_user)))
+            results['python_seconds'] = sample_seconds * len(ids) / len(sample)
+
+            (_, written), results['full_seconds'] = timed(suggestions.refresh, args.per_user, True)
+            results['suggestions'] = written
+            random_follows(ids, args.changes, random.Random(1))
+            (refreshed, _), results['incremental_seconds'] = timed(suggestions.refresh, args.per_user)
+            results['incremental_users'] = refreshed
+
+    print('{} users, {} follow relationships, {} suggestions'.format(args.users, results['edges'],
+                                                                     results['suggestions']))
+    print('{:<34} {:>9.2f}s'.format('load graph', results['load_seconds']))
+    if 'scipy_seconds' in results:
+        print('{:<34} {:>9.2f}s'.format('compute (scipy)', results['scipy_seconds']))
+    print('{:<34} {:>9.2f}s'.format('compute (python, extrapolated)', results['python_seconds']))
+    print('{:<34} {:>9.2f}s'.format('full refresh ({})'.format(suggestions.backend()), results['full_seconds']))
+    print('{:<34} {:>9.2f}s'.format('incremental refresh, {} users'.format(results['incremental_users']),
+                                    results['incremental_seconds']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'parameters': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -9,15 +9,100 @@ load_dotenv(os.path.join(basedir, '.env'))
 # It is a good idea to have these application-wide "knobs" that can change behaviors in the configuration file,
 # because then I can go to a single place to make adjustments.
 class Config(object):
+    # Structured JSON access log, off unless ACCESS_LOG_ENABLED is set (see app/access_log.py)
+    ACCESS_LOG_BACKUP_COUNT = int(os.environ.get('ACCESS_LOG_BACKUP_COUNT') or 10)
+    ACCESS_LOG_BUFFER = int(os.environ.get('ACCESS_LOG_BUFFER') or 100)
+    ACCESS_LOG_ENABLED = os.environ.get('ACCESS_LOG_ENABLED') is not None
+    ACCESS_LOG_MAX_BYTES = int(os.environ.get('ACCESS_LOG_MAX_BYTES') or 50 * 1024 * 1024)
+    ACCESS_LOG_PATH = os.environ.get('ACCESS_LOG_PATH') or os.path.join(basedir, 'logs', 'access.log')
     ADMINS = ['darien@acorn.me']
+    # JSON API (see app/api): posts per response by default and at most, and lifetime of the tokens in seconds
+    API_MAX_PAGE_SIZE = 100
+    API_PAGE_SIZE = 20
+    API_TOKEN_EXPIRATION = int(os.environ.get('API_TOKEN_EXPIRATION') or 24 * 3600)
+    # Maximum number of users in one /bulk_follow request
+    BULK_FOLLOW_MAX = int(os.environ.get('BULK_FOLLOW_MAX') or 1000)
+    # gzip compression of HTML and JSON responses (see app/compression.py)
+    COMPRESSION_ENABLED = os.environ.get('COMPRESSION_DISABLED') is None
+    COMPRESSION_LEVEL = int(os.environ.get('COMPRESSION_LEVEL') or 6)
+    COMPRESSION_MIMETYPES = ['text/html', 'application/json']
+    COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE') or 500)
+    # ETag validation of the explore and user pages (see app/conditional.py)
+    CONDITIONAL_GET_ENABLED = os.environ.get('CONDITIONAL_GET_DISABLED') is None
+    CONDITIONAL_GET_MAX_STALENESS = int(os.environ.get('CONDITIONAL_GET_MAX_STALENESS') or 60)
+    # In-memory copy of the follow graph in every worker (see app/graph.py)
+    GRAPH_ENABLED = os.environ.get('GRAPH_ENABLED') is not None
+    GRAPH_MAX_DELTA = int(os.environ.get('GRAPH_MAX_DELTA') or 10000)
+    GRAPH_RELOAD_INTERVAL = int(os.environ.get('GRAPH_RELOAD_INTERVAL') or 600)
+    # Optional group-commit write path for new posts (see app/group_commit.py)
+    GROUP_COMMIT_ENABLED = os.environ.get('GROUP_COMMIT_ENABLED') is not None
+    GROUP_COMMIT_MAX_BATCH = int(os.environ.get('GROUP_COMMIT_MAX_BATCH') or 100)
+    GROUP_COMMIT_TIMEOUT = int(os.environ.get('GROUP_COMMIT_TIMEOUT') or 5)
+    GROUP_COMMIT_WINDOW_MS = int(os.environ.get('GROUP_COMMIT_WINDOW_MS') or 5)
     LANGUAGES = ['en', 'fr']
+    # Server-sent events of the new posts of the home page at /stream (see app/live.py)
+    LIVE_ENABLED = os.environ.get('LIVE_ENABLED') is not None
+    LIVE_HEARTBEAT = float(os.environ.get('LIVE_HEARTBEAT') or 15)
+    LIVE_MAX_AGE = float(os.environ.get('LIVE_MAX_AGE') or 300)
+    LIVE_MAX_STREAMS = int(os.environ.get('LIVE_MAX_STREAMS') or 10)
+    LIVE_POLL_INTERVAL = float(os.environ.get('LIVE_POLL_INTERVAL') or 1)
+    LIVE_QUEUE_SIZE = int(os.environ.get('LIVE_QUEUE_SIZE') or 100)
+    # Logging pipeline (see app/logging_pipeline.py): file rotation, queue size and error email aggregation
+    LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT') or 10)
+    LOG_MAIL_INTERVAL = int(os.environ.get('LOG_MAIL_INTERVAL') or 300)
+    LOG_MAIL_MAX_RECORDS = int(os.environ.get('LOG_MAIL_MAX_RECORDS') or 50)
+    LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES') or 10 * 1024 * 1024)
+    LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE') or 10000)
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 25)
     MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') is not None
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
+    # Metrics exposed at /metrics (see app/metrics.py), METRICS_DIR is needed to aggregate several worker processes and
+    # outside debug mode the endpoint is only served to scrapers that send METRICS_TOKEN
+    METRICS_DIR = os.environ.get('METRICS_DIR')
+    METRICS_ENABLED = os.environ.get('METRICS_DISABLED') is None
+    METRICS_FLUSH_INTERVAL = int(os.environ.get('METRICS_FLUSH_INTERVAL') or 5)
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
     MS_TRANSLATOR_KEY = os.environ.get('MS_TRANSLATOR_KEY')
+    # Shared cache of the first explore pages with stale-while-revalidate (see app/page_cache.py)
+    PAGE_CACHE_DIR = os.environ.get('PAGE_CACHE_DIR') or os.path.join(basedir, 'cache', 'pages')
+    PAGE_CACHE_ENABLED = os.environ.get('PAGE_CACHE_DISABLED') is None
+    PAGE_CACHE_LOCK_TIMEOUT = float(os.environ.get('PAGE_CACHE_LOCK_TIMEOUT') or 30)
+    PAGE_CACHE_MAX_PAGE = int(os.environ.get('PAGE_CACHE_MAX_PAGE') or 10)
+    PAGE_CACHE_STALE_TTL = float(os.environ.get('PAGE_CACHE_STALE_TTL') or 60)
+    PAGE_CACHE_TTL = float(os.environ.get('PAGE_CACHE_TTL') or 10)
+    PAGE_CACHE_WAIT = float(os.environ.get('PAGE_CACHE_WAIT') or 2)
     POSTS_PER_PAGE = 10
+    # Sampled cProfile capture (see app/profiling.py), the header only works for users listed in ADMINS
+    PROFILE_DIR = os.environ.get('PROFILE_DIR') or os.path.join(basedir, 'profiles')
+    PROFILE_HEADER = 'X-Profile'
+    PROFILE_MAX_FILES = int(os.environ.get('PROFILE_MAX_FILES') or 100)
+    PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE') or 0)
+    # In-memory buffer of the newest posts for the first explore pages (see app/recent_posts.py)
+    RECENT_POSTS_ENABLED = os.environ.get('RECENT_POSTS_DISABLED') is None
+    RECENT_POSTS_FEED = os.environ.get('RECENT_POSTS_FEED') or os.path.join(basedir, 'cache', 'recent_posts.feed')
+    RECENT_POSTS_SIZE = int(os.environ.get('RECENT_POSTS_SIZE') or 500)
     SECRET_KEY = os.environ.get('SECRET_KEY')
+    # Sentry is only enabled when a DSN is configured (see init_sentry() in app/__init__.py)
+    SENTRY_DSN = os.environ.get('SENTRY_DSN')
+    SENTRY_ENVIRONMENT = os.environ.get('SENTRY_ENVIRONMENT') or 'production'
+    SENTRY_SAMPLE_RATE = float(os.environ.get('SENTRY_SAMPLE_RATE') or 1.0)
+    SENTRY_SHUTDOWN_TIMEOUT = float(os.environ.get('SENTRY_SHUTDOWN_TIMEOUT') or 1.0)
+    SENTRY_TRACES_SAMPLE_RATE = float(os.environ.get('SENTRY_TRACES_SAMPLE_RATE') or 0.0)
+    SENTRY_TRANSPORT_QUEUE_SIZE = int(os.environ.get('SENTRY_TRANSPORT_QUEUE_SIZE') or 100)
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///' + os.path.join(basedir, 'app.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # "Who to follow" suggestions kept per user, and shown on the home page (see app/suggestions.py)
+    SUGGESTIONS_PER_USER = int(os.environ.get('SUGGESTIONS_PER_USER') or 20)
+    SUGGESTIONS_SHOWN = int(os.environ.get('SUGGESTIONS_SHOWN') or 5)
+    # Per-request SQL stats (see app/instrumentation.py)
+    SQL_N_PLUS_ONE_THRESHOLD = int(os.environ.get('SQL_N_PLUS_ONE_THRESHOLD') or 5)
+    SQL_STATS_HEADERS = os.environ.get('SQL_STATS_HEADERS') is not None
+    # Send the feed pages while they are rendered instead of all at once (see app/streaming.py)
+    STREAMING_FEEDS = os.environ.get('STREAMING_FEEDS') is not None
+    # Compiled templates shared by all the workers, and optional compilation of every template at startup
+    # (see app/templating.py)
+    TEMPLATE_CACHE_DIR = os.environ.get('TEMPLATE_CACHE_DIR') or os.path.join(basedir, 'cache', 'jinja')
+    TEMPLATE_WARMUP = os.environ.get('TEMPLATE_WARMUP') is not None
+    USERS_PER_PAGE = 20
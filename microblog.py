@@ -1,9 +1,12 @@
-from app import create_app, db
+from app import create_app, db, cli
 from app.models import User, Post
 
 # FN called create_app() that constructs a Flask application instance, and eliminate the global variable
 app = create_app()
 
+# Attach the custom commands (flask seed, ...) to the flask command-line interface
+cli.register(app)
+
 
 # Python script at the top-level that defines the Flask application instance
 @app.shell_context_processor
@@ -1,7 +1,33 @@
 from datetime import datetime, timedelta
+import base64
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import shutil
+import tempfile
+import threading
 import unittest
-from app import create_app, db
-from app.models import User, Post
+import zlib
+from threading import Thread
+from time import time
+from unittest import mock
+from flask import url_for
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+from app import access_log, assets, counters, create_app, db, cli, graph, live, metrics, page_cache, suggestions, \
+    templating
+from app.compression import CompressionMiddleware
+from app.graph import GraphService, SocialGraph
+from app.group_commit import GroupCommitError, group_commit
+from app.instrumentation import current_stats, statement_shape
+from app.logging_pipeline import AggregatingSMTPHandler, attach_queued_handlers
+from app.main import routes
+from app.metrics import collect, record_cache, render
+from app.models import User, Post, followers
+from app.page_cache import PageCache
+from app.recent_posts import RecentPosts
 from config import Config
 
 
@@ -25,6 +51,16 @@ from config import Config
 class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    SECRET_KEY = 'test-secret'
+    # The tests must not write bytecode into the cache directory of the development server
+    TEMPLATE_CACHE_DIR = None
+    WTF_CSRF_ENABLED = False
+    # The caches and in-memory copies outlive the data of a test, the tests that need them turn them on by themselves
+    ACCESS_LOG_ENABLED = False
+    GRAPH_ENABLED = False
+    LIVE_ENABLED = False
+    PAGE_CACHE_ENABLED = False
+    RECENT_POSTS_ENABLED = False
 
 
 # noinspection PyArgumentList
@@ -115,5 +151,1297 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f4, [p4])
 
 
+class AppFactoryCase(unittest.TestCase):
+    # A DSN alone is not enough, Sentry is never started by unit tests (or anything else running with TESTING)
+    def test_sentry_is_not_started_in_tests(self):
+        import sentry_sdk
+        app = create_app(type('SentryConfig', (TestConfig,), {'SENTRY_DSN': 'https://key@sentry.invalid/1'}))
+        self.assertTrue(app.testing)
+        self.assertIsNone(sentry_sdk.Hub.current.client)
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super(ListHandler, self).__init__()
+        self.records = []
+        self.threads = []
+
+    def emit(self, record):
+        self.records.append(record)
+        self.threads.append(threading.get_ident())
+
+
+class LoggingPipelineCase(unittest.TestCase):
+    def test_records_are_handled_on_a_background_thread(self):
+        logger = logging.getLogger('tests.pipeline')
+        target = ListHandler()
+        queued = attach_queued_handlers(logger, [target])
+        try:
+            logger.error('something broke')
+        finally:
+            queued.stop()
+            logger.removeHandler(queued)
+        self.assertEqual([r.getMessage() for r in target.records], ['something broke'])
+        self.assertNotEqual(target.threads[0], threading.get_ident())
+
+    def test_error_emails_are_aggregated(self):
+        handler = AggregatingSMTPHandler(mailhost=('localhost', 25), fromaddr='no-reply@localhost',
+                                         toaddrs=['admin@example.com'], subject='Microblog Failure', interval=60)
+        with mock.patch('smtplib.SMTP') as smtp:
+            for i in range(3):
+                handler.handle(logging.makeLogRecord({'msg': 'error {}'.format(i), 'levelno': logging.ERROR}))
+            # The first error is sent right away, the next two wait for the interval (or for close())
+            self.assertEqual(smtp.return_value.send_message.call_count, 1)
+            handler.close()
+            self.assertEqual(smtp.return_value.send_message.call_count, 2)
+        message = smtp.return_value.send_message.call_args[0][0]
+        self.assertIn('(2 errors)', message['Subject'])
+        self.assertIn('error 1', message.get_content())
+        self.assertIn('error 2', message.get_content())
+
+
+class GroupCommitConfig(TestConfig):
+    GROUP_COMMIT_ENABLED = True
+    # Long enough for the three threads of the test to land in the same window on a slow machine
+    GROUP_COMMIT_WINDOW_MS = 200
+
+
+# noinspection PyArgumentList
+class GroupCommitCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(GroupCommitConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_concurrent_posts_share_one_batch(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        user_id = u.id
+        db.session.remove()
+
+        # Record the size of every batch the writer flushes
+        writer = self.app.extensions['group_commit']
+        flush = writer.flush
+        batches = []
+
+        def counting_flush(batch):
+            batches.append(len(batch))
+            flush(batch)
+
+        # Submit three posts from three threads at once, they should all be acknowledged and all be written by ONE
+        # flush, that is one INSERT and one COMMIT
+        start = threading.Barrier(3)
+
+        def submit(i):
+            with self.app.app_context():
+                start.wait()
+                group_commit.submit_post('post {}'.format(i), user_id, 'en')
+
+        with mock.patch.object(writer, 'flush', counting_flush):
+            threads = [Thread(target=submit, args=(i,)) for i in range(3)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+        self.assertEqual(batches, [3])
+        self.assertEqual(Post.query.filter_by(user_id=user_id).count(), 3)
+        self.assertEqual(User.query.get(user_id).posts_count, 3)
+
+    def test_failing_hook_does_not_fail_a_committed_post(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        user_id = u.id
+        db.session.remove()
+
+        with mock.patch('app.recent_posts.posts_created', side_effect=RuntimeError('boom')), \
+                mock.patch('app.live.posts_created') as live_hook:
+            group_commit.submit_post('saved', user_id, 'en')
+        live_hook.assert_called_once_with()
+        self.assertEqual(Post.query.filter_by(user_id=user_id).count(), 1)
+
+    def test_timed_out_post_is_not_written_later(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        user_id = u.id
+        db.session.remove()
+
+        # Keep the writer busy with a first post, so that the second one times out while still queued
+        writer = self.app.extensions['group_commit']
+        flush = writer.flush
+        flushing, release = threading.Event(), threading.Event()
+
+        def slow_flush(batch):
+            flushing.set()
+            release.wait(5)
+            flush(batch)
+
+        def submit_first():
+            with self.app.app_context():
+                group_commit.submit_post('first', user_id, 'en')
+
+        with mock.patch.object(writer, 'flush', slow_flush):
+            first = Thread(target=submit_first)
+            first.start()
+            self.assertTrue(flushing.wait(5))
+            values = {'body': 'second', 'user_id': user_id, 'language': 'en', 'timestamp': datetime.utcnow()}
+            with self.assertRaises(GroupCommitError):
+                writer.submit(values, 0.05)
+            release.set()
+            first.join()
+
+        self.assertEqual([p.body for p in Post.query.filter_by(user_id=user_id)], ['first'])
+        self.assertEqual(len(writer.queue), 0)
+
+
+class InstrumentedConfig(TestConfig):
+    SQL_STATS_HEADERS = True
+    SQL_N_PLUS_ONE_THRESHOLD = 3
+
+
+# noinspection PyArgumentList
+class InstrumentationCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(InstrumentedConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def login(self, username, password='cat'):
+        return self.client.post('/auth/login', data={'username': username, 'password': password})
+
+    def test_statement_shape(self):
+        self.assertEqual(statement_shape('SELECT *\n  FROM user WHERE id IN (?, ?, ?)'),
+                         'SELECT * FROM user WHERE id IN (?)')
+
+    def test_query_count_headers_and_n_plus_one_warning(self):
+        # Four authors with one post each, so rendering explore lazy loads four different authors
+        for name in ('john', 'susan', 'mary', 'david'):
+            u = User(username=name, email=name + '@example.com')
+            u.set_password('cat')
+            db.session.add(u)
+            db.session.add(Post(body='post from ' + name, author=u))
+        db.session.commit()
+        db.session.remove()
+
+        self.login('john')
+        with self.assertLogs(self.app.logger, 'WARNING') as logs:
+            rv = self.client.get('/explore')
+        self.assertEqual(rv.status_code, 200)
+        self.assertGreater(int(rv.headers['X-DB-Query-Count']), 3)
+        self.assertIn('X-DB-Time-Ms', rv.headers)
+        self.assertTrue(any('Possible N+1 query in main.explore' in line for line in logs.output))
+
+    def test_failing_statement_does_not_break_the_timing(self):
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            with self.assertRaises(Exception):
+                db.session.execute('SELECT * FROM no_such_table')
+            db.session.rollback()
+            db.session.execute('SELECT 1')
+            stats = current_stats()
+            self.assertEqual(stats.count, 1)
+            self.assertGreaterEqual(stats.time, 0)
+            self.assertNotIn('query_start_time', db.session.connection().info)
+
+
+# noinspection PyArgumentList
+class MetricsCase(unittest.TestCase):
+    def setUp(self):
+        self.metrics_dir = tempfile.mkdtemp()
+        self.app = create_app(TestConfig)
+        self.app.config['METRICS_DIR'] = self.metrics_dir
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        shutil.rmtree(self.metrics_dir)
+
+    def test_latency_histogram_is_exposed(self):
+        self.client.get('/auth/login')
+        rv = self.client.get('/metrics')
+        text = rv.get_data(as_text=True)
+        self.assertEqual(rv.status_code, 200)
+        self.assertIn('# TYPE microblog_request_duration_seconds histogram', text)
+        self.assertIn('microblog_request_duration_seconds_bucket{endpoint="auth.login",le="+Inf"}', text)
+
+    def test_snapshots_of_other_processes_are_merged(self):
+        # A snapshot left behind by a worker that has exited: its counters still count, its gauges do not
+        with open(os.path.join(self.metrics_dir, '999999999.json'), 'w') as f:
+            json.dump({'counters': [['microblog_cache_requests_total', [['cache', 'test'], ['result', 'hit']], 5]],
+                       'gauges': [['microblog_email_queue_depth', [], 3]],
+                       'histograms': []}, f)
+        record_cache('test', hit=True)
+        text = render(collect(self.metrics_dir))
+        self.assertIn('microblog_cache_requests_total{cache="test",result="hit"} 6', text)
+        self.assertNotIn('microblog_email_queue_depth 3', text)
+        # The dead worker's snapshot was folded into the dead workers' totals, which keep counting
+        self.assertFalse(os.path.exists(os.path.join(self.metrics_dir, '999999999.json')))
+        text = render(collect(self.metrics_dir))
+        self.assertIn('microblog_cache_requests_total{cache="test",result="hit"} 6', text)
+
+    def test_snapshot_of_a_reused_pid_is_kept(self):
+        # A previous worker with the same pid as this process left its snapshot behind
+        with open(os.path.join(self.metrics_dir, '{}.json'.format(os.getpid())), 'w') as f:
+            json.dump({'counters': [['microblog_cache_requests_total', [['cache', 'test'], ['result', 'miss']], 4]],
+                       'gauges': [], 'histograms': []}, f)
+        with mock.patch.object(metrics, '_written_pid', None):
+            record_cache('test', hit=False)
+            text = render(collect(self.metrics_dir))
+        self.assertIn('microblog_cache_requests_total{cache="test",result="miss"} 5', text)
+
+    def test_endpoint_needs_a_token_outside_debug_and_tests(self):
+        self.app.testing = False
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+        self.app.config['METRICS_TOKEN'] = 'secret'
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        rv = self.client.get('/metrics', headers={'Authorization': 'Bearer secret'})
+        self.assertEqual(rv.status_code, 200)
+
+
+# noinspection PyArgumentList
+class ProfilingCase(unittest.TestCase):
+    def setUp(self):
+        self.profile_dir = tempfile.mkdtemp()
+        self.app = create_app(TestConfig)
+        self.app.config['PROFILE_DIR'] = self.profile_dir
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        shutil.rmtree(self.profile_dir)
+
+    def test_sampled_request_writes_pstats_and_collapsed_stacks(self):
+        self.app.config['PROFILE_SAMPLE_RATE'] = 1.0
+        self.client.get('/auth/login')
+        files = sorted(os.listdir(self.profile_dir))
+        self.assertEqual(len(files), 2)
+        self.assertIn('auth-login', files[0])
+        self.assertTrue(files[0].endswith('.collapsed') and files[1].endswith('.pstats'))
+        with open(os.path.join(self.profile_dir, files[0])) as f:
+            stack, microseconds = f.readline().rsplit(' ', 1)
+        self.assertTrue(int(microseconds) > 0)
+
+    def test_header_is_ignored_for_anonymous_users(self):
+        self.client.get('/auth/login', headers={'X-Profile': '1'})
+        self.assertEqual(os.listdir(self.profile_dir), [])
+
+    def test_only_newest_profiles_are_kept(self):
+        self.app.config['PROFILE_SAMPLE_RATE'] = 1.0
+        self.app.config['PROFILE_MAX_FILES'] = 1
+        for name in ('20000101-000000-1-old-1ms.pstats', '20000101-000000-1-old-1ms.collapsed'):
+            open(os.path.join(self.profile_dir, name), 'w').close()
+        self.client.get('/auth/login')
+        self.assertFalse(any('old' in f for f in os.listdir(self.profile_dir)))
+
+
+# noinspection PyArgumentList
+class AccessLogCase(unittest.TestCase):
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+        self.app = create_app(TestConfig)
+        self.app.config['ACCESS_LOG_PATH'] = os.path.join(self.log_dir, 'access.log')
+        access_log.init_app(self.app)
+        cli.register(self.app)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        for handler in access_log.logger.handlers[:]:
+            handler.stop()
+            access_log.logger.removeHandler(handler)
+        shutil.rmtree(self.log_dir)
+
+    def test_request_is_logged_as_json(self):
+        self.client.get('/auth/login')
+        # Stopping the queue drains it and flushes the buffered lines to the file
+        access_log.logger.handlers[0].stop()
+        with open(self.app.config['ACCESS_LOG_PATH']) as f:
+            entry = json.loads(f.readline())
+        self.assertEqual((entry['method'], entry['path'], entry['endpoint'], entry['status']),
+                         ('GET', '/auth/login', 'auth.login', 200))
+        self.assertIsNone(entry['user_id'])
+        self.assertGreater(entry['latency_ms'], 0)
+        self.assertGreater(entry['template_ms'], 0)
+        self.assertGreater(entry['bytes'], 0)
+
+    def test_buffered_lines_are_flushed_when_traffic_stops(self):
+        target = logging.handlers.BufferingHandler(100)
+        handler = access_log._TimedMemoryHandler(100, target, max_delay=0.05)
+        handler.handle(logging.makeLogRecord({'msg': 'last request', 'levelno': logging.INFO}))
+        self.assertEqual(len(target.buffer), 0)
+        # No other line arrives, the timer thread flushes it on its own
+        for _ in range(100):
+            if target.buffer:
+                break
+            threading.Event().wait(0.01)
+        self.assertEqual([record.msg for record in target.buffer], ['last request'])
+        handler.close()
+
+    def test_stats_command(self):
+        path = os.path.join(self.log_dir, 'old.log')
+        with open(path, 'w') as f:
+            for ms in range(1, 101):
+                f.write(json.dumps({'endpoint': 'main.index', 'latency_ms': ms, 'status': 500 if ms > 98 else 200}))
+                f.write('\n')
+            f.write('not json\n')
+        histograms, skipped = access_log.stats([path])
+        h = histograms['main.index']
+        self.assertEqual((h.count, h.errors, skipped), (100, 2, 1))
+        self.assertAlmostEqual(h.percentile(50), 50, delta=50 * 0.05)
+        self.assertAlmostEqual(h.percentile(99), 99, delta=99 * 0.05)
+
+        result = self.app.test_cli_runner().invoke(args=['accesslog', 'stats', path])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('main.index', result.output)
+
+
+# noinspection PyArgumentList
+class AssetsCase(unittest.TestCase):
+    def setUp(self):
+        self.static_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.static_dir, 'css'))
+        with open(os.path.join(self.static_dir, 'css', 'main.css'), 'w') as f:
+            f.write('.post { margin: 0; }\n' * 100)
+        self.app = create_app(TestConfig)
+        self.app.static_folder = self.static_dir
+        assets.build(self.static_dir)
+        assets.load_manifest(self.app)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        self.app_context.pop()
+        shutil.rmtree(self.static_dir)
+
+    def test_url_for_resolves_to_immutable_precompressed_file(self):
+        with self.app.test_request_context():
+            url = url_for('static', filename='css/main.css')
+        self.assertRegex(url, r'^/static/dist/css/main\.[0-9a-f]{8}\.css$')
+
+        rv = self.client.get(url, headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.headers['Content-Encoding'], 'gzip')
+        self.assertIn('immutable', rv.headers['Cache-Control'])
+        self.assertIn('max-age=31536000', rv.headers['Cache-Control'])
+        self.assertEqual(gzip.decompress(rv.get_data()), b'.post { margin: 0; }\n' * 100)
+
+        rv = self.client.get(url)
+        self.assertNotIn('Content-Encoding', rv.headers)
+        self.assertEqual(rv.mimetype, 'text/css')
+
+        # gzip refused with a zero quality
+        rv = self.client.get(url, headers={'Accept-Encoding': 'gzip;q=0, deflate'})
+        self.assertNotIn('Content-Encoding', rv.headers)
+        self.assertEqual(rv.get_data(), b'.post { margin: 0; }\n' * 100)
+
+
+# noinspection PyArgumentList
+class CompressionCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_html_is_gzipped_when_accepted(self):
+        plain = self.client.get('/auth/login')
+        rv = self.client.get('/auth/login', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertEqual(rv.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(rv.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(int(rv.headers['Content-Length']), len(rv.get_data()))
+        self.assertLess(len(rv.get_data()), len(plain.get_data()))
+        # The CSRF token is disabled in the tests, so both renderings of the page are identical
+        self.assertEqual(gzip.decompress(rv.get_data()), plain.get_data())
+
+    def test_streamed_chunks_are_flushed_one_by_one(self):
+        def streaming_app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/html; charset=utf-8')])
+            return (('<p>chunk {}</p>'.format(i)).encode() for i in range(3))
+
+        client = Client(CompressionMiddleware(streaming_app), BaseResponse)
+        rv = client.get('/', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(rv.headers['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', rv.headers)
+
+        # Every chunk can be decompressed as soon as it arrives, without waiting for the end of the stream
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        chunks = [decompressor.decompress(chunk) for chunk in rv.response]
+        self.assertEqual(chunks[:3], [b'<p>chunk 0</p>', b'<p>chunk 1</p>', b'<p>chunk 2</p>'])
+
+
+# noinspection PyArgumentList
+class TemplateCacheCase(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_warmed_templates_are_reused_by_other_workers(self):
+        class WarmupConfig(TestConfig):
+            TEMPLATE_CACHE_DIR = self.cache_dir
+            TEMPLATE_WARMUP = True
+
+        app = create_app(WarmupConfig)
+        self.assertEqual(len(os.listdir(self.cache_dir)), len(app.jinja_env.list_templates()))
+
+        # A second worker finds the bytecode in the shared cache and does not compile anything
+        other = create_app(WarmupConfig)
+        with mock.patch.object(type(other.jinja_env), 'compile', side_effect=AssertionError('compiled')):
+            other.jinja_env.cache.clear()
+            other.jinja_env.get_template('index.html')
+
+    def test_a_missing_template_does_not_stop_the_warmup(self):
+        app = create_app(TestConfig)
+        names = app.jinja_env.list_templates()
+        with mock.patch.object(type(app.jinja_env), 'list_templates', return_value=['missing.html'] + names):
+            compiled, errors = templating.compile_templates(app)
+        self.assertEqual([name for name, _ in errors], ['missing.html'])
+        self.assertEqual(len(compiled), len(names))
+
+
+# noinspection PyArgumentList
+class StreamingCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['STREAMING_FEEDS'] = True
+        self.app.config['POSTS_PER_PAGE'] = 3
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_explore_is_streamed_post_by_post(self):
+        u = User(username='john', email='john@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        now = datetime.utcnow()
+        for i in range(4):
+            db.session.add(Post(body='post number {}'.format(i), author=u, timestamp=now + timedelta(seconds=i)))
+        db.session.commit()
+        self.client.post('/auth/login', data={'username': 'john', 'password': 'cat'})
+
+        rv = self.client.get('/explore', buffered=False)
+        self.assertTrue(rv.is_streamed)
+        chunks = [chunk.decode() for chunk in rv.response]
+        rv.close()
+
+        # The head and navbar come first, then one chunk per post (newest first), then the pager
+        self.assertIn('navbar', chunks[0])
+        self.assertNotIn('post number', chunks[0])
+        self.assertEqual([c for c in chunks if 'post number' in c][0].count('post number'), 1)
+        page = ''.join(chunks)
+        self.assertNotIn('stream-flush', page)
+        self.assertEqual([n for n in (3, 2, 1, 0) if 'post number {}'.format(n) in page], [3, 2, 1])
+        self.assertIn('href="/explore?page=2"', page)
+
+        rv = self.client.get('/explore?page=2')
+        page = rv.get_data(as_text=True)
+        self.assertIn('post number 0', page)
+        self.assertIn('href="/explore?page=1"', page)
+        self.assertNotIn('href="/explore?page=3"', page)
+
+
+# noinspection PyArgumentList
+class ConditionalGetCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+        self.john = User(username='john', email='john@example.com')
+        self.susan = User(username='susan', email='susan@example.com')
+        self.john.set_password('cat')
+        db.session.add_all([self.john, self.susan, Post(body='hello', author=self.susan)])
+        db.session.commit()
+        self.client.post('/auth/login', data={'username': 'john', 'password': 'cat'})
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def revalidate(self, path, etag):
+        return self.client.get(path, headers={'If-None-Match': etag})
+
+    def test_explore_is_not_modified_until_a_new_post(self):
+        rv = self.client.get('/explore')
+        etag = rv.headers['ETag']
+        self.assertIn('no-cache', rv.headers['Cache-Control'])
+        rv = self.revalidate('/explore', etag)
+        self.assertEqual(rv.status_code, 304)
+        self.assertEqual(rv.get_data(), b'')
+        self.assertEqual(self.revalidate('/explore?page=2', etag).status_code, 200)
+
+        db.session.add(Post(body='news', author=self.susan))
+        db.session.commit()
+        self.assertEqual(self.revalidate('/explore', etag).status_code, 200)
+
+    def test_follow_changes_the_user_page(self):
+        etag = self.client.get('/user/susan').headers['ETag']
+        self.assertEqual(self.revalidate('/user/susan', etag).status_code, 304)
+
+        version = self.susan.graph_version
+        self.client.get('/follow/susan')
+        self.assertEqual(User.query.get(self.susan.id).graph_version, version + 1)
+        # The follow flashed a message, it must be shown
+        self.assertEqual(self.revalidate('/user/susan', etag).status_code, 200)
+        # And once it has been shown, the page is different anyway (Un-Follow link, followers count)
+        self.assertEqual(self.revalidate('/user/susan', etag).status_code, 200)
+
+
+# noinspection PyArgumentList
+class PageCacheCase(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = PageCache(self.cache_dir, ttl=10, stale_ttl=60, wait=0.1)
+        self.builds = []
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def build(self, html):
+        def build():
+            self.builds.append(html)
+            return html
+        return build
+
+    def test_fresh_entries_are_not_rebuilt(self):
+        self.assertEqual(self.cache.get(('explore', 1), 7, self.build('v7')), ('v7', True))
+        self.assertEqual(self.cache.get(('explore', 1), 7, self.build('again')), ('v7', True))
+        self.assertEqual(self.builds, ['v7'])
+
+    def test_stale_copy_is_served_while_another_worker_rebuilds(self):
+        self.cache.get(('explore', 1), 7, self.build('v7'))
+        # Another worker holds the lock of this page
+        open(self.cache._path(('explore', 1)) + '.lock', 'w').close()
+        self.assertEqual(self.cache.get(('explore', 1), 8, self.build('v8')), ('v7', False))
+        self.assertEqual(self.builds, ['v7'])
+
+        # Once the lock is released the next request rebuilds it
+        os.remove(self.cache._path(('explore', 1)) + '.lock')
+        self.assertEqual(self.cache.get(('explore', 1), 8, self.build('v8')), ('v8', True))
+        self.assertFalse(os.path.exists(self.cache._path(('explore', 1)) + '.lock'))
+
+    def test_expired_entries_and_leftovers_are_pruned(self):
+        self.cache.get(('explore', 1), 7, self.build('v7'))
+        self.cache.get(('explore', 2), 7, self.build('v7'))
+        old = self.cache._path(('explore', 2))
+        open(old + '.lock', 'w').close()
+        # Past the stale lifetime (10 + 60 seconds) for the entry, and past the lock timeout for the lock
+        past = time() - 100
+        os.utime(old, (past, past))
+        os.utime(old + '.lock', (past, past))
+        self.assertEqual(self.cache.prune(), 2)
+        self.assertEqual(os.listdir(self.cache_dir), [os.path.basename(self.cache._path(('explore', 1)))])
+
+    def test_explore_posts_come_from_the_cache(self):
+        app = create_app(TestConfig)
+        app.config['PAGE_CACHE_DIR'] = self.cache_dir
+        page_cache.init_app(app)
+        with app.app_context():
+            db.create_all()
+            u = User(username='john', email='john@example.com')
+            u.set_password('cat')
+            db.session.add_all([u, Post(body='cached post', author=u)])
+            db.session.commit()
+            client = app.test_client()
+            client.post('/auth/login', data={'username': 'john', 'password': 'cat'})
+            with mock.patch('app.main.routes._render_explore_posts', wraps=routes._render_explore_posts) as render:
+                for _ in range(2):
+                    rv = client.get('/explore')
+                    self.assertIn('cached post', rv.get_data(as_text=True))
+                    self.assertIn('Hi, john!', rv.get_data(as_text=True))
+            self.assertEqual(render.call_count, 1)
+            # Pages past PAGE_CACHE_MAX_PAGE are rendered without going through the cache
+            entries = len(os.listdir(self.cache_dir))
+            rv = client.get('/explore?page={}'.format(app.config['PAGE_CACHE_MAX_PAGE'] + 1))
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(len(os.listdir(self.cache_dir)), entries)
+            db.session.remove()
+            db.drop_all()
+
+
+# noinspection PyArgumentList
+class RecentPostsCase(unittest.TestCase):
+    def setUp(self):
+        self.feed_dir = tempfile.mkdtemp()
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.john = User(username='john', email='john@example.com')
+        now = datetime.utcnow()
+        db.session.add_all([Post(body='post {}'.format(i), author=self.john, timestamp=now + timedelta(seconds=i))
+                            for i in range(5)])
+        db.session.commit()
+        # Two buffers sharing the same change feed, as two worker processes would
+        feed = os.path.join(self.feed_dir, 'recent_posts.feed')
+        self.worker1 = RecentPosts(4, feed)
+        self.worker2 = RecentPosts(4, feed)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        shutil.rmtree(self.feed_dir)
+
+    def bodies(self, worker, page, per_page=2):
+        posts, has_next = worker.page(page, per_page)
+        return [post.body for post in posts], has_next
+
+    def test_pages_come_from_memory_and_follow_the_change_feed(self):
+        self.assertEqual(self.bodies(self.worker1, 1), (['post 4', 'post 3'], True))
+        self.assertEqual(self.bodies(self.worker2, 1), (['post 4', 'post 3'], True))
+        # Only the 4 newest posts are kept, the third page has to come from the database
+        self.assertIsNone(self.worker1.page(3, 2))
+
+        post = Post(body='post 5', author=self.john, timestamp=datetime.utcnow() + timedelta(seconds=10))
+        db.session.add(post)
+        db.session.commit()
+        with mock.patch.object(RecentPosts, '_query', side_effect=AssertionError('query')):
+            self.worker1.add(post)
+            self.assertEqual(self.bodies(self.worker1, 1), (['post 5', 'post 4'], True))
+            self.assertEqual(self.bodies(self.worker1, 2), (['post 3', 'post 2'], True))
+        # The other worker sees the new id in the feed and loads the post it is missing
+        self.assertEqual(self.bodies(self.worker2, 1), (['post 5', 'post 4'], True))
+        self.assertEqual(self.worker2.newest_id(), post.id)
+
+    def test_a_full_buffer_keeps_its_newest_posts_when_an_older_post_arrives(self):
+        self.worker1.page(1, 2)
+        post4 = Post.query.filter_by(body='post 4').one()
+        # Older than the head of the buffer, so it is merged in rather than pushed at the front
+        late = Post(body='late', author=self.john, timestamp=post4.timestamp - timedelta(milliseconds=500))
+        db.session.add(late)
+        db.session.commit()
+        self.worker1.add(late)
+        self.assertEqual(self.bodies(self.worker1, 1), (['post 4', 'late'], True))
+        self.assertEqual(self.bodies(self.worker1, 2), (['post 3', 'post 2'], True))
+
+    def test_a_post_committed_after_a_higher_id_is_picked_up(self):
+        post3 = Post.query.filter_by(body='post 3').one()
+        post3_id, timestamp = post3.id, post3.timestamp
+        db.session.delete(post3)
+        db.session.commit()
+        self.assertEqual(self.bodies(self.worker2, 1), (['post 4', 'post 2'], True))
+
+        # The post with the lower id becomes visible only now, the newest id of the feed does not move
+        db.session.add(Post(id=post3_id, body='post 3', author=self.john, timestamp=timestamp))
+        db.session.commit()
+        self.worker1.posts_created(db.session.query(db.func.max(Post.id)).scalar())
+        self.assertEqual(self.bodies(self.worker2, 1), (['post 4', 'post 3'], True))
+
+    def test_profile_change_reloads_the_authors(self):
+        self.worker2.page(1, 2)
+        self.john.username = 'johnny'
+        db.session.commit()
+        self.worker1.profile_changed()
+        posts, _ = self.worker2.page(1, 2)
+        self.assertEqual(posts[0].author.username, 'johnny')
+        self.assertIn('gravatar', posts[0].author.avatar(70))
+
+
+# noinspection PyArgumentList
+class CountersCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        cli.register(self.app)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.john = User(username='john', email='john@example.com')
+        self.susan = User(username='susan', email='susan@example.com')
+        db.session.add_all([self.john, self.susan])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_follow_and_posts_update_the_counters(self):
+        self.john.follow(self.susan)
+        db.session.commit()
+        self.assertEqual((self.john.followed_count, self.john.followers_count), (1, 0))
+        self.assertEqual((self.susan.followed_count, self.susan.followers_count), (0, 1))
+
+        self.john.unfollow(self.susan)
+        self.john.unfollow(self.susan)
+        db.session.commit()
+        self.assertEqual((self.john.followed_count, self.susan.followers_count), (0, 0))
+
+        self.john.set_password('cat')
+        db.session.commit()
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'john', 'password': 'cat'})
+        client.post('/index', data={'post': 'hello'})
+        self.assertEqual(User.query.get(self.john.id).posts_count, 1)
+
+    def test_reconcile_reports_and_fixes_drift(self):
+        self.john.follow(self.susan)
+        db.session.add(Post(body='hello', author=self.susan))
+        db.session.commit()
+        susan_id = self.susan.id
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(args=['counters', 'reconcile'])
+        self.assertIn('1 with drifted counters', result.output)
+        self.assertIn('posts_count 0 (actual 1)', result.output)
+
+        result = runner.invoke(args=['counters', 'reconcile', '--fix'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(User.query.get(susan_id).posts_count, 1)
+        self.assertIn('0 with drifted counters', runner.invoke(args=['counters', 'reconcile']).output)
+
+    def test_several_follows_in_one_session_keep_every_increment(self):
+        mary = User(username='mary', email='mary@example.com')
+        db.session.add(mary)
+        db.session.commit()
+
+        # Inside a request the follow state is remembered, so these run without any query (and flush) in between
+        with self.app.test_request_context():
+            self.john.follow(self.susan)
+            self.john.unfollow(self.susan)
+            self.john.following_ids([self.susan.id, mary.id])
+            self.john.follow(mary)
+            self.john.follow(self.susan)
+            self.john.unfollow(mary)
+            self.john.follow(mary)
+            db.session.commit()
+        mary.follow(self.john)
+        mary.unfollow(self.john)
+        mary.follow(self.john)
+        db.session.commit()
+
+        for u in (self.john, self.susan, mary):
+            self.assertEqual(u.followed_count, u.followed.count())
+            self.assertEqual(u.followers_count, u.followers.count())
+        self.assertEqual((self.john.followed_count, self.john.followers_count), (2, 1))
+        result = self.app.test_cli_runner().invoke(args=['counters', 'reconcile'])
+        self.assertIn('0 with drifted counters', result.output)
+
+
+# noinspection PyArgumentList
+class FollowStateCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(InstrumentedConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.users = [User(username='user{}'.format(i), email='user{}@example.com'.format(i)) for i in range(5)]
+        db.session.add_all(self.users)
+        db.session.commit()
+        self.users[0].follow(self.users[1])
+        self.users[0].follow(self.users[3])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_follow_state_is_batched_and_remembered_for_the_request(self):
+        me = self.users[0]
+        ids = [u.id for u in self.users]
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            self.assertEqual(me.following_ids(ids), {self.users[1].id, self.users[3].id})
+            self.assertEqual(current_stats().count, 1)
+            self.assertTrue(me.is_following(self.users[3]))
+            self.assertFalse(me.is_following(self.users[2]))
+            self.assertEqual(current_stats().count, 1)
+
+            me.unfollow(self.users[3])
+            me.follow(self.users[2])
+            db.session.commit()
+            self.assertEqual(me.following_ids(ids), {self.users[1].id, self.users[2].id})
+        # A new request asks the database again
+        self.assertEqual(me.following_ids(ids), {self.users[1].id, self.users[2].id})
+
+        # The remembered state skips the queries, not the counters: they still match the rows of the followers table
+        def rows(column, user_id):
+            return db.session.query(followers).filter(column == user_id).count()
+
+        for u in self.users:
+            self.assertEqual(u.followed_count, rows(followers.c.follower_id, u.id))
+            self.assertEqual(u.followers_count, rows(followers.c.followed_id, u.id))
+        self.assertEqual(me.followed_count, 2)
+
+
+# noinspection PyArgumentList
+class SocialGraphCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.users = [User(username='user{}'.format(i), email='user{}@example.com'.format(i)) for i in range(4)]
+        db.session.add_all(self.users)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_queries_match_the_followers_table_and_follow_the_deltas(self):
+        a, b, c, d = [u.id for u in self.users]
+        db.session.execute(followers.insert(), [{'follower_id': x, 'followed_id': y}
+                                                for x, y in ((a, b), (a, c), (b, a), (c, a), (d, a), (a, d))])
+        db.session.commit()
+        social_graph = SocialGraph.load()
+        self.assertEqual(social_graph.edges(), 6)
+        self.assertTrue(social_graph.is_following(a, c))
+        self.assertFalse(social_graph.is_following(c, b))
+        self.assertEqual(social_graph.following(a), [b, c, d])
+        self.assertEqual(social_graph.followers(a), [b, c, d])
+        self.assertEqual(social_graph.mutuals(b), [a])
+        self.assertEqual(social_graph.followers_count(a), 3)
+        # Users created after the load have no edges yet
+        self.assertEqual(social_graph.following(1000), [])
+
+        social_graph.unfollow(a, c)
+        social_graph.follow(c, b)
+        social_graph.follow(1000, a)
+        self.assertFalse(social_graph.is_following(a, c))
+        self.assertTrue(social_graph.is_following(c, b))
+        self.assertEqual(social_graph.following(a), [b, d])
+        self.assertEqual(social_graph.followers(a), [b, c, d, 1000])
+        self.assertEqual(social_graph.mutuals(a), [b, d])
+        self.assertEqual(social_graph.followers_count(b), 2)
+
+    def test_service_replays_the_changes_made_during_a_reload(self):
+        a, b, c, d = [u.id for u in self.users]
+        db.session.execute(followers.insert(), [{'follower_id': a, 'followed_id': b}])
+        db.session.commit()
+        service = GraphService(self.app)
+        self.assertTrue(service.get().is_following(a, b))
+
+        # A reload is running, and this worker commits a follow that the reload may have missed: it is applied to the
+        # current graph at once and journaled for the new one (the edge is not even in the table here)
+        service.reloading = True
+        service.changed(True, c, d)
+        self.assertTrue(service.get().is_following(c, d))
+        old = service.graph
+        service._reload()
+        self.assertIsNot(service.graph, old)
+        self.assertTrue(service.graph.is_following(a, b))
+        self.assertTrue(service.graph.is_following(c, d))
+        self.assertEqual((service.reloading, service.journal), (False, []))
+
+
+# noinspection PyArgumentList
+class SuggestionsCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.john, self.susan, self.mary, self.david = users = [
+            User(username=name, email=name + '@example.com') for name in ('john', 'susan', 'mary', 'david')]
+        db.session.add_all(users)
+        db.session.commit()
+        # john follows susan and mary, who both follow david, and mary also follows john
+        for follower, followed in ((self.john, self.susan), (self.john, self.mary), (self.susan, self.david),
+                                   (self.mary, self.david), (self.mary, self.john)):
+            follower.follow(followed)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_friends_of_friends_are_suggested(self):
+        self.assertEqual(suggestions.refresh(per_user=10), (4, 2))
+        self.assertEqual([u.username for u in self.john.suggested_users(5)], ['david'])
+        self.assertEqual([u.username for u in self.mary.suggested_users(5)], ['susan'])
+        self.assertEqual([u.username for u in self.susan.suggested_users(5)], [])
+        # Both backends give the same ranking
+        graph = SocialGraph.load()
+        ids = [u.id for u in (self.john, self.susan, self.mary, self.david)]
+        self.assertEqual(list(suggestions.compute(graph, ids, 10)),
+                         list(suggestions._compute_python(graph, ids, 10)))
+
+        # Nothing changed, nothing is recomputed. Then susan follows mary: susan and john (her follower) are recomputed
+        self.assertEqual(suggestions.refresh(per_user=10), (0, 0))
+        self.susan.follow(self.mary)
+        db.session.commit()
+        self.assertEqual(suggestions.refresh(per_user=10)[0], 2)
+        self.assertEqual([u.username for u in self.susan.suggested_users(5)], ['john'])
+
+        # A suggested user that gets followed disappears right away
+        self.john.follow(self.david)
+        db.session.commit()
+        self.assertEqual(self.john.suggested_users(5), [])
+
+
+# noinspection PyArgumentList
+class FollowListCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['USERS_PER_PAGE'] = 3
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.john = User(username='john', email='john@example.com')
+        self.john.set_password('cat')
+        self.fans = [User(username='fan{}'.format(i), email='fan{}@example.com'.format(i)) for i in range(5)]
+        db.session.add_all([self.john] + self.fans)
+        db.session.commit()
+        for fan in self.fans:
+            fan.follow(self.john)
+        self.john.follow(self.fans[3])
+        db.session.commit()
+        self.client = self.app.test_client()
+        self.client.post('/auth/login', data={'username': 'john', 'password': 'cat'})
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_users_following_back_are_marked_from_the_graph(self):
+        html = self.client.get('/user/john/following').get_data(as_text=True)
+        self.assertNotIn('follows you', html)
+        graph.init_app(self.app)
+        html = self.client.get('/user/john/following').get_data(as_text=True)
+        self.assertIn('follows you', html)
+        self.assertEqual(self.app.extensions['graph'].graph.edges(), 6)
+
+    def test_followers_are_paged_by_key(self):
+        html = self.client.get('/user/john/followers').get_data(as_text=True)
+        self.assertIn('5 followers', html)
+        self.assertIn('/follow/fan2', html)
+        self.assertNotIn('follow/fan3', html)
+        self.assertIn('/user/john/followers?after={}'.format(self.fans[2].id), html)
+
+        html = self.client.get('/user/john/followers?after={}'.format(self.fans[2].id)).get_data(as_text=True)
+        self.assertIn('/unfollow/fan3', html)
+        self.assertIn('/follow/fan4', html)
+        self.assertNotIn('/follow/fan2', html)
+        self.assertIn('/user/john/followers?before={}'.format(self.fans[3].id), html)
+
+        html = self.client.get('/user/john/followers?before={}'.format(self.fans[3].id)).get_data(as_text=True)
+        self.assertIn('/follow/fan0', html)
+        self.assertNotIn('/follow/fan4', html)
+
+        html = self.client.get('/user/john/following').get_data(as_text=True)
+        self.assertIn('following 1', html)
+        self.assertIn('/unfollow/fan3', html)
+
+
+# noinspection PyArgumentList
+class BulkFollowCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(InstrumentedConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.john = User(username='john', email='john@example.com')
+        self.john.set_password('cat')
+        self.others = [User(username='user{}'.format(i), email='user{}@example.com'.format(i)) for i in range(30)]
+        db.session.add_all([self.john] + self.others)
+        db.session.commit()
+        self.john.follow(self.others[0])
+        self.john.follow(self.others[1])
+        db.session.commit()
+        self.client = self.app.test_client()
+        self.client.post('/auth/login', data={'username': 'john', 'password': 'cat'})
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_many_users_are_followed_in_one_transaction(self):
+        to_follow = ['user{}'.format(i) for i in range(1, 30)] + ['nobody', 'john']
+        rv = self.client.post('/bulk_follow', json={'follow': to_follow, 'unfollow': ['user0']})
+        self.assertEqual(rv.status_code, 200)
+        result = rv.get_json()
+        self.assertEqual(len(result['followed']), 28)
+        self.assertEqual(result['unfollowed'], ['user0'])
+        self.assertEqual(result['unchanged'], ['john', 'user1'])
+        self.assertEqual(result['not_found'], ['nobody'])
+        # The number of statements does not depend on the number of users
+        self.assertLess(int(rv.headers['X-DB-Query-Count']), 12)
+
+        john = User.query.filter_by(username='john').first()
+        self.assertEqual(john.followed.count(), 29)
+        self.assertFalse(john.is_following(User.query.filter_by(username='user0').first()))
+        self.assertEqual(counters.reconcile()[1], [])
+
+    def test_bad_requests_are_rejected(self):
+        self.assertEqual(self.client.post('/bulk_follow', data='follow=susan').status_code, 400)
+        self.assertEqual(self.client.post('/bulk_follow', json={'follow': 'susan'}).status_code, 400)
+
+
+# noinspection PyArgumentList
+class ApiCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.john = User(username='john', email='john@example.com')
+        self.susan = User(username='susan', email='susan@example.com')
+        self.mary = User(username='mary', email='mary@example.com')
+        self.john.set_password('cat')
+        db.session.add_all([self.john, self.susan, self.mary])
+        db.session.commit()
+        self.john.follow(self.susan)
+        self.posts = [Post(body='post {}'.format(i), author=(self.susan, self.mary, self.john)[i % 3])
+                      for i in range(6)]
+        db.session.add_all(self.posts)
+        db.session.commit()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def get(self, path, token):
+        return self.client.get('/api/v1' + path, headers={'Authorization': 'Bearer ' + token})
+
+    def test_token_and_timelines(self):
+        self.assertEqual(self.client.get('/api/v1/timeline/home').status_code, 401)
+        basic = 'Basic ' + base64.b64encode(b'john:dog').decode()
+        self.assertEqual(self.client.post('/api/v1/tokens', headers={'Authorization': basic}).status_code, 401)
+        basic = 'Basic ' + base64.b64encode(b'john:cat').decode()
+        token = self.client.post('/api/v1/tokens', headers={'Authorization': basic}).get_json()['token']
+
+        home = self.get('/timeline/home?count=2', token).get_json()
+        ids = [p.id for p in self.posts]
+        self.assertEqual([p['id'] for p in home['posts']], [ids[5], ids[3]])
+        self.assertEqual(home['posts'][0]['author'], {'id': self.john.id, 'username': 'john'})
+        older = self.get('/timeline/home?max_id={}'.format(home['next_max_id']), token).get_json()
+        self.assertEqual([p['id'] for p in older['posts']], [ids[2], ids[0]])
+        self.assertIsNone(older['next_max_id'])
+
+        explore = self.get('/timeline/explore', token).get_json()
+        self.assertEqual(len(explore['posts']), 6)
+        poll = self.get('/timeline/explore?since_id={}'.format(explore['newest_id']), token).get_json()
+        self.assertEqual((poll['posts'], poll['newest_id']), ([], explore['newest_id']))
+        new_post = Post(body='news', author=self.mary)
+        db.session.add(new_post)
+        db.session.commit()
+        poll = self.get('/timeline/explore?since_id={}'.format(explore['newest_id']), token).get_json()
+        self.assertEqual([p['id'] for p in poll['posts']], [new_post.id])
+
+        self.assertEqual(len(self.get('/users/mary/posts', token).get_json()['posts']), 3)
+        self.assertEqual(self.get('/users/nobody/posts', token).status_code, 404)
+        self.assertEqual(self.get('/timeline/explore?since_id=abc', token).status_code, 400)
+
+        self.assertEqual(self.client.delete('/api/v1/tokens', headers={'Authorization': 'Bearer ' + token})
+                         .status_code, 204)
+        self.assertEqual(self.get('/timeline/home', token).status_code, 401)
+
+    def test_polling_with_since_id_skips_nothing(self):
+        token = self.john.get_token()
+        db.session.commit()
+        ids = [p.id for p in self.posts]
+        poll = self.get('/timeline/explore?count=4&since_id={}'.format(ids[0]), token).get_json()
+        # The 4 oldest of the 5 new posts, newest first, and the rest on the next poll
+        self.assertEqual([p['id'] for p in poll['posts']], ids[4:0:-1])
+        self.assertIsNone(poll['next_max_id'])
+        poll = self.get('/timeline/explore?count=4&since_id={}'.format(poll['newest_id']), token).get_json()
+        self.assertEqual([p['id'] for p in poll['posts']], [ids[5]])
+
+    def test_errors_are_json(self):
+        rv = self.client.get('/api/v1/nope')
+        self.assertEqual((rv.status_code, rv.get_json()), (404, {'error': 'Not Found'}))
+        rv = self.client.post('/api/v1/timeline/home')
+        self.assertEqual((rv.status_code, rv.get_json()), (405, {'error': 'Method Not Allowed'}))
+        # The web application keeps its HTML pages
+        rv = self.client.get('/nope')
+        self.assertEqual((rv.status_code, rv.mimetype), (404, 'text/html'))
+
+
+class LiveConfig(TestConfig):
+    # The pump is only run by the tests, its thread waits for a poke that never comes
+    LIVE_MAX_STREAMS = 2
+    LIVE_POLL_INTERVAL = 3600
+    LIVE_QUEUE_SIZE = 2
+
+
+# noinspection PyArgumentList
+class LiveCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(LiveConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.john = User(username='john', email='john@example.com')
+        self.john.set_password('cat')
+        self.susan = User(username='susan', email='susan@example.com')
+        self.mary = User(username='mary', email='mary@example.com')
+        db.session.add_all([self.john, self.susan, self.mary])
+        db.session.commit()
+        self.john.follow(self.susan)
+        db.session.commit()
+        live.init_app(self.app)
+        self.hub = live.get()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def post(self, author, body):
+        post = Post(body=body, author=author)
+        db.session.add(post)
+        db.session.commit()
+        return post.id
+
+    def test_new_posts_go_to_the_streams_of_the_followers(self):
+        johns, _ = self.hub.subscribe(live.authors_of(self.john.id))
+        marys, _ = self.hub.subscribe(live.authors_of(self.mary.id))
+        susan_post = self.post(self.susan, 'from susan')
+        mary_post = self.post(self.mary, 'from mary')
+        self.hub.pump()
+
+        events, overflowed = johns.drain()
+        self.assertEqual(len(events), 1)
+        self.assertTrue(events[0].startswith('id: {}\nevent: post\n'.format(susan_post)))
+        self.assertIn('"username": "susan"', events[0])
+        self.assertFalse(overflowed)
+        events, _ = marys.drain()
+        self.assertEqual([event.split('\n')[0] for event in events], ['id: {}'.format(mary_post)])
+
+        # Nothing is published twice, and nothing reaches a closed stream
+        self.hub.unsubscribe(johns)
+        self.post(self.susan, 'again')
+        self.hub.pump()
+        self.assertEqual(johns.drain(), ([], False))
+        self.assertEqual(self.hub.by_author, {self.mary.id: {marys}})
+
+    def test_a_post_committed_after_a_higher_id_is_pushed(self):
+        johns, _ = self.hub.subscribe(live.authors_of(self.john.id))
+        db.session.add(Post(id=50, body='committed first', author=self.susan))
+        db.session.commit()
+        self.hub.pump()
+        # Post 45 was inserted before post 50 but is only committed now
+        db.session.add(Post(id=45, body='committed late', author=self.susan))
+        db.session.commit()
+        self.hub.pump()
+        self.hub.pump()
+        events, _ = johns.drain()
+        self.assertEqual([event.split('\n')[0] for event in events], ['id: 50', 'id: 45'])
+
+    def test_a_slow_stream_keeps_its_newest_events(self):
+        johns, _ = self.hub.subscribe(live.authors_of(self.john.id))
+        ids = [self.post(self.susan, 'post {}'.format(i)) for i in range(3)]
+        self.hub.pump()
+        events, overflowed = johns.drain()
+        self.assertEqual([event.split('\n')[0] for event in events], ['id: {}'.format(i) for i in ids[1:]])
+        self.assertTrue(overflowed)
+
+    def test_stream_resumes_after_the_last_event_id(self):
+        first = self.post(self.susan, 'seen')
+        missed = self.post(self.susan, 'missed')
+        self.post(self.mary, 'not followed')
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'john', 'password': 'cat'})
+        response = client.get('/stream', headers={'Last-Event-ID': str(first)}, buffered=False)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        chunks = iter(response.response)
+        self.assertEqual(next(chunks), b'retry: 2000\n\n')
+        backfill = next(chunks).decode()
+        self.assertEqual(backfill.count('event: post'), 1)
+        self.assertIn('id: {}\n'.format(missed), backfill)
+        response.close()
+        self.assertEqual(self.hub.subscribers, 0)
+
+        # The home page listens to the stream
+        html = client.get('/index').get_data(as_text=True)
+        self.assertIn('new EventSource("/stream")', html)
+
+    def test_streams_past_the_limit_are_told_to_retry_later(self):
+        for _ in range(2):
+            self.hub.subscribe(live.authors_of(self.mary.id))
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'john', 'password': 'cat'})
+        response = client.get('/stream')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_data(as_text=True), 'retry: {}\n\n'.format(live.FULL_RETRY_MS))
+        self.assertEqual(self.hub.subscribers, 2)
+
+
+# noinspection PyArgumentList
+class SeedCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        cli.register(self.app)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_seed_command(self):
+        result = self.app.test_cli_runner().invoke(args=['seed', '--users', '50', '--posts', '200',
+                                                         '--follows', '5', '--random-seed', '1'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(User.query.count(), 50)
+        self.assertEqual(Post.query.count(), 200)
+
+        # Seeded users can log in with the shared password, follow each other and post in several languages
+        u = User.query.filter_by(username='user1').first()
+        self.assertTrue(u.check_password('password'))
+        self.assertGreater(db.session.query(followers).count(), 0)
+        self.assertFalse(u.is_following(u))
+        self.assertEqual({p.language for p in Post.query}, {'en', 'fr', 'es', 'de'})
+        self.assertEqual(u.posts_count, Post.query.filter_by(author=u).count())
+        self.assertEqual(u.followers_count, u.followers.count())
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)